@@ -0,0 +1,101 @@
+"""
+This script evaluates the memory needed for keeping a synthetic
+blockchain in memory, i.e., the blocks, transactions and outputs in
+koppercoin.tokens.Blockchain. The memory is measured with tracemalloc.
+
+As a baseline, the same chain is built from objects which keep their
+fields in __dict__, as the model classes did before they used
+__slots__. These are subclasses of the model classes which shadow the
+slots, so their empty slots remain and the baseline slightly
+overestimates the memory of the old objects.
+"""
+from koppercoin.tokens import *
+import os
+import binascii
+import tracemalloc
+import pandas as pd
+import matplotlib.pyplot as plt
+plt.style.use('ggplot')
+
+# The chainlengths which will be tested
+chainlengths = range(100, 1001, 100)
+# The number of transactions per block
+txs_per_block = 10
+
+
+class Mockpersistence():
+    def save(self, object):
+        pass
+
+    def load(self, entity):
+        pass
+
+
+def randhex(numbytes):
+    return binascii.hexlify(os.urandom(numbytes)).decode()
+
+
+def with_dict(cls):
+    """Returns a subclass of the model class cls whose objects keep
+    their fields and their cache in __dict__."""
+    shadowed = {name: None for base in cls.__mro__ for name in getattr(base, '__slots__', ())}
+    return type(cls.__name__, (cls,), shadowed)
+
+
+slotted = {cls.__name__: cls for cls in (Block, Transaction, TxInput, TxOutput)}
+baseline = {name: with_dict(cls) for (name, cls) in slotted.items()}
+
+
+def gen_transaction(classes):
+    # a synthetic transaction with a realistic structure but without
+    # valid signatures, which we do not need for measuring the memory
+    txin = classes['TxInput'](prevhashes=[randhex(64) for i in range(3)],
+                              signatures=[(randhex(32), int(randhex(32), 16), [int(randhex(32), 16) for i in range(3)])],
+                              amount=2**20)
+    txouts = [classes['TxOutput'](amount=2**19, recipientpubkeys=[randhex(32)], condition=OutputCondition.singlesig)
+              for i in range(2)]
+    return classes['Transaction'](inputs=[txin], outputs=txouts, pubkey=randhex(32), is_coinbase=False)
+
+
+def measure_chain(chainlength, classes):
+    """Returns the number of bytes allocated for a blockchain of
+    chainlength blocks built from the classes."""
+    tracemalloc.start()
+    blockchain = Blockchain(persistence=Mockpersistence())
+    block = genesisblock
+    for height in range(chainlength):
+        block = classes['Block'](blockheight=block.blockheight + 1, prevhash=block.hash, target=block.next_target(),
+                                 transactions=[gen_transaction(classes) for i in range(txs_per_block)])
+        blockchain.add_block(block)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del blockchain, block
+    return size
+
+
+memsizes = {'total': [], 'per block': [], 'total (__dict__)': [], 'per block (__dict__)': []}
+
+for chainlength in chainlengths:
+    print("Building chain of length " + str(chainlength) + " from " + str(list(chainlengths)))
+    size = measure_chain(chainlength, slotted)
+    memsizes['total'].append(size)
+    memsizes['per block'].append(size / chainlength)
+    size = measure_chain(chainlength, baseline)
+    memsizes['total (__dict__)'].append(size)
+    memsizes['per block (__dict__)'].append(size / chainlength)
+
+print("Running postprocessing steps")
+
+memsizes = pd.DataFrame(memsizes, index=chainlengths)
+memsizes['saving'] = 1 - memsizes['total'] / memsizes['total (__dict__)']
+print(memsizes)
+memsizes.to_csv('memsizes_chain.csv')
+
+plt.figure()
+memsizes['total'].plot(style='bo', label='__slots__')
+memsizes['total (__dict__)'].plot(style='ro', label='__dict__')
+plt.legend(loc='upper left')
+plt.xlabel('Length of the Chain')
+plt.ylabel('Memory Size in Bytes')
+plt.title('Memory Measurements for the Blockchain')
+plt.savefig('memsizes_chain.png')
@@ -0,0 +1,98 @@
+"""
+This script evaluates the time a new node needs to start, depending on
+the length of the blockchain: replaying all stored blocks into the
+in-memory indexes versus starting from a snapshot, see
+koppercoin.tokens.snapshot.
+"""
+from koppercoin.tokens import *
+from koppercoin.tokens import Persistencemanager
+from koppercoin.tokens import snapshot
+from koppercoin.crypto import lww_signature
+import os
+import tempfile
+import time
+import pandas as pd
+import matplotlib.pyplot as plt
+plt.style.use('ggplot')
+
+# The lengths of the blockchain which will be tested
+lengths = [100, 200, 400, 800]
+# The number of outputs of the transaction in each block
+outputs_per_block = 20
+# The number of starts per length
+runs = 3
+
+
+class Mockpersistence():
+    def save(self, object):
+        pass
+
+    def load(self, entity):
+        pass
+
+
+class Replaypersistence():
+    """Loads the stored blocks, but keeps the indexes in memory, so
+    they are rebuilt from the blocks."""
+    def __init__(self, pm):
+        self.pm = pm
+
+    def save(self, object):
+        pass
+
+    def load(self, blockchain):
+        self.pm.load(blockchain)
+
+
+pubkey = lww_signature.keygen()[1]
+timings = {'replay': [], 'snapshot': []}
+sizes = {'blocks': [], 'snapshot': []}
+directory = tempfile.TemporaryDirectory()
+
+for length in lengths:
+    print("Generating a blockchain with " + str(length) + " blocks")
+    path = os.path.join(directory.name, str(length) + ".db")
+    blockdir = os.path.join(directory.name, str(length))
+    pm = Persistencemanager(path, blockdir=blockdir)
+    blockchain = Blockchain(persistence=pm)
+    block = genesisblock
+    for height in range(1, length + 1):
+        tx = Transaction(outputs=[TxOutput(amount=2**(i % 20), recipientpubkeys=[pubkey], condition=OutputCondition.singlesig)
+                                  for i in range(outputs_per_block)],
+                         pubkey=pubkey, is_coinbase=True)
+        block = Block.from_prevblock(block, transactions=[tx])
+        blockchain.add_block(block)
+    snapshotpath = os.path.join(directory.name, str(length) + ".kcs")
+    commitment = snapshot.create(blockchain, snapshotpath)
+    pm.close()
+    sizes['blocks'].append(sum(os.path.getsize(os.path.join(blockdir, name)) for name in os.listdir(blockdir)))
+    sizes['snapshot'].append(os.path.getsize(snapshotpath))
+
+    print("Starting from the blocks and from the snapshot")
+    time_pre = time.time()
+    for run in range(runs):
+        pm = Persistencemanager(path, blockdir=blockdir)
+        Blockchain(persistence=Replaypersistence(pm))
+        pm.close()
+    timings['replay'].append((time.time() - time_pre) / runs)
+    time_pre = time.time()
+    for run in range(runs):
+        snapshot.load(Blockchain(persistence=Mockpersistence()), snapshotpath, commitment)
+    timings['snapshot'].append((time.time() - time_pre) / runs)
+
+print("Running postprocessing steps")
+
+timings = pd.DataFrame(timings, index=lengths)
+timings['speedup'] = timings['replay'] / timings['snapshot']
+print(timings)
+timings.to_csv('timings_coldstart.csv')
+sizes = pd.DataFrame(sizes, index=lengths)
+print(sizes)
+sizes.to_csv('sizes_coldstart.csv')
+
+plt.figure()
+timings[['replay', 'snapshot']].plot(style='o-')
+plt.xlabel('Number of Blocks')
+plt.ylabel('Time in sec')
+plt.title('Time Measurements for Starting a Node')
+plt.savefig('timings_coldstart.png')
@@ -0,0 +1,85 @@
+"""
+This script evaluates the time and memory needed for computing the
+hashes of blocks implemented in koppercoin.tokens.model, with and
+without the cached serialization.
+"""
+from koppercoin.tokens.model import *
+import os
+import binascii
+import time
+import tracemalloc
+import pandas as pd
+import matplotlib.pyplot as plt
+plt.style.use('ggplot')
+
+# The number of transactions per block which will be tested
+blocksizes = range(10, 101, 10)
+# The number of hash computations per blocksize
+runs = 20
+
+
+def randhex(numbytes):
+    return binascii.hexlify(os.urandom(numbytes)).decode()
+
+
+def gen_transaction():
+    # a synthetic transaction with a realistic structure but without
+    # valid signatures, which we do not need for hashing
+    txin = TxInput(prevhashes=[randhex(64) for i in range(3)],
+                   signatures=[(randhex(32), int(randhex(32), 16), [int(randhex(32), 16) for i in range(3)])],
+                   amount=2**20)
+    txouts = [TxOutput(amount=2**19, recipientpubkeys=[randhex(32)], condition=OutputCondition.singlesig)
+              for i in range(2)]
+    return Transaction.gen_regular(inputs=[txin], outputs=txouts, pubkey=randhex(32))
+
+
+def invalidate_all(block):
+    # emulate the behaviour without caching
+    block._invalidate()
+    for tx in block.transactions:
+        tx._invalidate()
+        for obj in tx.inputs + tx.outputs:
+            obj._invalidate()
+
+
+timings = {'uncached': [], 'cached': []}
+memsizes = {'cache': []}
+
+for blocksize in blocksizes:
+    print("Hashing block with " + str(blocksize) + " transactions from " + str(list(blocksizes)))
+    block = Block(blockheight=1, prevhash=randhex(64), target=randhex(63),
+                  transactions=[gen_transaction() for i in range(blocksize)])
+
+    time_pre = time.time()
+    for run in range(runs):
+        invalidate_all(block)
+        block.hash
+    timings['uncached'].append((time.time() - time_pre) / runs)
+
+    invalidate_all(block)
+    tracemalloc.start()
+    block.hash
+    memsizes['cache'].append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+
+    time_pre = time.time()
+    for run in range(runs):
+        block.hash
+    timings['cached'].append((time.time() - time_pre) / runs)
+
+print("Running postprocessing steps")
+
+timings = pd.DataFrame(timings, index=blocksizes)
+memsizes = pd.DataFrame(memsizes, index=blocksizes)
+print(timings)
+print(memsizes)
+timings.to_csv('timings_hash.csv')
+memsizes.to_csv('memsizes_hash.csv')
+
+plt.figure()
+timings.plot(style=['bo', 'gv'])
+plt.xlabel('Number of Transactions in the Block')
+plt.ylabel('Time in sec')
+plt.title('Time Measurements for Block.hash')
+plt.legend(loc='upper left')
+plt.savefig('timings_hash.png')
@@ -0,0 +1,78 @@
+"""
+This script evaluates the time needed for validating a block of ring
+signed transactions with koppercoin.tokens.validation, depending on
+the number of processes verifying the signatures.
+"""
+from koppercoin.tokens import *
+from koppercoin.tokens.validation import Validationexecutor
+from koppercoin.crypto import lww_signature
+import multiprocessing
+import time
+import pandas as pd
+import matplotlib.pyplot as plt
+plt.style.use('ggplot')
+
+# The numbers of processes which will be tested
+processes = range(1, multiprocessing.cpu_count() + 1)
+# The number of transactions in the block
+txs_per_block = 40
+# The size of the rings
+ringsize = 5
+# The number of validations per number of processes
+runs = 5
+
+
+class Mockpersistence():
+    def save(self, object):
+        pass
+
+    def load(self, entity):
+        pass
+
+
+print("Generating a block with " + str(txs_per_block) + " transactions")
+blockchain = Blockchain(persistence=Mockpersistence())
+# outputs which can be spent by the transactions and used as decoys
+keys = [lww_signature.keygen() for i in range(txs_per_block)]
+funding = Transaction(outputs=[TxOutput(amount=2**20, recipientpubkeys=[pub], condition=OutputCondition.singlesig)
+                               for (sec, pub) in keys],
+                      pubkey=keys[0][1], is_coinbase=True)
+prevblock = Block.from_prevblock(genesisblock, transactions=[funding])
+blockchain.add_block(prevblock)
+
+transactions = []
+for i, (sec, pub) in enumerate(keys):
+    ring = [funding.outputs[(i + j) % txs_per_block] for j in range(ringsize)]
+    txout = TxOutput(amount=2**20 - 1, recipientpubkeys=[lww_signature.keygen()[1]], condition=OutputCondition.singlesig)
+    tx = Transaction.gen_regular(inputs=[], outputs=[txout], pubkey=pub)
+    signature = lww_signature.ringsign([output.recipientpubkeys[0] for output in ring], sec, tx.signed_message())
+    tx.inputs = [TxInput.from_prevouts(prevouts=ring, signatures=[signature])]
+    transactions.append(tx)
+block = Block.from_prevblock(prevblock, transactions=transactions)
+
+timings = {'validation': []}
+
+for num in processes:
+    print("Validating with " + str(num) + " processes from " + str(list(processes)))
+    executor = Validationexecutor(num)
+    # start the pool before measuring
+    executor.check_signatures(transactions[:2], blockchain=blockchain)
+    time_pre = time.time()
+    for run in range(runs):
+        assert block.is_valid(blockchain=blockchain, sigcache=None, executor=executor)
+    timings['validation'].append((time.time() - time_pre) / runs)
+    executor.close()
+
+print("Running postprocessing steps")
+
+timings = pd.DataFrame(timings, index=processes)
+timings['speedup'] = timings['validation'][processes[0]] / timings['validation']
+print(timings)
+timings.to_csv('timings_validation.csv')
+
+plt.figure()
+timings['validation'].plot(style='bo')
+plt.xlabel('Number of Processes')
+plt.ylabel('Time in sec')
+plt.title('Time Measurements for Block.is_valid')
+plt.savefig('timings_validation.png')
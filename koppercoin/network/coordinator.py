@@ -0,0 +1,139 @@
+"""
+This file implements a coordinator which distributes the mining work
+of a node to remote workers, in the spirit of stratum. The workers do
+not need to run a node, see koppercoin.network.remoteworker.
+
+The messages are json objects, one per line, as in
+koppercoin.network.p2p. A worker sends
+
+    {'msgtype': 'subscribe', 'name': name}
+    {'msgtype': 'getwork'}
+    {'msgtype': 'submit', 'generation': generation, 'nonce': nonce}
+
+and the coordinator answers with
+
+    {'msgtype': 'job', 'generation': generation, 'prefix': prefix,
+     'target': target, 'sharetarget': sharetarget,
+     'extranonce': extranonce, 'rangebits': rangebits}
+    {'msgtype': 'result', 'generation': generation, 'nonce': nonce,
+     'accepted': accepted, 'reason': reason}
+
+A job contains the base64-encoded constant part of the header of the
+template (see BlockHeader.pow_prefix), so the worker only needs to
+hash. A worker which searched its range asks for more work with
+getwork. When the node publishes a new template, e.g., for a new tip,
+every subscribed worker gets a new job.
+
+A worker submits each digest below the share target. The coordinator
+counts the shares of each worker and passes the blocks to the node.
+The jobs and the shares are checked by a
+koppercoin.tokens.jobs.Jobdispatcher, this file only adds the network.
+
+    reactor.listenTCP(port, Coordinatorfactory.from_miningmanager(miningmanager))
+"""
+
+from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+from twisted.internet.error import ConnectionDone
+import json
+from koppercoin.tokens.jobs import Jobdispatcher, Workerstate
+
+# seconds between the checks for a new template
+_pollinterval = 0.05
+
+
+def log(msg):
+    print('\033[93m'+msg+'\033[0m')
+
+
+class Coordinatorprotocol(LineReceiver):
+    version = "0.1"
+    delimiter = b'\n'
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.state = Workerstate()
+        self.subscribed = False
+        self.dispatch = {'subscribe': self.handle_subscribe,
+                         'getwork': self.handle_getwork,
+                         'submit': self.handle_submit}
+
+    def connectionMade(self):
+        self.factory.workers.add(self)
+
+    def connectionLost(self, reason=ConnectionDone):
+        self.factory.workers.discard(self)
+
+    def lineReceived(self, line):
+        try:
+            msg = json.loads(line.decode("utf-8"))
+            self.dispatch[msg["msgtype"]](msg)
+        except Exception as e:
+            log("Error: "+str(e))
+
+    def send(self, msgdict):
+        msgdict['v'] = self.version
+        self.sendLine(json.dumps(msgdict).encode("utf-8"))
+
+    def send_job(self):
+        job = self.factory.dispatcher.job(self.state)
+        if job is not None:
+            self.send(job)
+
+    def handle_subscribe(self, msg):
+        self.state.name = str(msg.get('name'))
+        self.subscribed = True
+        self.send_job()
+
+    def handle_getwork(self, msg):
+        if self.subscribed:
+            self.send_job()
+
+    def handle_submit(self, msg):
+        (generation, nonce) = (int(msg['generation']), int(msg['nonce']))
+        (accepted, reason) = self.factory.dispatcher.check(self.state, generation, nonce)
+        self.send({'msgtype': 'result', 'generation': generation, 'nonce': nonce,
+                   'accepted': accepted, 'reason': reason})
+
+
+class Coordinatorfactory(Factory):
+    """Serves the templates of a Workview to remote workers.
+
+    :param view: the workview to which the node publishes its templates
+    :paramtype view: koppercoin.tokens.workview.Workview
+    :param extranonces: the shared counter of the extranonces
+    :paramtype extranonces: multiprocessing.Value
+    :param submit_block: is called with each block found by a worker
+    """
+
+    def __init__(self, view, extranonces, submit_block):
+        self.dispatcher = Jobdispatcher(view, extranonces, submit_block)
+        self.workers = set()
+        self.polling = LoopingCall(self.poll)
+
+    @classmethod
+    def from_miningmanager(cls, miningmanager):
+        """Serves the templates of the Miningmanager and passes the
+        blocks back to it."""
+        if miningmanager.view.generation == 0:
+            miningmanager.update_tip()
+        return cls(miningmanager.view, miningmanager.extranonces, miningmanager.submit_block)
+
+    def buildProtocol(self, addr):
+        return Coordinatorprotocol(self)
+
+    def startFactory(self):
+        self.polling.start(_pollinterval)
+
+    def stopFactory(self):
+        if self.polling.running:
+            self.polling.stop()
+
+    def poll(self):
+        """Notifies the workers if there is a new template."""
+        if not self.dispatcher.update():
+            return
+        for worker in list(self.workers):
+            if worker.subscribed:
+                worker.send_job()
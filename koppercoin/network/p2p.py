@@ -1,8 +1,9 @@
 from twisted.internet.protocol import Factory
 from twisted.internet.task import LoopingCall
 from twisted.protocols.basic import LineReceiver
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet.error import ConnectionDone
+from twisted.internet.threads import deferToThread
 from twisted.internet import reactor
 from time import time
 from uuid import uuid4 as uuid
@@ -10,7 +11,9 @@ import json
 import datetime
 import random
 import hashlib
+import base64
 from collections import defaultdict
+from koppercoin.tokens.validation import Validationpipeline, Validationexecutor
 
 def log(msg):
     print('\033[93m'+msg+'\033[0m')
@@ -103,11 +106,15 @@ class Transactions(Mixin):
         self.send_transaction(kwargs['tx'])
 
     def send_transaction(self, tx):
-        self.protocol.send({'msgtype': 'transaction', 'tx': tx.json()})
+        self.protocol.send({'msgtype': 'transaction', 'tx': base64.b64encode(tx.encode()).decode()})
 
     def handle_transaction(self, msg):
         from koppercoin.tokens.model import Transaction
-        tx = Transaction.from_json(msg["tx"])
+        try:
+            tx = Transaction.decode(base64.b64decode(msg["tx"]))
+        except ValueError:
+            self.factory.pipeline.reject_malformed('transaction')
+            return
         self.factory.publishTransaction(tx)
 
 
@@ -115,23 +122,228 @@ class Blocks(Mixin):
     def __init__(self, protocol):
         self.protocol = protocol
         self.factory = protocol.factory
-        self.msgtypes = {'block': self.handle_block}
+        self.msgtypes = {'block': self.handle_block, 'getblock': self.handle_getblock}
         self.entrances = {'block': self.start}
 
     def start(self, **kwargs):
         self.send_block(kwargs['block'])
 
     def send_block(self, block):
-        self.protocol.send({'msgtype': 'block', 'block': block.json()})
+        self.send_raw_block(block.encode())
+
+    def send_raw_block(self, raw):
+        self.protocol.send({'msgtype': 'block', 'block': base64.b64encode(raw).decode()})
+
+    def send_getblock(self, hash):
+        self.protocol.send({'msgtype': 'getblock', 'hash': hash})
+
+    def handle_getblock(self, msg):
+        # the block is sent as it is stored, without decoding it
+        try:
+            raw = self.factory.blockchain.get_raw_block(msg["hash"])
+        except KeyError:
+            return
+        self.send_raw_block(raw)
 
     def handle_block(self, msg):
-        from koppercoin.tokens.model import Block
-        block = Block.from_json(msg["block"])
-        self.factory.publishBlock(block)
-        self.factory.blockchain.add_block(block)
+        from koppercoin.tokens.model import LazyBlock
+        # the transactions are only decoded if the block is new
+        try:
+            block = LazyBlock.decode(base64.b64decode(msg["block"]))
+        except ValueError:
+            self.factory.pipeline.reject_malformed('block')
+            return
+        if block.hash in self.factory.sentblocks:
+            return
+        # the block is only relayed if it is valid
+        d = deferToThread(self.factory.pipeline.check_block, block)
+        d.addCallback(self.accept_block, block)
+        d.addErrback(lambda failure: log(str(failure.value)))
+
+    def accept_block(self, valid, block):
+        if not valid or block.hash in self.factory.sentblocks:
+            return
+        # a reorganization validates the blocks of the new chain, so the
+        # block is not added in the reactor
+        d = deferToThread(self.add_block, block)
+        d.addCallback(self.relay_block, block)
+        d.addErrback(lambda failure: log(str(failure.value)))
+
+    def add_block(self, block):
+        """
+        Adds the block to the blockchain and updates the mempool and the
+        miners. Runs in a thread.
+
+        :param block: The checked block.
+        :returns: The Chainupdate, or None if the block turned out to
+            be invalid.
+        """
+        # the miningmanager adds the blocks of its miners concurrently
+        with self.factory.blockchain.lock:
+            update = self.factory.blockchain.add_block(block)
+            # a block of another chain which turned out to be invalid
+            # when its chain got the most work
+            if block.hash in self.factory.blockchain.invalid:
+                return None
+            # the transactions of blocks which left the main chain are
+            # pending again, unless the new chain spends their keyimages
+            self.factory.mempool.update_chain(update, blockchain=self.factory.blockchain)
+            # the miners switch to the new tip
+            if update.connected:
+                self.factory.miningmanager.update_tip()
+        return update
+
+    def relay_block(self, update, block):
+        # only the blocks of the main chain are validated, so a block of
+        # another chain is relayed once its chain got the most work
+        if update is None or not update.connected:
+            return
+        # the light clients drop the outputs of blocks which left the
+        # main chain
+        for disconnected in update.disconnected:
+            self.factory.retractBlock(disconnected)
+        for connected in update.connected:
+            self.factory.publishBlock(connected)
         reactor.callInThread(self.factory.wallet.rescan_blockchain)
-        #self.factory.wallet.rescan_blockchain()
-        # todo check validity and remove tx from mempool
+
+
+class Tracking(Mixin):
+    """
+    Scanning of blocks on behalf of light clients. A light client
+    registers its tracking key and the node pushes only the matching
+    TxOutputs and tx pubkeys of new blocks. Optionally the node first
+    catches up from a given blockheight. If a block whose matches have
+    been pushed leaves the main chain, the node retracts its outputs.
+    """
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.factory = protocol.factory
+        self.subscription = None
+        # the scans for the subscription run one after the other, so
+        # the client gets the matches of the catch-up and of the new
+        # blocks ordered by blockheight
+        self.scans = None
+        # the hashes of the blocks whose matches have been pushed,
+        # mapped to the hashes of the pushed outputs
+        self.pushed = {}
+        # set if we subscribed at this peer as a light client
+        self.tracking = False
+        self.msgtypes = {'subscribetracking': self.handle_subscribe,
+                         'unsubscribetracking': self.handle_unsubscribe,
+                         'trackedoutputs': self.handle_trackedoutputs,
+                         'retractedoutputs': self.handle_retractedoutputs}
+        self.entrances = {'track': self.start}
+
+    def start(self, **kwargs):
+        self.send_subscribe(kwargs['trackingkey'], kwargs.get('fromheight'))
+
+    def send_subscribe(self, trackingkey, fromheight=None):
+        # client
+        self.tracking = True
+        self.protocol.send({'msgtype': 'subscribetracking', 'trackingkey': list(trackingkey),
+                            'fromheight': fromheight})
+
+    def send_unsubscribe(self):
+        # client
+        self.tracking = False
+        self.protocol.send({'msgtype': 'unsubscribetracking'})
+
+    def send_trackedoutputs(self, results):
+        # server
+        from koppercoin.tokens.tracking import Trackingsubscription
+        for block, entries in results:
+            # a new block may also be found by the catch-up
+            if block.hash in self.pushed:
+                continue
+            self.pushed[block.hash] = [txout.hash for (_, _, txouts) in entries for txout in txouts]
+            self.protocol.send({'msgtype': 'trackedoutputs',
+                                'matches': Trackingsubscription.serialize_matches(block, entries)})
+
+    def send_retractedoutputs(self, block):
+        # server
+        outputs = self.pushed.pop(block.hash, None)
+        if outputs is None:
+            return
+        self.protocol.send({'msgtype': 'retractedoutputs', 'blockhash': block.hash, 'outputs': outputs})
+
+    def scan(self, function, *args):
+        # server
+        # runs function in a thread after the previous scans and sends
+        # the results, unless the client unsubscribed meanwhile
+        subscription = self.subscription
+
+        def send(results):
+            if self.subscription is subscription:
+                self.send_trackedoutputs(results)
+
+        def run(_):
+            if self.subscription is not subscription:
+                return
+            d = deferToThread(function, *args)
+            d.addCallback(send)
+            return d
+        self.scans.addCallback(run)
+        self.scans.addErrback(lambda failure: log(str(failure.value)))
+
+    def handle_subscribe(self, msg):
+        # server
+        from koppercoin.tokens.tracking import Trackingsubscription
+        fromheight = msg.get('fromheight')
+        self.subscription = Trackingsubscription(msg['trackingkey'], fromheight=fromheight or 0)
+        self.scans = succeed(None)
+        self.pushed = {}
+        self.factory.trackers.add(self)
+        if fromheight is not None:
+            # catch-up mode, scan the chain in a thread to not block the reactor
+            self.scan(self.subscription.catch_up, self.factory.blockchain)
+
+    def handle_unsubscribe(self, msg):
+        # server
+        self.subscription = None
+        self.factory.trackers.discard(self)
+
+    def handle_trackedoutputs(self, msg):
+        # client
+        from koppercoin.tokens.model import TxOutput
+        # only the peers we subscribed at push outputs to us
+        if not self.tracking:
+            return
+        matches = msg['matches']
+        for entry in matches['transactions']:
+            for output in entry['outputs']:
+                self.factory.trackedoutputs.append((matches['blockheight'], entry['pubkey'],
+                                                    TxOutput.from_dict(output)))
+
+    def handle_retractedoutputs(self, msg):
+        # client
+        if not self.tracking:
+            return
+        retracted = set(msg['outputs'])
+        self.factory.trackedoutputs[:] = [entry for entry in self.factory.trackedoutputs
+                                          if entry[2].hash not in retracted]
+
+    def push_block(self, block):
+        # server
+        if self.subscription is None:
+            return
+        self.scan(self.subscription.scan_blocks, [block])
+
+    def retract_block(self, block):
+        # server
+        # the retraction waits for the scans, which may still push the
+        # matches of the block
+        subscription = self.subscription
+        if subscription is None:
+            return
+
+        def send(_):
+            if self.subscription is subscription:
+                self.send_retractedoutputs(block)
+        self.scans.addCallback(send)
+        self.scans.addErrback(lambda failure: log(str(failure.value)))
+
+    def connectionLost(self):
+        self.factory.trackers.discard(self)
 
 
 class StoreFile(Mixin):
@@ -331,7 +543,8 @@ class KCProtocol(LineReceiver):
                        StoreFile(self),
                        RetrieveFile(self),
                        Transactions(self),
-                       Blocks(self)]
+                       Blocks(self),
+                       Tracking(self)]
         self.dispatch = defaultdict(lambda: (lambda msg: None))
         self.dispatch.update({"init": self.handle_init, "init2": self.handle_init2})
         self.start = defaultdict(lambda: (lambda **kwargs: None))
@@ -459,6 +672,12 @@ class KCFactory(Factory):
         self.files = {} # used for file retrieval
         self.senttx = set() # maybe remove entries after time late
         self.sentblocks = set() # maybe remove entries after time late
+        self.trackers = set() # light clients which subscribed with a tracking key
+        self.trackedoutputs = [] # outputs pushed to us as a light client
+        # the signatures verified for the mempool are not verified
+        # again when their transactions arrive in a block
+        self.pipeline = Validationpipeline(blockchain, mempool, seentransactions=self.senttx, seenblocks=self.sentblocks,
+                                           executor=Validationexecutor(), sigcache=mempool.sigcache)
 
     def _updateConnections(self):
         try:
@@ -489,11 +708,40 @@ class KCFactory(Factory):
             self.sentblocks.add(block.hash)
             for connection in self.connections:
                 connection.start["block"](block=block)
+            self.notifyTrackers(block)
+
+    def notifyTrackers(self, block):
+        for tracker in list(self.trackers):
+            tracker.push_block(block)
+
+    def retractBlock(self, block):
+        # the block left the main chain
+        for tracker in list(self.trackers):
+            tracker.retract_block(block)
+
+    def track(self, trackingkey, fromheight=None):
+        # subscribe at all connections with our tracking key
+        for connection in self.connections:
+            connection.start["track"](trackingkey=trackingkey, fromheight=fromheight)
 
     def publishTransaction(self, transaction):
+        if transaction.hash in self.senttx:
+            return
+        # the transaction is only relayed if it is valid
+        d = deferToThread(self.pipeline.check_transaction, transaction)
+        d.addCallback(self._relayTransaction, transaction)
+        d.addErrback(lambda failure: log(str(failure.value)))
+
+    def _relayTransaction(self, valid, transaction):
         try:
-            if transaction.hash not in self.senttx:
-                self.mempool.add(transaction)
+            if not valid:
+                log("Dropped invalid transaction " + transaction.hash[:10])
+            elif transaction.hash not in self.senttx:
+                # the pipeline checks transactions concurrently, so a
+                # conflicting one may have been added meanwhile
+                if not self.mempool.add(transaction):
+                    log("Dropped conflicting or low fee transaction " + transaction.hash[:10])
+                    return
                 self.miningmanager.add_transaction(transaction)
                 self.senttx.add(transaction.hash)
                 for connection in self.connections:
@@ -0,0 +1,104 @@
+"""
+This file implements the reference worker of the mining coordinator,
+see koppercoin.network.coordinator. It searches the nonces of its jobs
+with the hashing kernel of koppercoin.tokens.mining and submits the
+shares. It only needs the python standard library and does not run a
+node.
+
+    python -m koppercoin.network.remoteworker host port [name]
+"""
+
+import json
+import time
+import base64
+import socket
+import select
+import hashlib
+import threading
+from koppercoin.tokens import mining
+
+
+class Remoteworker():
+    """A worker which mines for the coordinator at host and port.
+
+    :param name: the name under which the shares are counted
+    """
+
+    def __init__(self, host, port, name=None):
+        self.host = host
+        self.port = port
+        self.name = name or socket.gethostname()
+        self.job = None
+        self.hashes = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.buffer = b''
+
+    def send(self, msgdict):
+        self.sock.sendall(json.dumps(msgdict).encode("utf-8") + b'\n')
+
+    def receive(self, timeout):
+        """Handles the messages which arrive within timeout seconds."""
+        if select.select([self.sock], [], [], timeout)[0]:
+            data = self.sock.recv(2**16)
+            if not data:
+                raise ConnectionError("The coordinator closed the connection")
+            self.buffer += data
+        while b'\n' in self.buffer:
+            (line, self.buffer) = self.buffer.split(b'\n', 1)
+            msg = json.loads(line.decode("utf-8"))
+            if msg['msgtype'] == 'job':
+                self.start_job(msg)
+            elif msg['msgtype'] == 'result':
+                if msg['accepted']:
+                    self.accepted += 1
+                else:
+                    self.rejected += 1
+
+    def start_job(self, msg):
+        self.job = msg
+        self.prefix_hash = hashlib.sha512(base64.b64decode(msg['prefix']))
+        self.sharetarget = bytes.fromhex(msg['sharetarget'])
+        self.position = msg['extranonce'] << msg['rangebits']
+        self.end = self.position + 2**msg['rangebits']
+
+    def run(self, stop=None):
+        """Mines until stop is set.
+        :paramtype stop: threading.Event
+        """
+        stop = stop or threading.Event()
+        self.sock = socket.create_connection((self.host, self.port))
+        try:
+            self.send({'msgtype': 'subscribe', 'name': self.name})
+            while not stop.is_set():
+                if self.job is None:
+                    self.receive(mining._pollinterval)
+                    continue
+                batchend = min(self.position + mining._batchsize, self.end)
+                nonce = mining.search_nonces(self.prefix_hash, self.sharetarget, self.position, batchend)
+                if nonce is None:
+                    self.hashes += batchend - self.position
+                    self.position = batchend
+                else:
+                    self.hashes += nonce - self.position + 1
+                    self.position = nonce + 1
+                    self.send({'msgtype': 'submit', 'generation': self.job['generation'], 'nonce': nonce})
+                if self.position == self.end:
+                    self.job = None
+                    self.send({'msgtype': 'getwork'})
+                # a new job replaces the current one
+                self.receive(0)
+        finally:
+            self.sock.close()
+
+
+if __name__ == '__main__':
+    import sys
+    worker = Remoteworker(sys.argv[1], int(sys.argv[2]), sys.argv[3] if len(sys.argv) > 3 else None)
+    thread = threading.Thread(target=worker.run, daemon=True)
+    thread.start()
+    starttime = time.time()
+    while thread.is_alive():
+        thread.join(10)
+        print("Hashrate: %d H/s, %d shares accepted, %d rejected"
+              % (worker.hashes / (time.time() - starttime), worker.accepted, worker.rejected))
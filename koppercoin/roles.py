@@ -39,6 +39,16 @@ class Role():
         point = TCP4ClientEndpoint(reactor, "134.60.77.158", 27346)
         d = point.connect(self.factory)
         d.addCallback(gotProtocol)
+        # the writes are queued to daemon threads, which do not finish
+        # them at exit
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def close(self):
+        """Writes the pending blocks, indexes and transactions and
+        closes the databases."""
+        for pm in (self.blockchain.pm, self.mempool.pm):
+            pm.commit()
+            pm.close()
 
     @run_in_reactor
     def store(self, file, jstate):
@@ -49,6 +59,13 @@ class Role():
         d = self.factory.retrieve(fileid)
         return d
 
+    @run_in_reactor
+    def servemining(self, port):
+        # remote workers can mine for this node, see koppercoin.network.coordinator
+        from twisted.internet import reactor
+        from .network.coordinator import Coordinatorfactory
+        reactor.listenTCP(port, Coordinatorfactory.from_miningmanager(self.miningmanager))
+
     @run_in_reactor
     def _transfermoney(self, tx):
         self.factory.publishTransaction(tx)
@@ -145,4 +162,7 @@ class Miner(Role):
         self.role.miningmanager.start_mining()
 
     def stopmining(self):
-        self.role.miningmanager.stop_mining()
\ No newline at end of file
+        self.role.miningmanager.stop_mining()
+
+    def servemining(self, port=27348):
+        self.role.servemining(port)
\ No newline at end of file
@@ -1,10 +1,18 @@
-from .model import Block, Transaction, TxInput, TxOutput, OutputCondition
+from .model import Block, BlockHeader, LazyBlock, PrunedBlock, Transaction, TxInput, TxOutput, OutputCondition
 from .mempool import Mempool
 # Tailimport of Wallet to prevent Circular import Problems
 from .mining import Miningmanager
+from .index import Memoryindexes, Sqliteindexes
+from .persistence import Sqlitewriter, Readerpool, connect
+from .blockstore import Blockstore, migrate
 from collections import namedtuple
+import os
+import heapq
+import threading
 
 class Genesisblock(Block):
+    __slots__ = ()
+
     def is_valid(self, *args,**kwargs):
         return True
 
@@ -12,90 +20,532 @@ genesisblock = Genesisblock(blockheight=0, prevhash='0000', target='0', nonce='0
 
 
 class Persistencemanager():
-    def __init__(self):
-        import sqlite3
-        self.conn = sqlite3.connect("blockchain.db", check_same_thread=False)
-        self.__create_tables()
-        self.clear()
+    """Stores the blocks of the blockchain in append-only segment files,
+    see koppercoin.tokens.blockstore, and the indexes of the blockchain
+    in a sqlite database. The writes are done in the background by a
+    Sqlitewriter, commit waits until they are on disk. See
+    koppercoin.tokens.persistence for the parameters.
 
-    def __create_tables(self):
-        cursor = self.conn.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS blocks (height integer, hash text, content text)")
-        self.conn.commit()
+    :param blockdir: the directory of the segment files, by default
+        the directory blocks next to the database
+    :param segmentsize: the size of the segment files
+    """
+    def __init__(self, path="blockchain.db", *, blockdir=None, segmentsize=2**27, durability='normal',
+                 flushsize=512, flushinterval=1.0):
+        self.path = path
+        self.__create_tables(durability)
+        self.writer = Sqlitewriter(path, durability=durability, flushsize=flushsize, flushinterval=flushinterval)
+        self.readers = Readerpool(path)
+        if blockdir is None:
+            blockdir = os.path.join(os.path.dirname(path), "blocks")
+        self.store = Blockstore(blockdir, segmentsize=segmentsize, sync=(durability == 'full'))
+        # databases of older versions store the blocks in a table
+        if len(self.store) == 0:
+            migrate(path, self.store)
 
-    def clear(self):
-        self.newset = set()
+    def __create_tables(self, durability):
+        conn = connect(self.path, durability)
+        Sqliteindexes.create_tables(conn)
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS invalidblocks (hash text PRIMARY KEY)")
+        conn.close()
 
     def save(self, block):
-        self.newset.add(block)
+        self.store.append(block)
+
+    def mark_invalid(self, hash):
+        """Remembers that the block is invalid, so it is not loaded
+        again."""
+        self.writer.submit("INSERT OR IGNORE INTO invalidblocks VALUES (?)", [(hash,)])
+
+    def invalid_blocks(self):
+        """Returns the hashes of the invalid blocks."""
+        with self.readers.connection() as conn:
+            return [hash for (hash,) in conn.execute("SELECT hash FROM invalidblocks")]
+
+    def iter_blocks(self):
+        """Streams all stored blocks ordered by their height."""
+        return self.store.iter_blocks()
+
+    def raw_block(self, hash):
+        """Returns the encoding of a stored block without decoding it.
+        :raises KeyError: if the block is not stored or pruned"""
+        if self.store.is_pruned(hash):
+            raise KeyError(hash)
+        return self.store.get_raw(hash)
+
+    def get_block(self, hash):
+        """Returns a stored block, its transactions are decoded lazily.
+        It is a PrunedBlock if its transactions have been deleted.
+        :raises KeyError: if the block is not stored"""
+        return self.store.get_block(hash)
+
+    def prune(self, height):
+        """Deletes the stored transactions of the blocks below height,
+        see koppercoin.tokens.blockstore."""
+        self.store.prune(height)
+
+    def raw_blocks(self, hashes):
+        """Returns the encodings of the stored blocks with one lookup,
+        None for the blocks which are not stored."""
+        return self.store.get_raw_many(hashes)
 
     def load(self, blockchain):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM blocks ORDER BY height DESC LIMIT 1")
-        try:
-            height, hash, jsonblock = cursor.fetchone()
-        except:
-            return
-        block = Block.from_json(jsonblock)
-        blockchain.add_block(block)
-        while block.prevhash != genesisblock.hash:
-            cursor.execute("SELECT * FROM blocks WHERE hash = ?", (block.prevhash,))
-            _, _, jsonblock = cursor.fetchone()
-            block = Block.from_json(jsonblock)
-            blockchain.add_block(block)
+        # the store contains the blocks of all chains, the blockchain
+        # selects the main chain
+        blockchain.load_blocks(self.iter_blocks())
+
+    def indexes(self):
+        """Returns the indexes of the blockchain, which are stored in
+        the database."""
+        return Sqliteindexes(self.writer, self.readers)
 
     def commit(self):
-        cursor = self.conn.cursor()
-        for block in self.newset:
-            prepared = (block.blockheight, block.hash, block.json())
-            cursor.execute("INSERT INTO blocks VALUES (?, ?, ?)", prepared)
-        self.conn.commit()
-        self.clear()
+        """Waits until all saved blocks are written."""
+        self.store.flush()
+        self.writer.flush()
+
+    def close(self):
+        self.store.close()
+        self.writer.close()
+
+
+_persistence = None
+
+
+def _default_persistence():
+    """Returns the Persistencemanager of blockchain.db in the working
+    directory, which is shared by the blockchains without their own.
+    It is only opened when it is used, not when the module is
+    imported."""
+    global _persistence
+    if _persistence is None:
+        _persistence = Persistencemanager()
+    return _persistence
+
+
+class Blockmap():
+    """The blocks of the tree by their hashes. If the persistence
+    stores the blocks, see Persistencemanager.get_block, only the
+    headers of the stored blocks are kept in memory and a block is read
+    from the persistence when it is accessed, with its transactions
+    decoded lazily. Otherwise, and
+    for the genesis block and pruned blocks, the blocks are kept in
+    memory.
+
+    The blocks added by add stay in memory until release is called,
+    i.e., until they are stored.
+    """
+
+    def __init__(self, persistence):
+        self.pm = persistence
+        self.stored = hasattr(persistence, 'get_block')
+        # the blocks in memory and the headers of the stored blocks
+        self.entries = {}
+        # the hashes of the blocks which are not stored yet
+        self.unsaved = set()
+
+    def __contains__(self, hash):
+        return hash in self.entries
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, hash):
+        entry = self.entries[hash]
+        if isinstance(entry, BlockHeader):
+            return self.pm.get_block(hash)
+        return entry
+
+    def __setitem__(self, hash, block):
+        """Keeps the block in memory."""
+        self.entries[hash] = block
+        self.unsaved.discard(hash)
+
+    def add(self, block):
+        """Adds a block which is stored on the next release."""
+        self.entries[block.hash] = block
+        self.unsaved.add(block.hash)
+
+    def release(self):
+        """Drops the transactions of the added blocks from memory, once
+        they are stored."""
+        for hash in self.unsaved:
+            block = self.entries.get(hash)
+            if self.stored and block is not None and not block.is_pruned:
+                self.entries[hash] = block.header
+        self.unsaved.clear()
+
+    def discard(self, hash):
+        self.entries.pop(hash, None)
+        self.unsaved.discard(hash)
+
+    def is_pruned(self, hash):
+        entry = self.entries[hash]
+        return not isinstance(entry, BlockHeader) and entry.is_pruned
 
 
 class Blockchain():
+    """The blockchain is a tree of blocks. Every block knows its
+    previous block, its height and the cumulative work of the chain
+    ending in it. The main chain is the chain with the most work, its
+    last block is the maxblock. Only the transactions of the main chain
+    are in the indexes: when another chain gets more work, the blocks
+    of the old chain are rolled back down to the fork and the blocks of
+    the new chain are applied. Blocks whose previous block is unknown
+    are kept as orphans until it arrives.
+
+    The hashes of the main chain are indexed by their height in
+    mainchain, so ranges of the main chain can be read without walking
+    it from the tip.
+
+    A pruned node only keeps the last retain_blocks blocks or the last
+    retain_bytes bytes of blocks of the main chain in full, the older
+    blocks are replaced by PrunedBlocks in memory and in the
+    persistence. Their outputs, keyimages and transactions stay in the
+    indexes, so wallets and the decoy index are not affected. A
+    reorganization which would need to roll back pruned blocks is not
+    done. The stored blocks are only kept in memory as headers, see
+    Blockmap.
+
+    The validation pipeline checks the transactions of a block against
+    the indexes, i.e., the main chain, so it can only do this for blocks
+    which extend the maxblock. The blocks of another chain are validated
+    when they join the main chain: if one of them is invalid, the
+    reorganization is undone, the block and the blocks on top of it are
+    dropped and remembered as invalid.
+    """
     Maxblock = namedtuple('Maxblock', 'blockheight hash')
+    # work is the cumulative work of the chain ending in the block
+    Treenode = namedtuple('Treenode', 'blockheight prevhash work')
+    # the blocks which left and joined the main chain by a new block,
+    # both ordered by their height
+    Chainupdate = namedtuple('Chainupdate', 'disconnected connected')
 
-    def __init__(self,*, persistence=Persistencemanager(), allowload=True):
-        self.blocks = {}
-        self.transactions = {}
-        self.keyimages = {}
-        self.outputs = {}
+    def __init__(self,*, persistence=None, allowload=True, keyimagefilter=None,
+                 retain_blocks=None, retain_bytes=None):
+        # serializes the threads which add blocks, e.g., the network
+        # and the miners
+        self.lock = threading.RLock()
+        if persistence is None:
+            persistence = _default_persistence()
+        # the indexes are stored by the persistence if it supports it
+        if hasattr(persistence, 'indexes'):
+            self.indexes = persistence.indexes()
+        else:
+            self.indexes = Memoryindexes()
+        self.transactions = self.indexes.transactions
+        self.keyimages = self.indexes.keyimages
+        self.outputs = self.indexes.outputs
+        # an optional Bloomfilter in front of keyimages
+        self.keyimagefilter = keyimagefilter
+        if keyimagefilter is not None:
+            for keyimage in self.indexes.iter_keyimages():
+                keyimagefilter.add(keyimage)
+        self.blocks = Blockmap(persistence)
         self.blocks[genesisblock.hash] = genesisblock
+        self.tree = {genesisblock.hash: Blockchain.Treenode(blockheight=0, prevhash=genesisblock.prevhash,
+                                                            work=genesisblock.work)}
+        # the orphans by the hash of their previous block
+        self.orphans = {}
+        # the hashes of blocks which failed validation on their chain
+        self.invalid = set()
         self.maxblock = Blockchain.Maxblock(blockheight=0, hash=genesisblock.hash)
+        # the hashes of the main chain by their height
+        self.mainchain = [genesisblock.hash]
+        self.retain_blocks = retain_blocks
+        self.retain_bytes = retain_bytes
+        # the blocks which are not pruned, as a heap of (height, hash),
+        # and the encoded sizes of the blocks for retain_bytes
+        self.fullblocks = []
+        self.sizes = {}
         self.pm = persistence
         if allowload:
+            if hasattr(self.pm, 'invalid_blocks'):
+                self.invalid.update(self.pm.invalid_blocks())
             self.pm.load(self)
+        self.prune()
 
     def add_block(self, block):
-        if block.blockheight > self.maxblock.blockheight:
-            self.maxblock = Blockchain.Maxblock(blockheight=block.blockheight, hash=block.hash)
-            # TODO:
-            # Manage forks?!
-        for tx in block.transactions:
-            self.add_transaction(tx)
-        self.blocks[block.hash] = block
-        self.pm.save(block)
+        """Adds a block to the tree and updates the indexes if the main
+        chain changed.
+        :returns: a Chainupdate with the blocks which left and joined
+            the main chain
+        """
+        # a block which repeats a transaction may have the hash of a
+        # valid block, see merkle_root, so it is not remembered at all
+        if not block.has_unique_transactions():
+            return Blockchain.Chainupdate(disconnected=[], connected=[])
+        with self.lock:
+            update = self._insert_block(block)
+            if block.hash not in self.invalid:
+                self.pm.save(block)
+            # the blocks of the tree were stored when they arrived
+            self.blocks.release()
+            self.prune()
+            return update
 
-    def add_transaction(self, tx):
-        self.transactions[tx.hash] = tx
+    def load_blocks(self, blocks):
+        """Inserts blocks which have been loaded from the persistence,
+        so they are not saved again. The blocks need to be ordered by
+        their height. The indexes are only updated once all blocks are
+        in the tree, so a fork in the stored blocks does not cause
+        reorganizations."""
+        for block in blocks:
+            self._connect(block)
+        mainchain = [self.blocks[hash] for hash in self._mainchain_hashes()]
+        self.mainchain = [block.hash for block in reversed(mainchain)]
+        onmain = set(block.hash for block in mainchain)
+        for hash in self.blocks:
+            if hash not in onmain and self.indexes.has_block(hash):
+                self.indexes.remove_block(hash, list(self.blocks[hash].iter_transactions()))
+        for block in reversed(mainchain):
+            self._index_block(block)
+        self.blocks.release()
+
+    def _mainchain_hashes(self):
+        hash = self.maxblock.hash
+        while hash in self.tree:
+            yield hash
+            hash = self.tree[hash].prevhash
+
+    def _insert_block(self, block):
+        if block.hash in self.blocks:
+            return Blockchain.Chainupdate(disconnected=[], connected=[])
+        oldtip = self.maxblock.hash
+        self._connect(block)
+        return self._reorganize(oldtip)
+
+    def _connect(self, block):
+        """Adds the block and the orphans waiting for it to the tree
+        and moves the maxblock to the block with the most work. Blocks
+        whose height does not follow the height of their previous block
+        are dropped."""
+        if block.hash in self.invalid or block.prevhash in self.invalid:
+            self.invalid.add(block.hash)
+            return
+        if block.prevhash not in self.tree:
+            siblings = self.orphans.setdefault(block.prevhash, [])
+            if all(sibling.hash != block.hash for sibling in siblings):
+                siblings.append(block)
+            return
+        waiting = [block]
+        while waiting:
+            block = waiting.pop()
+            if block.hash in self.tree or block.blockheight != self.tree[block.prevhash].blockheight + 1:
+                continue
+            node = Blockchain.Treenode(blockheight=block.blockheight, prevhash=block.prevhash,
+                                       work=self.tree[block.prevhash].work + block.work)
+            self.tree[block.hash] = node
+            self.blocks.add(block)
+            block.compact()
+            if self.is_pruning and not block.is_pruned:
+                heapq.heappush(self.fullblocks, (block.blockheight, block.hash))
+                if self.retain_bytes is not None:
+                    self.sizes[block.hash] = len(block.encode())
+            # on equal work the first block stays the tip
+            if node.work > self.tree[self.maxblock.hash].work:
+                self.maxblock = Blockchain.Maxblock(blockheight=block.blockheight, hash=block.hash)
+            waiting += self.orphans.pop(block.hash, [])
+
+    def _reorganize(self, oldtip):
+        """Updates the indexes after the maxblock moved away from
+        oldtip. The blocks of the old chain are rolled back down to the
+        fork, then the blocks of the new chain are applied."""
+        disconnected, connected = [], []
+        old, new = oldtip, self.maxblock.hash
+        while old != new:
+            if self.tree[old].blockheight > self.tree[new].blockheight:
+                disconnected.append(self.blocks[old])
+                old = self.tree[old].prevhash
+            else:
+                connected.append(self.blocks[new])
+                new = self.tree[new].prevhash
+        if disconnected and any(block.is_pruned for block in disconnected + connected):
+            # the transactions of pruned blocks are unknown, so we
+            # stay on the old chain
+            self.maxblock = Blockchain.Maxblock(blockheight=self.tree[oldtip].blockheight, hash=oldtip)
+            return Blockchain.Chainupdate(disconnected=[], connected=[])
+        for block in disconnected:
+            self.indexes.remove_block(block.hash, list(block.iter_transactions()))
+        connected.reverse()
+        disconnected.reverse()
+        # blocks which extend the old main chain one by one have been
+        # validated against it, the others only on their own chain
+        validate = bool(disconnected) or len(connected) > 1
+        oldchain = self.mainchain[self.tree[new].blockheight + 1:]
+        del self.mainchain[self.tree[new].blockheight + 1:]
+        for i, block in enumerate(connected):
+            if validate and not self.is_valid_on_chain(block):
+                self._undo_reorganize(oldtip, oldchain, disconnected, connected[:i])
+                self._drop_invalid(block.hash)
+                return Blockchain.Chainupdate(disconnected=[], connected=[])
+            self.mainchain.append(block.hash)
+            self._index_block(block)
+        return Blockchain.Chainupdate(disconnected=disconnected, connected=connected)
+
+    def is_valid_on_chain(self, block):
+        """Validates the transactions of a block against the indexes,
+        which contain the chain up to its previous block, e.g., for a
+        block which extends the maxblock."""
+        if block.is_pruned:
+            return True
+        if any(tx.hash in self.transactions for tx in block.transactions):
+            return False
         try:
-            for output in tx.outputs:
-                self.outputs[output.hash] = output
-            for keyimage in [_.keyimages for _ in tx.inputs]:
-                self.keyimages[str(keyimage[0])] = tx
-        except TypeError:
-            # if we end up here, inputs are None
-            pass
+            return block.is_valid(blockchain=self)
+        except KeyError:
+            # a referenced output does not exist on this chain
+            return False
+
+    def _undo_reorganize(self, oldtip, oldchain, disconnected, connected):
+        for block in reversed(connected):
+            self.indexes.remove_block(block.hash, list(block.iter_transactions()))
+        del self.mainchain[len(self.mainchain) - len(connected):]
+        self.mainchain += oldchain
+        for block in disconnected:
+            self._index_block(block)
+        self.maxblock = Blockchain.Maxblock(blockheight=self.tree[oldtip].blockheight, hash=oldtip)
+
+    def _drop_invalid(self, hash):
+        """Removes the block and all blocks on top of it from the tree."""
+        children = {}
+        for child, node in self.tree.items():
+            children.setdefault(node.prevhash, []).append(child)
+        dropped = [hash]
+        while dropped:
+            hash = dropped.pop()
+            dropped += children.get(hash, [])
+            self.tree.pop(hash, None)
+            self.blocks.discard(hash)
+            self.sizes.pop(hash, None)
+            self.invalid.add(hash)
+            if hasattr(self.pm, 'mark_invalid'):
+                self.pm.mark_invalid(hash)
+
+    def _index_block(self, block):
+        # blocks loaded from the persistence are usually indexed
+        # already, so their transactions are not even decoded
+        if not self.indexes.has_block(block.hash):
+            txs = list(block.iter_transactions())
+            self.indexes.add_block(block.hash, txs)
+            self._filter_keyimages(txs)
+
+    @property
+    def is_pruning(self):
+        return self.retain_blocks is not None or self.retain_bytes is not None
+
+    def prune_height(self):
+        """Returns the height below which the blocks are pruned. The
+        maxblock is never pruned."""
+        tip = self.maxblock.blockheight
+        height = 0
+        if self.retain_blocks is not None:
+            height = tip - max(self.retain_blocks, 1) + 1
+        if self.retain_bytes is not None:
+            size = 0
+            keep = tip
+            for blockheight in range(tip, 0, -1):
+                hash = self.mainchain[blockheight]
+                size += self.sizes.get(hash, 0)
+                if self.blocks.is_pruned(hash) or (size > self.retain_bytes and blockheight < tip):
+                    break
+                keep = blockheight
+            height = keep if self.retain_blocks is None else min(height, keep)
+        return max(height, 0)
+
+    def prune(self):
+        """Replaces the blocks below the prune height by PrunedBlocks,
+        if the blockchain is pruning."""
+        if not self.is_pruning:
+            return
+        height = self.prune_height()
+        pruned = False
+        while self.fullblocks and self.fullblocks[0][0] < height:
+            (blockheight, hash) = heapq.heappop(self.fullblocks)
+            # the genesis block has no transactions
+            if hash not in self.blocks or self.blocks.is_pruned(hash) or hash == genesisblock.hash:
+                continue
+            self.blocks[hash] = PrunedBlock.from_block(self.blocks[hash])
+            self.sizes.pop(hash, None)
+            pruned = True
+        if pruned and hasattr(self.pm, 'prune'):
+            self.pm.prune(height)
+
+    def get_transactions(self, block):
+        """Returns the transactions of a block. The transactions of a
+        pruned block of the main chain are read from the transaction
+        index."""
+        if not block.is_pruned:
+            return block.transactions
+        txs = (self.transactions.get(txhash) for txhash in block.txhashes or [])
+        return [tx for tx in txs if tx is not None]
+
+    def get_work(self, hash):
+        """Returns the cumulative work of the chain ending in the block.
+        :raises KeyError: if the block is not in the tree"""
+        return self.tree[hash].work
+
+    def add_transaction(self, tx):
+        self.indexes.add_transactions([tx])
+        self._filter_keyimages([tx])
+
+    def add_outputs(self, outputs):
+        """Adds outputs whose transactions are not kept, e.g., from a
+        snapshot."""
+        self.indexes.add_outputs(outputs)
+
+    def add_keyimages(self, items):
+        """Adds keyimages whose transactions are not kept, e.g., from a
+        snapshot. items are pairs of a keyimage and the hash of its
+        transaction."""
+        items = list(items)
+        self.indexes.add_keyimages(items)
+        if self.keyimagefilter is not None:
+            for keyimage, txhash in items:
+                self.keyimagefilter.add(keyimage)
+
+    def _filter_keyimages(self, txs):
+        if self.keyimagefilter is not None:
+            for tx in txs:
+                for keyimage in tx.keyimages:
+                    self.keyimagefilter.add(keyimage)
 
     def get_output_by_hash(self, hash):
         return self.outputs[hash]
 
+    def get_outputs_by_hashes(self, hashes):
+        """Returns the outputs with the given hashes in one lookup.
+        Raises a KeyError if one of them does not exist."""
+        if hasattr(self.outputs, 'get_many'):
+            return self.outputs.get_many(list(hashes))
+        return [self.outputs[hash] for hash in hashes]
+
     def get_transaction_by_hash(self, hash):
         return self.transactions[hash]
 
     def get_transaction_by_keyimage(self, keyimage):
-        return self.keyimages[str(keyimage)]
+        if self.keyimagefilter is not None and keyimage not in self.keyimagefilter:
+            raise KeyError(keyimage)
+        return self.keyimages[keyimage]
+
+    def get_raw_block(self, hash):
+        """Returns the encoding of a block, e.g., to send it to a peer.
+        If the persistence stores the encodings, the block is not
+        encoded again.
+        :raises KeyError: if the block is unknown or pruned"""
+        if hasattr(self.pm, 'raw_block'):
+            try:
+                return self.pm.raw_block(hash)
+            except KeyError:
+                pass
+        block = self.get_block_by_hash(hash)
+        if block.is_pruned:
+            raise KeyError(hash)
+        return block.encode()
 
     def get_block_by_hash(self, hash):
         if hash == genesisblock.prevhash:
@@ -110,19 +560,58 @@ class Blockchain():
         return self.get_block_by_hash(block.prevhash)
 
     def __iter__(self):
-        def Chaingenerator(blockchain):
-            current = blockchain.current_block
-            while True:
-                if current == genesisblock:
-                    yield genesisblock
-                    break
-                yield current
-                current = blockchain.resolve_previous_block(current)
-        return Chaingenerator(self)
-
-    def get_random_output_by_flavor_and_amnt(self, *args):
-        # TODO
-        # raise NotImplementedError("get random output by flavor and amnt missing. TODO")
-        return []
+        """Iterates over the main chain from the maxblock back to the
+        genesis block."""
+        mainchain = list(self.mainchain)
+        return (self.blocks[hash] for hash in reversed(mainchain))
+
+    def get_hash_by_height(self, height):
+        """Returns the hash of the block of the main chain at height.
+        :raises KeyError: if the main chain is shorter"""
+        if not 0 <= height < len(self.mainchain):
+            raise KeyError(height)
+        return self.mainchain[height]
+
+    def get_block_by_height(self, height):
+        """Returns the block of the main chain at height.
+        :raises KeyError: if the main chain is shorter"""
+        return self.blocks[self.get_hash_by_height(height)]
+
+    def blocks_in_range(self, start, end=None):
+        """Returns the blocks of the main chain with start <= height < end,
+        ordered by their height. If end is None, all blocks from start
+        on are returned."""
+        return [self.blocks[hash] for hash in self.mainchain[max(start, 0):end]]
+
+    def iter_forward(self, start=0):
+        """Iterates over the main chain from the height start to the
+        maxblock. The main chain is fixed when the iteration starts."""
+        return iter(self.blocks_in_range(start))
+
+    def stream_blocks(self, start=0, end=None, *, batchsize=256):
+        """Streams the blocks of the main chain with start <= height < end
+        from the persistence. The encodings are read in batches of
+        batchsize blocks, each block is decoded when it is reached and
+        its transactions are decoded lazily. If the persistence does not
+        store the encodings, the blocks in memory are returned."""
+        hashes = self.mainchain[max(start, 0):end]
+        if not hasattr(self.pm, 'raw_blocks'):
+            yield from (self.blocks[hash] for hash in hashes)
+            return
+        for i in range(0, len(hashes), batchsize):
+            batch = hashes[i:i + batchsize]
+            for hash, raw in zip(batch, self.pm.raw_blocks(batch)):
+                yield self.blocks[hash] if raw is None else LazyBlock.decode(raw)
+
+    def get_random_output_by_flavor_and_amnt(self, flavor, amount, num, *, exclude=()):
+        """Returns num random outputs of the main chain with the
+        condition flavor and the amount, e.g., as the decoys of a ring.
+        :param exclude: hashes of outputs which must not be returned,
+            e.g., the output which is actually spent
+        :raises ValueError: if there are not enough such outputs
+        """
+        if num <= 0:
+            return []
+        return self.get_outputs_by_hashes(self.indexes.sample_outputs(flavor, amount, num, exclude))
 
 from .wallet import Wallet
\ No newline at end of file
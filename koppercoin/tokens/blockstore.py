@@ -0,0 +1,332 @@
+"""
+This file implements the storage of the blocks in append-only segment
+files. Each record in a segment is
+
+    magic (4 bytes) | length (4 bytes) | crc32 (4 bytes) | block
+
+where block is the encoding of the block, see koppercoin.tokens.codec.
+Blocks of which only the header is kept (PrunedBlock) are stored with
+another magic.
+When a segment exceeds the segment size, a new segment is started.
+
+An index in a small sqlite database maps the hash and the height of a
+block to its segment, offset and length. Blocks are read through
+memory maps of the segments, so the raw encoding of a block can be sent
+to a peer without copying, decoding or encoding it again.
+
+The index is written in the background, so after a crash the records
+at the end of the segments may be missing in the index and the last
+record may be incomplete. When the store is opened, the segments are
+scanned from the last indexed record on: complete records are indexed
+again and an incomplete tail is truncated.
+
+A pruned node deletes old segments: the blocks of a segment which
+are all below the prune height are appended again as PrunedBlocks,
+then the segment is deleted. Pruning therefore frees the disk in
+steps of the segment size.
+
+An existing blockchain.db with a blocks table can be migrated with the
+following command, which Persistencemanager also runs for an empty
+store. The json blocks of the first versions are moved aside instead,
+see migrate.
+
+    python -m koppercoin.tokens.blockstore blockchain.db blocks
+"""
+
+import os
+import mmap
+import zlib
+import struct
+import sqlite3
+import logging
+import threading
+from koppercoin.tokens.model import LazyBlock, PrunedBlock
+from koppercoin.tokens.persistence import Sqlitewriter, Readerpool, connect
+
+MAGIC = b'KCBK'
+HEADERMAGIC = b'KCHD'
+_classes = {MAGIC: LazyBlock, HEADERMAGIC: PrunedBlock}
+_recordheader = struct.Struct('>4sII')
+
+
+class Blockstore():
+    """Stores encoded blocks in append-only segment files in directory.
+
+    :param segmentsize: the size in bytes after which a new segment is
+        started
+    :param sync: if set, the segment is synced to disk after each block
+    """
+
+    def __init__(self, directory, *, segmentsize=2**27, sync=False):
+        self.directory = directory
+        self.segmentsize = segmentsize
+        self.sync = sync
+        os.makedirs(directory, exist_ok=True)
+        indexpath = os.path.join(directory, "index.db")
+        conn = connect(indexpath)
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS blocks "
+                         "(hash text PRIMARY KEY, height integer, segment integer, offset integer, length integer)")
+            conn.execute("CREATE INDEX IF NOT EXISTS blocks_height ON blocks (height)")
+        conn.close()
+        self.writer = Sqlitewriter(indexpath)
+        self.readers = Readerpool(indexpath)
+        self.lock = threading.Lock()
+        # index entries which are not yet committed
+        self.pending = {}
+        # the maximal height of the full blocks of each segment, so
+        # prune does not need to read the index to find nothing to do
+        with self.readers.connection() as conn:
+            self.heights = dict(conn.execute("SELECT segment, MAX(height) FROM blocks GROUP BY segment").fetchall())
+        self.maps = {}
+        self.file = None
+        self._recover()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, "blk%05d.dat" % segment)
+
+    def _segments(self):
+        return sorted(int(name[3:8]) for name in os.listdir(self.directory)
+                      if name.startswith("blk") and name.endswith(".dat"))
+
+    def _recover(self):
+        """Indexes the complete records after the last indexed record
+        and truncates an incomplete tail."""
+        with self.readers.connection() as conn:
+            last = conn.execute("SELECT segment, offset, length FROM blocks "
+                                "ORDER BY segment DESC, offset DESC LIMIT 1").fetchone()
+        (segment, offset) = (0, 0) if last is None else (last[0], last[1] + last[2])
+        segments = [s for s in self._segments() if s >= segment] or [segment]
+        for segment in segments:
+            path = self._path(segment)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(path, 'ab+') as f:
+                f.seek(offset)
+                while offset < size:
+                    data = f.read(_recordheader.size)
+                    if len(data) < _recordheader.size:
+                        break
+                    (magic, length, checksum) = _recordheader.unpack(data)
+                    raw = f.read(length)
+                    if magic not in _classes or len(raw) < length or zlib.crc32(raw) != checksum:
+                        break
+                    block = _classes[magic].decode(raw)
+                    self._index(block, segment, offset + _recordheader.size, length)
+                    offset += _recordheader.size + length
+                if offset < size:
+                    f.truncate(offset)
+            offset = 0
+        self.segment = segments[-1]
+        self.file = open(self._path(self.segment), 'ab')
+
+    def _index(self, block, segment, offset, length):
+        entry = (block.blockheight, segment, offset, length)
+        self.pending[block.hash] = entry
+        if not block.is_pruned:
+            self.heights[segment] = max(self.heights.get(segment, -1), block.blockheight)
+
+        def committed():
+            with self.lock:
+                if self.pending.get(block.hash) == entry:
+                    del self.pending[block.hash]
+        self.writer.submit("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?)",
+                           [(block.hash,) + entry], committed)
+
+    def append(self, block):
+        """Appends a block to the current segment, unless it is stored
+        already."""
+        with self.lock:
+            if self._lookup(block.hash) is not None:
+                return
+            self._append(block)
+
+    def _append(self, block):
+        raw = block.encode()
+        if self.file.tell() + _recordheader.size + len(raw) > self.segmentsize and self.file.tell() > 0:
+            self.file.close()
+            self.segment += 1
+            self.file = open(self._path(self.segment), 'ab')
+        offset = self.file.tell()
+        magic = HEADERMAGIC if block.is_pruned else MAGIC
+        self.file.write(_recordheader.pack(magic, len(raw), zlib.crc32(raw)))
+        self.file.write(raw)
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        self._index(block, self.segment, offset + _recordheader.size, len(raw))
+
+    def _lookup(self, hash):
+        entry = self.pending.get(hash)
+        if entry is not None:
+            return entry
+        with self.readers.connection() as conn:
+            return conn.execute("SELECT height, segment, offset, length FROM blocks WHERE hash = ?",
+                                (hash,)).fetchone()
+
+    def __contains__(self, hash):
+        return self._lookup(hash) is not None
+
+    def _map(self, segment, end):
+        """Returns a memory map of the segment which covers end."""
+        m = self.maps.get(segment)
+        if m is None or len(m) < end:
+            with open(self._path(segment), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = m
+        return m
+
+    def _record(self, segment, offset, length):
+        """Returns the magic and the data of a record."""
+        m = self._map(segment, offset + length)
+        return (m[offset - _recordheader.size:offset - _recordheader.size + 4],
+                memoryview(m)[offset:offset + length])
+
+    def get_raw(self, hash):
+        """Returns the encoding of the block as a memoryview into the
+        segment, without copying it. For a pruned block, this is the
+        encoding of its header.
+        :raises KeyError: if the block is unknown"""
+        entry = self._lookup(hash)
+        if entry is None:
+            raise KeyError(hash)
+        return self._record(*entry[1:])[1]
+
+    def is_pruned(self, hash):
+        """Checks if only the header of the block is stored.
+        :raises KeyError: if the block is unknown"""
+        entry = self._lookup(hash)
+        if entry is None:
+            raise KeyError(hash)
+        return self._record(*entry[1:])[0] == HEADERMAGIC
+
+    def get_raw_many(self, hashes):
+        """Returns the encodings of the blocks with the given hashes
+        with a single query, None for unknown and pruned blocks."""
+        entries = {hash: self.pending.get(hash) for hash in hashes}
+        missing = [hash for hash, entry in entries.items() if entry is None]
+        if missing:
+            with self.readers.connection() as conn:
+                rows = conn.execute("SELECT hash, height, segment, offset, length FROM blocks WHERE hash IN (%s)"
+                                    % ", ".join("?" * len(missing)), missing).fetchall()
+            entries.update((row[0], row[1:]) for row in rows)
+        raws = []
+        for hash in hashes:
+            if entries[hash] is None:
+                raws.append(None)
+                continue
+            (magic, raw) = self._record(*entries[hash][1:])
+            raws.append(raw if magic == MAGIC else None)
+        return raws
+
+    def get_block(self, hash):
+        """Returns the block, its transactions are decoded lazily."""
+        entry = self._lookup(hash)
+        if entry is None:
+            raise KeyError(hash)
+        (magic, raw) = self._record(*entry[1:])
+        return _classes[magic].decode(raw)
+
+    def iter_blocks(self):
+        """Streams all blocks ordered by their height."""
+        self.writer.flush()
+        with self.readers.connection() as conn:
+            for (segment, offset, length) in conn.execute(
+                    "SELECT segment, offset, length FROM blocks ORDER BY height"):
+                (magic, raw) = self._record(segment, offset, length)
+                yield _classes[magic].decode(raw)
+
+    def __len__(self):
+        self.writer.flush()
+        with self.readers.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
+
+    def flush(self):
+        """Waits until the index is written."""
+        self.writer.flush()
+
+    def size(self):
+        """Returns the number of bytes of all segments."""
+        return sum(os.path.getsize(self._path(segment)) for segment in self._segments())
+
+    def prune(self, height):
+        """Deletes the segments whose blocks are all below height,
+        except for the current segment. Their blocks are kept as
+        PrunedBlocks. Nothing is read or written unless a whole segment
+        is below height.
+        :returns: the number of deleted segments"""
+        with self.lock:
+            segments = sorted(segment for segment, maxheight in self.heights.items()
+                              if segment != self.segment and maxheight < height)
+        if not segments:
+            return 0
+        self.writer.flush()
+        deleted = 0
+        for segment in segments:
+            with self.readers.connection() as conn:
+                rows = conn.execute("SELECT segment, offset, length FROM blocks WHERE segment = ? ORDER BY offset",
+                                    (segment,)).fetchall()
+            with self.lock:
+                if all(self._record(*row)[0] == HEADERMAGIC for row in rows):
+                    # the segment is pruned already, e.g., it holds the
+                    # PrunedBlocks of deleted segments
+                    self.heights.pop(segment, None)
+                    continue
+                for row in rows:
+                    (magic, raw) = self._record(*row)
+                    block = _classes[magic].decode(raw)
+                    self._append(block if block.is_pruned else PrunedBlock.from_block(block))
+                    del raw
+            # the segment is deleted once no index entry refers to it
+            self.writer.flush()
+            self.maps.pop(segment, None)
+            self.heights.pop(segment, None)
+            os.remove(self._path(segment))
+            deleted += 1
+        return deleted
+
+    def close(self):
+        self.writer.close()
+        with self.lock:
+            self.file.close()
+        self.maps = {}
+
+
+def migrate(dbpath, store):
+    """Copies the blocks of the blocks table of an existing sqlite
+    database into the store.
+
+    The first versions stored the blocks as json. Their hashes are the
+    hashes of the json, so the prevhashes of the blocks, the
+    references of the inputs to the outputs and the proofs of work do
+    not match the encoded blocks, and these blocks cannot be
+    converted. Their table is renamed to blocks_json and the node syncs
+    the blockchain from the network again.
+    :returns: the number of copied blocks
+    """
+    conn = connect(dbpath)
+    try:
+        try:
+            legacy = conn.execute("SELECT COUNT(*) FROM blocks WHERE typeof(content) = 'text'").fetchone()[0]
+        except sqlite3.Error:
+            # there is no blocks table
+            return 0
+        if legacy:
+            with conn:
+                conn.execute("ALTER TABLE blocks RENAME TO blocks_json")
+            logging.getLogger(__name__).warning("The json blocks of " + dbpath + " cannot be migrated, they are "
+                                                "kept in the table blocks_json. The blockchain is synced again.")
+            return 0
+        count = 0
+        for (content,) in conn.execute("SELECT content FROM blocks ORDER BY height"):
+            store.append(LazyBlock.decode(content))
+            count += 1
+    finally:
+        conn.close()
+    store.flush()
+    return count
+
+if __name__ == '__main__':
+    import sys
+    store = Blockstore(sys.argv[2])
+    print("Migrated " + str(migrate(sys.argv[1], store)) + " blocks.")
+    store.close()
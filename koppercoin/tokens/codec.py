@@ -0,0 +1,178 @@
+"""
+This file implements the primitives of the binary serialization of
+the objects in koppercoin.tokens.model. The serialization is
+canonical, i.e., the same logical object always results in the same
+bytes, so it is used for hashing, for the network and for storing
+objects on disk.
+
+Each encoded object starts with a version byte. Integers are encoded
+as LEB128 varints, byte strings and lists are prefixed by their length.
+The JSON serialization of the model is still available for debugging.
+Decoding rejects all non-canonical encodings, so the encoding of a
+decoded object is exactly the data it was decoded from.
+"""
+
+VERSION = 1
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class Writer():
+    """Accumulates the encoding of an object."""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def getvalue(self):
+        return bytes(self.buf)
+
+    def u8(self, value):
+        self.buf.append(value)
+
+    def u64(self, value):
+        """A fixed size integer, used for the nonce of a block."""
+        self.buf += int(value).to_bytes(8, 'big')
+
+    def varint(self, value):
+        value = int(value)
+        if value < 0:
+            raise ValueError("Varints need to be >=0")
+        while value >= 0x80:
+            self.buf.append((value & 0x7f) | 0x80)
+            value >>= 7
+        self.buf.append(value)
+
+    def bool(self, value):
+        self.u8(1 if value else 0)
+
+    def bytes(self, value):
+        self.varint(len(value))
+        self.buf += value
+
+    def bigint(self, value):
+        """A nonnegative integer of arbitrary size, e.g., a scalar of
+        a signature."""
+        value = int(value)
+        self.bytes(value.to_bytes((value.bit_length() + 7) // 8, 'big'))
+
+    def hex(self, value):
+        """A hex-encoded string such as a key or a hash. We store the
+        number of hex digits, since some hex strings have an odd
+        length, e.g., the target of the genesis block."""
+        self.varint(len(value))
+        if len(value) % 2 == 1:
+            value = '0' + value
+        self.buf += bytes.fromhex(value)
+
+    def string(self, value):
+        self.bytes(value.encode('utf-8'))
+
+    def list(self, values, write):
+        self.varint(len(values))
+        for value in values:
+            write(value)
+
+    def optional(self, value, write):
+        if value is None:
+            self.u8(0)
+        else:
+            self.u8(1)
+            write(value)
+
+
+class Reader():
+    """Reads the encoding of an object written by a Writer."""
+
+    def __init__(self, data, offset=0):
+        self.data = memoryview(data)
+        self.offset = offset
+
+    def _take(self, length):
+        if self.offset + length > len(self.data):
+            raise DecodeError("Unexpected end of data")
+        chunk = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return chunk
+
+    def at_end(self):
+        return self.offset == len(self.data)
+
+    def u8(self):
+        return self._take(1)[0]
+
+    def u64(self):
+        return int.from_bytes(self._take(8), 'big')
+
+    def varint(self):
+        result = 0
+        shift = 0
+        while True:
+            byte = self.u8()
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                # reject padded encodings to keep the encoding canonical
+                if byte == 0 and shift > 0:
+                    raise DecodeError("Non-canonical varint")
+                return result
+            shift += 7
+
+    def bool(self):
+        value = self.u8()
+        if value not in (0, 1):
+            raise DecodeError("Invalid boolean")
+        return value == 1
+
+    def bytes(self):
+        return bytes(self._take(self.varint()))
+
+    def rawbytes(self):
+        """Like bytes, but returns a view into the data without copying."""
+        return self._take(self.varint())
+
+    def bigint(self):
+        value = self.rawbytes()
+        if len(value) > 0 and value[0] == 0:
+            raise DecodeError("Non-canonical integer")
+        return int.from_bytes(value, 'big')
+
+    def hex(self):
+        length = self.varint()
+        value = self._take((length + 1) // 2).hex()
+        if len(value) != length and value[0] != '0':
+            raise DecodeError("Non-canonical hex string")
+        return value[len(value) - length:]
+
+    def string(self):
+        return self.bytes().decode('utf-8')
+
+    def list(self, read):
+        return [read() for i in range(self.varint())]
+
+    def optional(self, read):
+        if self.bool():
+            return read()
+        return None
+
+
+def encode(obj):
+    """Returns the versioned encoding of an object which implements
+    _write(writer)."""
+    writer = Writer()
+    writer.u8(VERSION)
+    obj._write(writer)
+    return writer.getvalue()
+
+
+def decode(cls, data):
+    """Decodes an object of class cls, which implements
+    _read(reader), from its versioned encoding."""
+    reader = Reader(data)
+    version = reader.u8()
+    if version != VERSION:
+        raise DecodeError("Unknown version " + str(version))
+    obj = cls._read(reader)
+    if not reader.at_end():
+        raise DecodeError("Trailing data")
+    return obj
@@ -0,0 +1,415 @@
+"""
+This file implements the indexes of the blockchain, i.e., the
+transactions by their hash, the outputs by their hash and the
+transactions by their keyimages.
+
+The Memoryindexes keep everything in dicts and are rebuilt every
+time the blockchain is loaded. The Sqliteindexes keep the indexes in
+tables next to the blocks, so the memory they need does not grow with
+the length of the chain and they survive a restart. A small LRU cache
+in front of each table keeps the recently used objects, e.g., the
+outputs which are referenced by the transactions in the mempool.
+Writes are committed in the background, until then they are kept in
+memory, so they can be read immediately.
+
+Only the blocks of the main chain are indexed. When the main chain
+changes, the blocks which leave it are removed from the indexes with
+remove_block and the blocks which join it are added.
+
+The decoy index groups the hashes of the outputs by their condition
+and amount, so a wallet can pick the other members of a ring.
+
+A node which started from a snapshot, see koppercoin.tokens.snapshot,
+does not know the transactions which spent the keyimages before the
+snapshot. Those keyimages refer to a Transactionref.
+"""
+
+import random
+import threading
+from collections import OrderedDict, namedtuple
+from koppercoin.tokens.model import Transaction, TxOutput
+
+# marks a pending removal in Sqlitemap.pending
+_removed = object()
+# the maximal number of parameters of a query, the default limit of
+# older versions of sqlite
+_maxvariables = 999
+
+
+class Transactionref(namedtuple('Transactionref', 'hash')):
+    """Refers to a transaction which is not kept, e.g., the transaction
+    which spent a keyimage before a snapshot."""
+    __slots__ = ()
+
+    def is_same(self, other):
+        try:
+            return other.hash == self.hash
+        except (TypeError, ValueError, AttributeError):
+            return False
+
+
+def _sample(hashes, num, exclude):
+    hashes = [hash for hash in hashes if hash not in exclude]
+    return random.SystemRandom().sample(hashes, num)
+
+
+class Memoryindexes():
+    """The indexes of the blockchain in memory."""
+
+    def __init__(self):
+        self.transactions = {}
+        self.outputs = {}
+        self.keyimages = {}
+        self.blocks = set()
+        # the hashes of the outputs by their condition and amount
+        self.decoys = {}
+
+    def has_block(self, hash):
+        """Checks if the transactions of the block are indexed."""
+        return hash in self.blocks
+
+    def add_block(self, blockhash, txs):
+        """Indexes the transactions txs of the block with the hash
+        blockhash."""
+        self.add_transactions(txs)
+        self.blocks.add(blockhash)
+
+    def add_transactions(self, txs):
+        for tx in txs:
+            self.transactions[tx.hash] = tx
+            self.add_outputs(tx.outputs)
+            for keyimage in tx.keyimages:
+                self.keyimages[keyimage] = tx
+
+    def add_outputs(self, outputs):
+        for output in outputs:
+            self.outputs[output.hash] = output
+            self.decoys.setdefault((output.condition, output.amount), {})[output.hash] = None
+
+    def add_keyimages(self, items):
+        """Adds keyimages of transactions which are not kept, items are
+        pairs of a keyimage and the hash of its transaction."""
+        for keyimage, txhash in items:
+            self.keyimages[keyimage] = Transactionref(txhash)
+
+    def remove_block(self, blockhash, txs):
+        """Removes the transactions txs of the block with the hash
+        blockhash from the indexes."""
+        for tx in txs:
+            self.transactions.pop(tx.hash, None)
+            for output in tx.outputs:
+                self.outputs.pop(output.hash, None)
+                self.decoys.get((output.condition, output.amount), {}).pop(output.hash, None)
+            for keyimage in tx.keyimages:
+                if self.keyimages.get(keyimage) is not None and self.keyimages[keyimage].hash == tx.hash:
+                    del self.keyimages[keyimage]
+        self.blocks.discard(blockhash)
+
+    def iter_keyimages(self):
+        return iter(list(self.keyimages))
+
+    def sample_outputs(self, condition, amount, num, exclude=()):
+        """Returns the hashes of num random outputs with the condition
+        and the amount, except for the ones in exclude.
+        :raises ValueError: if there are not enough outputs"""
+        return _sample(self.decoys.get((condition, amount), {}), num, set(exclude))
+
+    def iter_outputs(self):
+        """Iterates over the outputs ordered by their hash."""
+        return (self.outputs[hash] for hash in sorted(self.outputs))
+
+    def iter_keyimage_items(self):
+        """Iterates over the pairs of a keyimage and the hash of its
+        transaction ordered by the keyimage."""
+        return ((keyimage, self.keyimages[keyimage].hash) for keyimage in sorted(self.keyimages))
+
+
+class Sqlitemap():
+    """A read-only mapping from a key column to a value column of a
+    table, with an LRU cache in front of it. Values which have been
+    written but are not yet committed are found in pending, removals
+    which are not yet committed are marked there as well."""
+
+    def __init__(self, readers, table, key, value, decode, cachesize):
+        self.readers = readers
+        self.query = "SELECT " + value + " FROM " + table + " WHERE " + key + " = ?"
+        self.countquery = "SELECT COUNT(*) FROM " + table
+        self.keysquery = "SELECT " + key + " FROM " + table + " WHERE " + key + " IN (%s)"
+        self.itemsquery = "SELECT " + key + ", " + value + " FROM " + table + " WHERE " + key + " IN (%s)"
+        self.decode = decode
+        self.cachesize = cachesize
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.pending:
+                if self.pending[key] is _removed:
+                    raise KeyError(key)
+                return self.pending[key]
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        with self.readers.connection() as conn:
+            row = conn.execute(self.query, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        value = self.decode(row[0])
+        with self.lock:
+            self.cache[key] = value
+            if len(self.cache) > self.cachesize:
+                self.cache.popitem(last=False)
+        return value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_many(self, keys):
+        """Returns the values of the keys in their order. The keys which
+        are neither pending nor cached are read with one query per
+        _maxvariables keys.
+        :raises KeyError: if one of the keys does not exist"""
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.pending:
+                    if self.pending[key] is _removed:
+                        raise KeyError(key)
+                    found[key] = self.pending[key]
+                elif key in self.cache:
+                    self.cache.move_to_end(key)
+                    found[key] = self.cache[key]
+        missing = list(set(keys).difference(found))
+        read = {}
+        if missing:
+            with self.readers.connection() as conn:
+                for i in range(0, len(missing), _maxvariables):
+                    chunk = missing[i:i + _maxvariables]
+                    read.update(conn.execute(self.itemsquery % ", ".join("?" * len(chunk)), chunk))
+        for key in missing:
+            if key not in read:
+                raise KeyError(key)
+            found[key] = self.decode(read[key])
+        with self.lock:
+            for key in missing:
+                self.cache[key] = found[key]
+            while len(self.cache) > self.cachesize:
+                self.cache.popitem(last=False)
+        return [found[key] for key in keys]
+
+    def _stored(self, conn, keys):
+        """Returns the keys which are in the table."""
+        stored = set()
+        for i in range(0, len(keys), _maxvariables):
+            chunk = keys[i:i + _maxvariables]
+            stored.update(key for (key,) in conn.execute(self.keysquery % ", ".join("?" * len(chunk)), chunk))
+        return stored
+
+    def __len__(self):
+        with self.lock:
+            pending = dict(self.pending)
+        with self.readers.connection() as conn:
+            # the count and the keys are read from the same snapshot,
+            # so a pending write committed meanwhile is counted once
+            conn.execute("BEGIN")
+            try:
+                count = conn.execute(self.countquery).fetchone()[0]
+                stored = self._stored(conn, list(pending))
+            finally:
+                conn.rollback()
+        for key, value in pending.items():
+            if value is _removed and key in stored:
+                count -= 1
+            elif value is not _removed and key not in stored:
+                count += 1
+        return count
+
+    def _add_pending(self, items):
+        with self.lock:
+            for key, value in items:
+                self.pending[key] = value
+                self.cache.pop(key, None)
+
+    def _remove_pending(self, items):
+        # called by the writer after the items have been committed
+        with self.lock:
+            for key, value in items:
+                if self.pending.get(key) is value:
+                    del self.pending[key]
+                    if value is not _removed:
+                        self.cache[key] = value
+            while len(self.cache) > self.cachesize:
+                self.cache.popitem(last=False)
+
+
+class Sqliteindexes():
+    """The indexes of the blockchain in sqlite tables. The indexes are
+    written by a koppercoin.tokens.persistence.Sqlitewriter, the
+    indexes of a block are committed in a single transaction. Until
+    then they are served from memory, which they also are if the
+    commit fails.
+    """
+
+    def __init__(self, writer, readers, *, cachesize=2**12):
+        self.writer = writer
+        self.readers = readers
+        self.transactions = Sqlitemap(readers, "idx_transactions", "hash", "content",
+                                      Transaction.decode, cachesize)
+        self.outputs = Sqlitemap(readers, "idx_outputs", "hash", "content",
+                                 TxOutput.decode, cachesize)
+        self.keyimages = Sqlitemap(readers, "idx_keyimages", "keyimage", "txhash",
+                                   self._spending_transaction, cachesize)
+        self.blocks = Sqlitemap(readers, "idx_blocks", "hash", "hash", lambda hash: True, cachesize)
+
+    @staticmethod
+    def create_tables(conn):
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS idx_transactions (hash text PRIMARY KEY, content blob)")
+            conn.execute("CREATE TABLE IF NOT EXISTS idx_outputs (hash text PRIMARY KEY, content blob)")
+            conn.execute("CREATE TABLE IF NOT EXISTS idx_keyimages (keyimage text PRIMARY KEY, txhash text)")
+            conn.execute("CREATE TABLE IF NOT EXISTS idx_blocks (hash text PRIMARY KEY)")
+            conn.execute("CREATE TABLE IF NOT EXISTS idx_decoys "
+                         "(hash text PRIMARY KEY, condition integer, amount integer)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_decoys_amount ON idx_decoys (condition, amount)")
+            # databases of older versions have no decoy index yet
+            if conn.execute("SELECT 1 FROM idx_decoys LIMIT 1").fetchone() is None:
+                outputs = (TxOutput.decode(content) for (content,) in
+                           conn.execute("SELECT content FROM idx_outputs").fetchall())
+                conn.executemany("INSERT INTO idx_decoys VALUES (?, ?, ?)",
+                                 ((output.hash, int(output.condition), output.amount) for output in outputs))
+
+    def _spending_transaction(self, txhash):
+        tx = self.transactions.get(txhash)
+        return Transactionref(txhash) if tx is None else tx
+
+    def has_block(self, hash):
+        """Checks if the transactions of the block are indexed."""
+        return hash in self.blocks
+
+    def add_block(self, blockhash, txs):
+        """Indexes the transactions txs of the block with the hash
+        blockhash."""
+        self._write(txs, blockhash)
+
+    def add_transactions(self, txs):
+        self._write(txs, None)
+
+    def _write(self, txs, blockhash):
+        txitems, outputitems, keyimageitems = [], [], []
+        for tx in txs:
+            txitems.append((tx.hash, tx))
+            outputitems += [(output.hash, output) for output in tx.outputs]
+            keyimageitems += [(keyimage, tx) for keyimage in tx.keyimages]
+        blockitems = [(blockhash, True)] if blockhash is not None else []
+        updates = [(self.transactions, txitems), (self.outputs, outputitems),
+                   (self.keyimages, keyimageitems), (self.blocks, blockitems)]
+        for index, items in updates:
+            index._add_pending(items)
+
+        def committed():
+            for index, items in updates:
+                index._remove_pending(items)
+        self.writer.submit_many([
+            ("INSERT OR REPLACE INTO idx_transactions VALUES (?, ?)",
+             [(hash, tx.encode()) for hash, tx in txitems]),
+            ("INSERT OR REPLACE INTO idx_outputs VALUES (?, ?)",
+             [(hash, output.encode()) for hash, output in outputitems]),
+            ("INSERT OR REPLACE INTO idx_decoys VALUES (?, ?, ?)",
+             [(hash, int(output.condition), output.amount) for hash, output in outputitems]),
+            ("INSERT OR REPLACE INTO idx_keyimages VALUES (?, ?)",
+             [(keyimage, tx.hash) for keyimage, tx in keyimageitems]),
+            ("INSERT OR REPLACE INTO idx_blocks VALUES (?)",
+             [(hash,) for hash, _ in blockitems])], committed)
+
+    def remove_block(self, blockhash, txs):
+        """Removes the transactions txs of the block with the hash
+        blockhash from the indexes."""
+        txitems, outputitems, keyimageitems = [], [], []
+        for tx in txs:
+            txitems.append((tx.hash, _removed))
+            outputitems += [(output.hash, _removed) for output in tx.outputs]
+            keyimageitems += [(keyimage, _removed) for keyimage in tx.keyimages]
+        blockitems = [(blockhash, _removed)]
+        updates = [(self.transactions, txitems), (self.outputs, outputitems),
+                   (self.keyimages, keyimageitems), (self.blocks, blockitems)]
+        for index, items in updates:
+            index._add_pending(items)
+
+        def committed():
+            for index, items in updates:
+                index._remove_pending(items)
+        self.writer.submit_many([
+            ("DELETE FROM idx_transactions WHERE hash = ?", [(hash,) for hash, _ in txitems]),
+            ("DELETE FROM idx_outputs WHERE hash = ?", [(hash,) for hash, _ in outputitems]),
+            ("DELETE FROM idx_decoys WHERE hash = ?", [(hash,) for hash, _ in outputitems]),
+            ("DELETE FROM idx_keyimages WHERE keyimage = ?", [(keyimage,) for keyimage, _ in keyimageitems]),
+            ("DELETE FROM idx_blocks WHERE hash = ?", [(blockhash,)])], committed)
+
+    def iter_keyimages(self):
+        with self.keyimages.lock:
+            removed = set(key for key, value in self.keyimages.pending.items() if value is _removed)
+        with self.readers.connection() as conn:
+            for (keyimage,) in conn.execute("SELECT keyimage FROM idx_keyimages"):
+                if keyimage not in removed:
+                    yield keyimage
+        with self.keyimages.lock:
+            pending = [key for key, value in self.keyimages.pending.items() if value is not _removed]
+        for keyimage in pending:
+            yield keyimage
+
+    def add_outputs(self, outputs):
+        """Adds outputs without their transactions, e.g., from a
+        snapshot."""
+        items = [(output.hash, output) for output in outputs]
+        self.outputs._add_pending(items)
+        self.writer.submit_many([
+            ("INSERT OR REPLACE INTO idx_outputs VALUES (?, ?)",
+             [(hash, output.encode()) for hash, output in items]),
+            ("INSERT OR REPLACE INTO idx_decoys VALUES (?, ?, ?)",
+             [(hash, int(output.condition), output.amount) for hash, output in items])],
+            lambda: self.outputs._remove_pending(items))
+
+    def add_keyimages(self, items):
+        """Adds keyimages of transactions which are not kept, items are
+        pairs of a keyimage and the hash of its transaction."""
+        items = [(keyimage, Transactionref(txhash)) for keyimage, txhash in items]
+        self.keyimages._add_pending(items)
+        self.writer.submit("INSERT OR REPLACE INTO idx_keyimages VALUES (?, ?)",
+                           [(keyimage, ref.hash) for keyimage, ref in items],
+                           lambda: self.keyimages._remove_pending(items))
+
+    def sample_outputs(self, condition, amount, num, exclude=()):
+        """Returns the hashes of num random outputs with the condition
+        and the amount, except for the ones in exclude. Outputs which
+        are not yet committed are not sampled.
+        :raises ValueError: if there are not enough outputs"""
+        with self.readers.connection() as conn:
+            hashes = [hash for (hash,) in conn.execute(
+                "SELECT hash FROM idx_decoys WHERE condition = ? AND amount = ?", (int(condition), amount))]
+        # outputs whose removal is not yet committed are left out
+        with self.outputs.lock:
+            removed = set(key for key, value in self.outputs.pending.items() if value is _removed)
+        return _sample(hashes, num, removed | set(exclude))
+
+    def iter_outputs(self):
+        """Iterates over the committed outputs ordered by their hash."""
+        with self.readers.connection() as conn:
+            for (content,) in conn.execute("SELECT content FROM idx_outputs ORDER BY hash"):
+                yield TxOutput.decode(content)
+
+    def iter_keyimage_items(self):
+        """Iterates over the committed pairs of a keyimage and the hash
+        of its transaction ordered by the keyimage."""
+        with self.readers.connection() as conn:
+            yield from conn.execute("SELECT keyimage, txhash FROM idx_keyimages ORDER BY keyimage")
@@ -0,0 +1,129 @@
+"""
+This file implements the bookkeeping of the mining coordinator, see
+koppercoin.network.coordinator, without the network: the jobs for the
+templates of a Workview, the nonce ranges handed out to each worker and
+the shares which the workers submit.
+
+The nonces of a job are extranonce * 2**rangebits + counter. The
+extranonces are taken from the same counter as the local workers of
+the Miningmanager, so no two workers search the same nonces. A worker
+holds at most _maxranges extranonces per template, so a worker cannot
+drain the counter by asking for work it does not do. Only the jobs and
+shares of the last _keep templates are remembered.
+"""
+
+import time
+import base64
+import hashlib
+from collections import OrderedDict, defaultdict
+from koppercoin.tokens import mining
+from koppercoin.tokens.model import Block
+
+# the number of templates for which submissions are accepted
+_keep = 4
+# the number of nonce ranges a worker may hold for a template
+_maxranges = 16
+
+
+class Workerstate():
+    """The jobs and the submitted shares of a worker.
+
+    :param name: the name under which the shares are counted
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        # the extranonces of the jobs of the worker by generation
+        self.extranonces = defaultdict(set)
+        # the submitted nonces by generation
+        self.submitted = defaultdict(set)
+
+    def forget(self, generations):
+        """Drops the jobs and shares of the templates which are not in
+        generations."""
+        for old in [old for old in self.extranonces if old not in generations]:
+            del self.extranonces[old]
+        for old in [old for old in self.submitted if old not in generations]:
+            del self.submitted[old]
+
+
+class Jobdispatcher():
+    """Hands out jobs for the templates of a Workview and checks the
+    shares of the workers.
+
+    :param view: the workview to which the node publishes its templates
+    :paramtype view: koppercoin.tokens.workview.Workview
+    :param extranonces: the shared counter of the extranonces
+    :paramtype extranonces: multiprocessing.Value
+    :param submit_block: is called with each block found by a worker
+    """
+
+    def __init__(self, view, extranonces, submit_block):
+        self.view = view
+        self.extranonces = extranonces
+        self.submit_block = submit_block
+        # the last templates and their pow prefixes by generation
+        self.templates = OrderedDict()
+        self.generation = 0
+        # the accepted shares by the names of the workers
+        self.shares = defaultdict(int)
+
+    def update(self):
+        """Reads the template of the view if it is new.
+        :returns: True if there is a new template
+        """
+        if self.view.generation in (0, self.generation):
+            return False
+        (generation, template) = self.view.read()
+        # all workers use the same timestamp, their nonces differ
+        template.timestamp = int(time.time())
+        self.templates[generation] = (template, template.header.pow_prefix())
+        while len(self.templates) > _keep:
+            self.templates.popitem(last=False)
+        self.generation = generation
+        return True
+
+    def job(self, worker):
+        """Returns a job for the current template with a new extranonce.
+        :paramtype worker: Workerstate
+        :returns: the job, None if there is no template yet or the
+            worker holds _maxranges jobs for the template
+        """
+        worker.forget(self.templates)
+        if self.generation not in self.templates or len(worker.extranonces[self.generation]) >= _maxranges:
+            return None
+        (template, prefix) = self.templates[self.generation]
+        extranonce = mining._allocate(self.extranonces)
+        worker.extranonces[self.generation].add(extranonce)
+        return {'msgtype': 'job', 'generation': self.generation,
+                'prefix': base64.b64encode(prefix).decode("utf-8"),
+                'target': template.target,
+                'sharetarget': mining.share_target(template.target).hex(),
+                'extranonce': extranonce,
+                'rangebits': mining._rangebits}
+
+    def check(self, worker, generation, nonce):
+        """Checks a share which the worker submitted and passes it to
+        the node if it is a block.
+        :paramtype worker: Workerstate
+        :returns: a tuple (accepted, reason)
+        """
+        worker.forget(self.templates)
+        if generation not in self.templates:
+            return (False, 'stale')
+        if nonce >> mining._rangebits not in worker.extranonces[generation]:
+            return (False, 'range')
+        if nonce in worker.submitted[generation]:
+            return (False, 'duplicate')
+        (template, prefix) = self.templates[generation]
+        digest = hashlib.sha512(prefix + nonce.to_bytes(8, 'big')).digest()
+        if digest >= mining.share_target(template.target):
+            return (False, 'target')
+        worker.submitted[generation].add(nonce)
+        self.shares[worker.name] += 1
+        if digest >= mining.pow_target(template.target):
+            return (True, 'share')
+        block = Block.decode(template.encode())
+        block.nonce = nonce
+        self.submit_block(block)
+        return (True, 'block')
@@ -0,0 +1,75 @@
+"""
+This file implements the lookup of keyimages for detecting
+doublespends. A keyimage is spent if a transaction in the blockchain
+or in the mempool uses it. The Keyimageregistry answers both with one
+O(1) lookup each.
+
+Most lookups are for keyimages which are not spent, e.g., when a new
+transaction is validated. If the keyimages of the blockchain are not
+kept in memory, a Bloomfilter in front of them answers most of these
+lookups without touching the disk.
+"""
+
+import hashlib
+
+
+class Bloomfilter():
+    """A Bloom filter over strings. It has no false negatives and a
+    false positive rate of about (1 - e^(-k*n/m))^k after n insertions,
+    where m is the number of bits and k the number of hashes.
+
+    >>> bf = Bloomfilter(2**10, 3)
+    >>> bf.add('ab')
+    >>> 'ab' in bf
+    True
+    """
+
+    def __init__(self, numbits=2**23, numhashes=5):
+        self.numbits = numbits
+        self.numhashes = numhashes
+        self.bits = bytearray((numbits + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=8 * self.numhashes).digest()
+        for i in range(self.numhashes):
+            yield int.from_bytes(digest[8*i:8*(i+1)], 'big') % self.numbits
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+
+    def __contains__(self, item):
+        return all(self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(item))
+
+
+class Keyimageregistry():
+    """Answers if keyimages are spent in the blockchain or in the
+    mempool."""
+
+    def __init__(self, blockchain, mempool):
+        self.blockchain = blockchain
+        self.mempool = mempool
+
+    @staticmethod
+    def _lookup(source, keyimage):
+        try:
+            return source.get_transaction_by_keyimage(keyimage)
+        except KeyError:
+            return None
+
+    def is_spent(self, keyimage):
+        """Checks if a transaction in the blockchain or in the mempool
+        uses the keyimage."""
+        return (self._lookup(self.mempool, keyimage) is not None
+                or self._lookup(self.blockchain, keyimage) is not None)
+
+    def conflicts(self, tx):
+        """Returns the transactions of the blockchain and the mempool
+        which use a keyimage of tx, except for tx itself."""
+        conflicts = []
+        for keyimage in tx.keyimages:
+            for source in (self.blockchain, self.mempool):
+                other = self._lookup(source, keyimage)
+                if other is not None and not other.is_same(tx) and other not in conflicts:
+                    conflicts.append(other)
+        return conflicts
@@ -4,102 +4,383 @@ set of transactions which are not yet confirmed, i.e., included in the
 blockchain.
 Since the network and the mining threads access the same mempool this
 class needs to be threadsafe.
+
+The transactions are ordered by their fee rate, i.e., their fee per
+byte, in two indexed heaps: one returns the transactions with the
+highest fee rates for mining, the other the ones with the lowest fee
+rates, which are evicted when the pool exceeds its maximal size.
+Transactions which stay in the pool longer than the expiry time are
+dropped.
 """
 
+import time
+import heapq
+import itertools
+import threading
 import multiprocessing
+from collections import OrderedDict
 from koppercoin.tokens.model import *
+from koppercoin.tokens import parameters
+from koppercoin.tokens.sigcache import signaturecache
+from koppercoin.tokens.persistence import Sqlitewriter, Readerpool, connect
 
 
 class Persistencemanager():
-    def __init__(self):
-        import sqlite3
-        self.conn = sqlite3.connect("mempool.db", check_same_thread=False)
-        self.__create_tables()
-        self.clear()
-
-    def __create_tables(self):
-        cursor = self.conn.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS transactions (hash text, content text)")
-        self.conn.commit()
+    """Stores the transactions of the mempool in a sqlite database,
+    see koppercoin.tokens.persistence."""
+    def __init__(self, path="mempool.db", *, durability='normal', flushsize=512, flushinterval=1.0):
+        self.path = path
+        self.__create_tables(durability)
+        self.writer = Sqlitewriter(path, durability=durability, flushsize=flushsize, flushinterval=flushinterval)
+        self.readers = Readerpool(path, size=1)
 
-    def clear(self):
-        self.newset = set()
-        self.removeset = set()
+    def __create_tables(self, durability):
+        conn = connect(self.path, durability)
+        cursor = conn.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS transactions (hash text, content blob)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS transactions_hash ON transactions (hash)")
+        conn.commit()
+        conn.close()
 
     def save(self, tx):
-        self.newset.add(tx)
-        self.removeset.discard(tx)
+        self.writer.submit("INSERT INTO transactions VALUES (?, ?)", [(tx.hash, tx.encode())])
 
     def remove(self, tx):
-        self.removeset.add(tx)
-        self.newset.discard(tx)
+        self.writer.submit("DELETE FROM transactions WHERE hash = ?", [(tx.hash,)])
 
     def load(self, mempool):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM transactions")
-        txs = cursor.fetchall()
-        for hash, jsontx in txs:
-            mempool.pool.add(Transaction.from_json(jsontx))
+        """Adds the stored transactions to the mempool. The first
+        versions stored the transactions as json, whose hashes are not
+        the ones of the encoded transactions any more, so they are
+        dropped. Their senders broadcast them again."""
+        with self.readers.connection() as conn:
+            txs = conn.execute("SELECT * FROM transactions WHERE typeof(content) = 'blob'").fetchall()
+            legacy = conn.execute("SELECT COUNT(*) FROM transactions WHERE typeof(content) != 'blob'").fetchone()[0]
+        if legacy:
+            self.writer.submit("DELETE FROM transactions WHERE typeof(content) != 'blob'", [()])
+        mempool.add_many([Transaction.decode(content) for hash, content in txs])
 
     def commit(self):
-        cursor = self.conn.cursor()
-        for tx in self.newset:
-            prepared = (tx.hash, tx.json())
-            cursor.execute("INSERT INTO transactions VALUES (?, ?)", prepared)
-        for tx in self.removeset:
-            cursor.execute("DELETE FROM transactions WHERE hash = ?", (tx.hash,))
-        self.conn.commit()
-        self.clear()
+        """Waits until all changes are written."""
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+class Feeheap():
+    """An indexed binary min-heap of items with unique keys. The
+    position of each item in the heap is tracked, so items can be
+    removed in O(log n).
+
+    >>> heap = Feeheap()
+    >>> for (key, item) in [(3, 'a'), (1, 'b'), (2, 'c')]:
+    ...     heap.push(key, item)
+    >>> heap.remove('c')
+    >>> heap.smallest(2)
+    ['b', 'a']
+    """
+    def __init__(self):
+        self.heap = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def push(self, key, item):
+        self.heap.append((key, item))
+        self.positions[item] = len(self.heap) - 1
+        self._up(len(self.heap) - 1)
+
+    def peek(self):
+        """Returns the item with the smallest key.
+        :raises IndexError: if the heap is empty"""
+        return self.heap[0][1]
+
+    def remove(self, item):
+        """Removes the item.
+        :raises KeyError: if the item is not in the heap"""
+        pos = self.positions.pop(item)
+        last = self.heap.pop()
+        if pos < len(self.heap):
+            self.heap[pos] = last
+            self.positions[last[1]] = pos
+            self._down(pos)
+            self._up(pos)
+
+    def smallest(self, num):
+        """Returns the num items with the smallest keys in order. Only
+        the heap entries above them are visited, so this takes
+        O(num log num) steps."""
+        return list(itertools.islice(self.iter_smallest(), num))
+
+    def iter_smallest(self):
+        """Yields the items ordered by their keys. The heap must not be
+        changed while iterating."""
+        frontier = [(self.heap[0], 0)] if self.heap else []
+        while frontier:
+            (entry, pos) = heapq.heappop(frontier)
+            yield entry[1]
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < len(self.heap):
+                    heapq.heappush(frontier, (self.heap[child], child))
+
+    def _swap(self, i, j):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.positions[self.heap[i][1]] = i
+        self.positions[self.heap[j][1]] = j
+
+    def _up(self, pos):
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if self.heap[pos][0] >= self.heap[parent][0]:
+                return
+            self._swap(pos, parent)
+            pos = parent
+
+    def _down(self, pos):
+        while True:
+            smallest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < len(self.heap) and self.heap[child][0] < self.heap[smallest][0]:
+                    smallest = child
+            if smallest == pos:
+                return
+            self._swap(pos, smallest)
+            pos = smallest
+
+
+_persistencemanager = None
+
+
+def _default_persistencemanager():
+    """Returns the Persistencemanager of mempool.db in the working
+    directory, which is shared by the mempools without their own. It
+    is only opened when it is used, not when the module is imported."""
+    global _persistencemanager
+    if _persistencemanager is None:
+        _persistencemanager = Persistencemanager()
+    return _persistencemanager
 
 
 class Mempool:
     """This class implements a mempool. This is a pool containing some
-    transactions. More transactions can be added or removed."""
-    def __init__(self, *, persistencemanager=Persistencemanager(), allowload=True):
+    transactions. More transactions can be added or removed.
+
+    :param maxsize: the maximal number of bytes of the encoded
+        transactions in the pool
+    :param expiry: the number of seconds after which a transaction is
+        dropped from the pool
+    """
+    def __init__(self, *, persistencemanager=None, allowload=True, sigcache=signaturecache,
+                 maxsize=parameters.max_mempool_size, expiry=parameters.mempool_expiry):
         self.pool = set([])
-        self.pm = persistencemanager
+        # the transactions of the pool by their keyimages
+        self.keyimages = {}
+        # the transactions by their hashes
+        self.transactions = {}
+        # the hashes ordered by decreasing and increasing fee rate, ties
+        # are broken by the arrival, so older transactions are mined
+        # first and newer ones are evicted first
+        self.highest = Feeheap()
+        self.lowest = Feeheap()
+        # the hashes ordered by the size of the encoded transactions
+        self.smallest = Feeheap()
+        # the arrival times of the transactions in the order they arrived
+        self.arrivals = OrderedDict()
+        self.counter = 0
+        self.size = 0
+        self.maxsize = maxsize
+        self.expiry = expiry
+        self.lock = threading.RLock()
+        self.pm = persistencemanager if persistencemanager is not None else _default_persistencemanager()
+        self.sigcache = sigcache
         if allowload:
             self.pm.load(self)
 
+    def __len__(self):
+        return len(self.transactions)
+
     def add(self, tx):
-        """add a transaction to the pool."""
+        """add a transaction to the pool, unless it uses a keyimage of
+        another transaction of the pool. The conflicts are checked
+        under the lock, so of two conflicting transactions which are
+        added concurrently only the first one is added.
+        :returns: False if the transaction conflicts with the pool or
+            was evicted right away, since the pool is full of
+            transactions with higher fee rates
+        """
+        with self.lock:
+            if tx.hash in self.transactions:
+                return True
+            if self.conflicts(tx):
+                return False
+            self.pm.save(tx)
+            return self._add(tx)
+
+    def _add(self, tx, now=None):
+        if tx.hash in self.transactions:
+            return True
+        now = time.time() if now is None else now
+        self.counter += 1
+        feerate = tx.feerate
         self.pool.add(tx)
-        self.pm.save(tx)
+        self.transactions[tx.hash] = tx
+        self.highest.push((-feerate, self.counter), tx.hash)
+        self.lowest.push((feerate, -self.counter), tx.hash)
+        self.smallest.push((len(tx.encode()), self.counter), tx.hash)
+        self.arrivals[tx.hash] = now
+        self.size += len(tx.encode())
+        for keyimage in tx.keyimages:
+            self.keyimages[keyimage] = tx
+        self.expire(now)
+        while self.size > self.maxsize:
+            self.remove(self.transactions[self.lowest.peek()])
+        return tx.hash in self.transactions
+
+    def _remove(self, tx):
+        if tx.hash not in self.transactions:
+            return
+        tx = self.transactions.pop(tx.hash)
+        self.pool.remove(tx)
+        self.highest.remove(tx.hash)
+        self.lowest.remove(tx.hash)
+        self.smallest.remove(tx.hash)
+        del self.arrivals[tx.hash]
+        self.size -= len(tx.encode())
+        for keyimage in tx.keyimages:
+            if self.keyimages.get(keyimage) is tx:
+                del self.keyimages[keyimage]
+
+    def expire(self, now=None):
+        """remove the transactions which arrived more than the expiry
+        time before now.
+        :returns: the number of removed transactions"""
+        now = time.time() if now is None else now
+        removed = 0
+        with self.lock:
+            while self.arrivals:
+                (hash, arrival) = next(iter(self.arrivals.items()))
+                if arrival + self.expiry > now:
+                    break
+                self.remove(self.transactions[hash])
+                removed += 1
+        return removed
+
+    def get_transaction_by_keyimage(self, keyimage):
+        return self.keyimages[keyimage]
+
+    def conflicts(self, tx):
+        """returns the transactions of the pool which use a keyimage of
+        tx, except for tx itself."""
+        conflicts = []
+        for keyimage in tx.keyimages:
+            other = self.keyimages.get(keyimage)
+            if other is not None and not other.is_same(tx) and other not in conflicts:
+                conflicts.append(other)
+        return conflicts
+
+    def admit(self, tx, *, blockchain):
+        """Validates a transaction and adds it to the pool if it is
+        valid. The verified signatures are remembered in the sigcache,
+        so they are not verified again when the transaction is
+        included in a block. The node checks the transactions it
+        receives with the validation pipeline instead, which fills the
+        same sigcache, and adds them with add.
+        :returns: True if the transaction was added
+        """
+        if not tx.is_valid(blockchain=blockchain, sigcache=self.sigcache):
+            return False
+        return self.add(tx)
 
     def add_many(self, txs):
         """add a transaction to the pool."""
-        for tx in txs:
-            self.pool.add(tx)
+        with self.lock:
+            for tx in txs:
+                self._add(tx)
 
     def remove(self, tx):
         """remove a transaction from the pool."""
-        self.pool.remove(tx)
-        self.pm.remove(tx)
+        with self.lock:
+            self._remove(tx)
+            self.pm.remove(tx)
 
     def remove_many(self, txs):
         """remove a transaction from the pool."""
-        for tx in txs:
-            self.pool.remove(tx)
+        with self.lock:
+            for tx in txs:
+                self._remove(tx)
+
+    def remove_spent(self, txs):
+        """remove the transactions of the pool which use a keyimage of
+        one of txs, e.g., the transactions of a new block. This removes
+        the transactions included in the block and the ones which
+        conflict with it."""
+        with self.lock:
+            for keyimage in [keyimage for tx in txs for keyimage in tx.keyimages]:
+                tx = self.keyimages.get(keyimage)
+                if tx is not None:
+                    self.remove(tx)
+
+    def update_chain(self, update, *, blockchain):
+        """Follows a change of the main chain, see
+        Blockchain.Chainupdate. The transactions of the blocks which
+        left the main chain are pending again, unless they conflict
+        with the pool, and the ones spent by the blocks which joined it
+        are removed. After a reorganization, the outputs of the old
+        chain are gone, so the transactions of the pool are checked
+        against the new chain: the outputs they reference need to exist
+        and their keyimages need to be unspent. The signatures do not
+        depend on the chain, they are not verified again. A chain which
+        is only extended adds outputs, and the keyimages it spends are
+        removed from the pool here, so the pool stays valid.
+        :paramtype update: koppercoin.tokens.Blockchain.Chainupdate
+        """
+        with self.lock:
+            for oldblock in update.disconnected:
+                for tx in oldblock.transactions:
+                    if not tx.is_coinbase:
+                        self.add(tx)
+            for newblock in update.connected:
+                self.remove_spent(newblock.transactions)
+            if update.disconnected:
+                for tx in list(self.transactions.values()):
+                    if not self._is_valid_on_chain(tx, blockchain):
+                        self.remove(tx)
+
+    @staticmethod
+    def _is_valid_on_chain(tx, blockchain):
+        try:
+            return tx.is_valid(blockchain=blockchain, verify_signatures=False)
+        except KeyError:
+            # a referenced output does not exist on the chain
+            return False
 
     def get_txs_with_max_fee(self, num):
-        """returns the num transactions of the pool with the highest fees"""
-        highest = [x for x in self.pool if x.fee >= max(tx.fee for tx in self.pool)]
-        return highest[0:num]
-
-#    def get_txs_with_max_fee_nonblck(self, num):
-#        """
-#        This is the nonblocking version of get_txs_with_max_fee. It
-#        either returns get_txs_with_max_fee or None if no lock can be
-#        acquired.
-#        """
-#        l = self.lock.acquire(False)
-#        if l:
-#            highest = [x for x in self.mempool if x.get_fee_amount() >= max(tx.get_fee_amount() for tx in self.mempool)]
-#            self.lock.release()
-#            return highest[0:num]
-#        else:
-#            return None
+        """returns the num transactions of the pool with the highest
+        fee rates, ordered by decreasing fee rate"""
+        with self.lock:
+            return [self.transactions[hash] for hash in self.highest.smallest(num)]
+
+    def min_txsize(self):
+        """returns the number of bytes of the smallest encoded
+        transaction of the pool, or None if the pool is empty"""
+        with self.lock:
+            if not self.smallest:
+                return None
+            return len(self.transactions[self.smallest.peek()].encode())
+
+    def iter_by_feerate(self):
+        """Yields the transactions of the pool ordered by decreasing fee
+        rate. The caller must hold the lock while iterating."""
+        for hash in self.highest.iter_smallest():
+            yield self.transactions[hash]
 
     def get_tx_with_max_fee(self):
-        """returns the tx of the pool which has the highest fee"""
-        return self.get_tx_with_max_fee(1)
+        """returns the tx of the pool which has the highest fee rate,
+        or None if the pool is empty"""
+        txs = self.get_txs_with_max_fee(1)
+        return txs[0] if txs else None
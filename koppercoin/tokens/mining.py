@@ -1,129 +1,221 @@
 
-from multiprocessing import Event, Process, Queue, Pool
+from multiprocessing import Event, Process, Queue, Value
 from threading import Thread
-import datetime
+import time
 import queue
 import logging
 import koppercoin.logsetup
-
-
-class NoBlockFoundError(Exception):
-    pass
-
-def _setup(event):
-    global finished
-    finished = event
-
-def _find_next_block(block, transactions, id, idrange):
-    from koppercoin.tokens import Block
-    possible_block = Block.from_prevblock(prevblock=block, transactions=transactions)
-    while True:
-        time = int(datetime.datetime.now().strftime("%s"))
-        possible_block.timestamp = time - (time % idrange) + id
-        # todo make start random
-        for nonce in range(2**64-1):
-            possible_block.nonce = nonce
-            if int(possible_block.hash,16) < int(possible_block.target,16):
-                return possible_block
-            if finished.is_set():
-                raise NoBlockFoundError()
+from koppercoin.tokens.template import Templatebuilder
+from koppercoin.tokens.workview import Workview
+
+# number of nonces which are tried before checking for abortion or
+# new work, about a few milliseconds of hashing
+_batchsize = 2**12
+# seconds between the checks of an idle worker for new work
+_pollinterval = 0.005
+# seconds between the reports of the workers
+_reportinterval = 1.0
+# the nonce of a block is extranonce * 2**_rangebits + counter, each
+# extranonce is searched by a single worker
+_rangebits = 32
+# a share is a digest below this target, i.e., about one in 2**16
+# hashes. It proves that a worker is searching.
+_sharetarget = 2**496
+
+def pow_target(target):
+    """
+    Returns the hex-encoded target as bytes of the size of a digest.
+    A digest is a valid proof of work iff it is smaller than these
+    bytes, which is the same as comparing the integer values.
+    """
+    return int(target, 16).to_bytes(64, 'big')
+
+def search_nonces(prefix_hash, target, start, stop):
+    """
+    The hashing kernel. It tries all nonces in range(start, stop).
+    :param prefix_hash: a hashlib object which has already hashed the
+        constant part of the header, see BlockHeader.pow_prefix
+    :param target: the target as returned by pow_target
+    :returns: the first nonce whose digest is below the target or
+        None
+    """
+    for nonce in range(start, stop):
+        h = prefix_hash.copy()
+        h.update(nonce.to_bytes(8, 'big'))
+        if h.digest() < target:
+            return nonce
+    return None
+
+def share_target(target):
+    """
+    Returns the target of the shares for the hex-encoded target of a
+    block as bytes, see pow_target. Each block is also a share.
+    """
+    return max(int(target, 16), _sharetarget).to_bytes(64, 'big')
+
+def _allocate(extranonces):
+    """Returns the next extranonce of the shared counter."""
+    with extranonces.get_lock():
+        extranonce = extranonces.value
+        extranonces.value = (extranonce + 1) % 2**(64 - _rangebits)
+    return extranonce
+
+def _worker(id, view, extranonces, results, stop):
+    """
+    A long-lived mining worker. It searches the template of the
+    workview in the nonce ranges of the extranonces it takes from the
+    shared counter, and switches to a new template after the current
+    batch of nonces. The worker puts the following messages into the
+    results queue:
+        ('work', id, generation) when it starts on a template
+        ('block', id, block) when it finds a block
+        ('stats', id, hashes, shares, seconds) every _reportinterval
+            and when it stops
+    After a block is found, the worker waits for the next template.
+    """
+    import hashlib
+    hashes = shares = 0
+    reported = time.time()
+    generation = 0
+    while not stop.is_set():
+        if view.generation in (0, generation):
+            stop.wait(_pollinterval)
+            continue
+        (generation, template) = view.read()
+        results.put(('work', id, generation))
+        template.timestamp = int(time.time())
+        target = pow_target(template.target)
+        sharetarget = share_target(template.target)
+        prefix_hash = hashlib.sha512(template.header.pow_prefix())
+        position = end = 0
+        while not stop.is_set() and view.generation == generation:
+            if position == end:
+                position = _allocate(extranonces) << _rangebits
+                end = position + 2**_rangebits
+            batchend = min(position + _batchsize, end)
+            nonce = search_nonces(prefix_hash, sharetarget, position, batchend)
+            if nonce is None:
+                hashes += batchend - position
+                position = batchend
+            else:
+                hashes += nonce - position + 1
+                shares += 1
+                position = nonce + 1
+                h = prefix_hash.copy()
+                h.update(nonce.to_bytes(8, 'big'))
+                if h.digest() < target:
+                    template.nonce = nonce
+                    results.put(('block', id, template))
+                    break
+            if time.time() - reported >= _reportinterval:
+                results.put(('stats', id, hashes, shares, time.time() - reported))
+                hashes = shares = 0
+                reported = time.time()
+    # the work since the last report
+    results.put(('stats', id, hashes, shares, max(time.time() - reported, 1e-6)))
 
 class Miningmanager():
+    """Mines blocks with long-lived worker processes. The node keeps
+    the template of the next block up to date and publishes it to the
+    workers through a Workview, see koppercoin.tokens.workview. The
+    node needs to call add_transaction for each new transaction of the
+    mempool and update_tip when the blockchain has a new current block.
+    The workers report their hashrates and shares, see hashrate and
+    shares.
+    """
 
     def __init__(self, mempool, blockchain, wallet, callback=lambda x:None, num_threads=4):
         self.logger = logging.getLogger(__name__)
         self.mining_stoprequest = Event()
         self.num_threads = num_threads
-        self.process = None
+        self.workers = []
         self.mempool = mempool
         self.blockchain = blockchain
         self.wallet = wallet
         self.blockfound = callback
-        self.txqueue = Queue()
+        self.templates = Templatebuilder(mempool, wallet)
+        self.view = Workview()
+        self.extranonces = Value('Q', 0)
+        # the hashrates of the workers in H/s
+        self.hashrates = {}
+        self.shares = 0
+
+    @property
+    def hashrate(self):
+        """The sum of the last reported hashrates of the workers."""
+        return sum(self.hashrates.values())
 
     def start_mining(self):
         self.mining_stoprequest.clear()
         self.queue = Queue()
-        self.txqueue = Queue()
-        self.process = Process(target=self._mine,
-                                args=(self.queue, self.txqueue, self.mempool, self.mining_stoprequest, self.blockchain, self.wallet, self.num_threads))
+        self.update_tip()
+        self.logger.info("Setup mining using "+str(self.num_threads)+" processes.")
+        self.workers = [Process(target=_worker, args=(i, self.view, self.extranonces, self.queue, self.mining_stoprequest),
+                                daemon=True)
+                        for i in range(self.num_threads)]
         self.consumer = Thread(target=self._consume)
-        self.process.start()
+        for worker in self.workers:
+            worker.start()
         self.consumer.start()
 
     def add_transaction(self, tx):
-        self.txqueue.put(tx)
+        """Adds a transaction of the mempool to the template."""
+        if self.templates.add_transaction(tx):
+            self.view.publish(self.templates.block())
+
+    def update_tip(self):
+        """Builds a new template on top of the current block of the
+        blockchain."""
+        self.view.publish(self.templates.build(self.blockchain.current_block))
 
     def stop_mining(self):
         self.mining_stoprequest.set()
         self.logger.debug("Attempting to close miningmanager.")
-        while self.process.is_alive():
-            self.process.join(1)
-            self.consumer.join(1)
+        self.consumer.join()
+        for worker in self.workers:
+            worker.join()
         self.logger.debug("Miningmanager closed succesfully.")
 
     def _consume(self):
-        # process internal thread to consume created blocks: put it in blockchain and call blockfound
-        while not self.mining_stoprequest.is_set() or not self.queue.empty():
+        # process internal thread to consume the messages of the
+        # workers: put found blocks in blockchain and call blockfound
+        while any(worker.is_alive() for worker in self.workers) or not self.queue.empty():
             try:
-                block = self.queue.get(timeout=5)
-                if block.blockheight > self.blockchain.current_block.blockheight:
-                    self.blockchain.add_block(block)
-                    self.blockfound(block)
-                    self.logger.debug("Block added to chain: "+str(block))
+                message = self.queue.get(timeout=_reportinterval)
             except queue.Empty:
-                pass
-
-    def _mine(self, result_queue, tx_queue, mempool, stoprequest, blockchain, wallet, num_threads):
-        """
-        Mines blocks with a coinbase transaction and some transactions
-        :param result_queue: A queue to which the fnal blocks are written
-        :paramtype result_queue: multiprocessing.Queue
-        :param mempool: A mempool whose transactions will be included
-            in the block.
-        :paramtype mempool: koppercoin.token.mempool.Mempool
-        :param stoprequest: When set, the mining function will terminate
-        :paramtype stoprequest: multiprocessing.Event
+                continue
+            if message[0] == 'stats':
+                (kind, id, hashes, shares, seconds) = message
+                self.hashrates[id] = hashes / seconds
+                self.shares += shares
+                self.logger.debug("Hashrate: %d H/s" % self.hashrate)
+            elif message[0] == 'block':
+                self.submit_block(message[2])
+
+    def submit_block(self, block):
+        """Adds a block found by a worker, e.g., a local one or a remote
+        one of the koppercoin.network.coordinator, to the blockchain
+        and builds the next template.
+        :returns: True if the block is the new current block
         """
-        def consume_tx(tx_queue, mempool):
-            while not self.mining_stoprequest.is_set() or not self.txqueue.empty():
-                try:
-                    tx = tx_queue.get(timeout=5)
-                    mempool.add(tx)
-                    self.logger.debug("TX added to mining mempool. "+str(tx))
-                except queue.Empty:
-                    pass
-
-        def finished_callback(block):
-            # callback for newly found block
-            result_queue.put(block)
-            blockchain.add_block(block)
-            mempool.remove_many(transactions[:-1])
-            self.logger.info("Block found: "+str(block))
-            self.finished.set()
-
-        self.logger.info("Setup mining using "+str(num_threads)+" processes.")
-        consumer = Thread(target=consume_tx, args=(tx_queue, mempool))
-        consumer.start()
-        while not stoprequest.is_set():
-            current_block = blockchain.current_block
-            coinbase = wallet.gen_coinbase_tx(current_block.blockheight)
-            self.logger.debug("Using as base: "+str(current_block.blockheight)+" -> "+str(current_block.hash))
-            transactions = mempool.get_txs_with_max_fee(5)+[coinbase]
-
-            self.finished = Event()
-            self.finished.clear()
-
-            with Pool(processes=num_threads, initializer=_setup, initargs=(self.finished,)) as pool:
-                self.logger.debug("Pool setup.")
-                for i in range(num_threads):
-                    pool.apply_async(_find_next_block, (current_block, transactions, i, num_threads),
-                                     callback=finished_callback)
-                pool.close()
-                self.logger.debug("Wait for mining.")
-                self.finished.wait()
-                self.logger.debug("Mininground finished.")
-                pool.terminate()
-            self.logger.debug("Pool terminated.")
-        consumer.join(1)
-        self.logger.info("Miningmanager stopped mining.")
\ No newline at end of file
+        self.logger.info("Block found: "+str(block))
+        # the consumer thread, the coordinator and the network add
+        # blocks concurrently
+        with self.blockchain.lock:
+            # the blockchain does not validate a block which extends
+            # the maxblock, and the template may be outdated, e.g., by
+            # a reorganization
+            if block.prevhash == self.blockchain.maxblock.hash and not self.blockchain.is_valid_on_chain(block):
+                self.logger.error("Dropped invalid block: "+str(block.hash))
+                self.update_tip()
+                return False
+            update = self.blockchain.add_block(block)
+            self.mempool.update_chain(update, blockchain=self.blockchain)
+            # the block is only announced if its chain has the most
+            # work, e.g., not if it was mined on a stale tip
+            tip = self.blockchain.maxblock.hash == block.hash
+            self.update_tip()
+        if tip:
+            self.blockfound(block)
+            self.logger.debug("Block added to chain: "+str(block))
+        return tip
@@ -9,26 +9,107 @@ import json
 from enum import IntEnum
 
 from koppercoin.crypto import lww_signature
+from koppercoin.tokens import codec
+from koppercoin.tokens.sigcache import signaturecache
 from koppercoin.tokens.parameters import *
 
 def hash(obj):
     return hashlib.sha512(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
 
 
+def merkle_root(hashes):
+    """Computes the root of a Merkle tree over a list of hex-encoded
+    hashes. If a level has an odd number of nodes, the last node is
+    paired with itself. Hence a list which repeats its last hashes can
+    have the same root as the list without them (CVE-2012-2459), so a
+    block whose transactions repeat a hash is malformed, see
+    Block.has_unique_transactions.
+
+    >>> merkle_root([]) == hashlib.sha512(b'').hexdigest()
+    True
+    >>> merkle_root(['ab']) == 'ab'
+    True
+    """
+    if not hashes:
+        return hashlib.sha512(b'').hexdigest()
+    level = [bytes.fromhex(h) for h in hashes]
+    while len(level) > 1:
+        if len(level) % 2 == 1:
+            level.append(level[-1])
+        level = [hashlib.sha512(level[i] + level[i+1]).digest() for i in range(0, len(level), 2)]
+    return level[0].hex()
+
+
 class KCBase():
+    """
+    Base class of the model objects. The canonical serialization is
+    the binary encoding of koppercoin.tokens.codec, the hash of an
+    object is the SHA-512 of it. The JSON serialization is kept for
+    debugging. The canonical serialization and the hash of an object
+    are cached, since they are needed very often,
+    e.g., as keys in the indexes of the blockchain. Setting a field
+    invalidates the cache. Fields must therefore be reassigned and not
+    mutated in place.
+
+    The objects use __slots__ to save memory, since the blockchain
+    keeps lots of them. Each subclass lists its fields in _fields,
+    which also drive the serialization.
+    """
     __abstract__ = True
+    __slots__ = ('_cache',)
+    _fields = ()
 
     def __str__(self):
         return self.json()
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if not name.startswith('_'):
+            self._invalidate(name)
+
+    def _invalidate(self, name=None):
+        """Drops the cache. name is the field which has been changed,
+        None means that everything needs to be recomputed."""
+        object.__setattr__(self, '_cache', None)
+
+    def _cached(self, key, compute):
+        cache = getattr(self, '_cache', None)
+        if cache is None:
+            cache = {}
+            object.__setattr__(self, '_cache', cache)
+        try:
+            return cache[key]
+        except KeyError:
+            cache[key] = value = compute()
+            return value
+
+    def compact(self):
+        """
+        Drops the cached serialization but keeps the hash. This is
+        used for objects which are kept for a long time, e.g., in the
+        blockchain, where only the hash is needed frequently.
+        """
+        cache = getattr(self, '_cache', None) or {}
+        cache = {k: cache[k] for k in self._compact_keys if k in cache}
+        object.__setattr__(self, '_cache', cache or None)
+        children = list(cache.values())
+        for k in self._fields:
+            if isinstance(getattr(self, k), list):
+                children += getattr(self, k)
+        for child in children:
+            if isinstance(child, KCBase):
+                child.compact()
+
+    _compact_keys = ('hash',)
+
     def serialize(self):
         """
         Method to return a serializable version of the object that
         can be dumped to json or other serialization.
         """
         t = {}
-        # only consider not-None values
-        for k,v in self.__dict__.items():
+        for k in self._fields:
+            v = getattr(self, k)
             # call serialize if it exists
             t[k] = getattr(v,'serialize',lambda : v)()
             # descend one indirection
@@ -46,23 +127,111 @@ class KCBase():
     def from_dict(cls, dict):
         return cls(**dict)
 
+    def is_same(self, other):
+        """Checks if other is the same object as this one, i.e., if
+        they have the same serialization. Objects which cannot be
+        serialized, e.g., since they are malformed, are never the same."""
+        if other is self:
+            return True
+        try:
+            return other.hash == self.hash
+        except (TypeError, ValueError, AttributeError):
+            return False
+
+    @classmethod
+    def decode(cls, data):
+        """Creates an object from its binary serialization.
+        :raises codec.DecodeError: if the data is malformed"""
+        obj = codec.decode(cls, data)
+        # the encoding is canonical, so we do not need to encode again
+        obj._cached('encoded', lambda: bytes(data))
+        return obj
+
+    def encode(self):
+        """
+        The canonical binary serialization of the object.
+        :returns: bytes
+        """
+        return self._cached('encoded', lambda: codec.encode(self))
+
     @property
     def hash(self):
         """Returns a unique hash of the object, based on its serialization."""
-        return hash(self.json())
+        return self._cached('hash', lambda: hashlib.sha512(self.encode()).hexdigest())
 
     def json(self):
         """
         A unique serialization of the Transaction.
         :returns: a json-serialization
         """
-        return json.dumps(self.serialize(), sort_keys=True)
+        return self._cached('json', lambda: json.dumps(self.serialize(), sort_keys=True))
+
+
+
+class BlockHeader(KCBase):
+    """This class implements the header of a block. The transactions
+    of the block are committed to by the root of a Merkle tree over
+    their hashes, so the header is small and its hash, which is the
+    hash of the block, can be computed without touching the
+    transactions.
+    """
+    _fields = ('blockheight', 'prevhash', 'target', 'timestamp', 'nonce', 'merkleroot')
+    __slots__ = _fields
+
+    def __init__(self, *, blockheight, prevhash, target, timestamp, nonce, merkleroot):
+        self.blockheight = blockheight
+        self.prevhash = prevhash
+        self.target = target
+        self.timestamp = timestamp
+        self.nonce = nonce
+        self.merkleroot = merkleroot
+
+    def __repr__(self):
+        return "%s(blockheight=%s, prevhash='%s', target='%s', timestamp='%s', nonce='%s', merkleroot='%s')" % \
+               (self.__class__.__name__, self.blockheight, self.prevhash, self.target, self.timestamp, self.nonce, self.merkleroot)
+
+    def _write(self, writer):
+        # the nonce is the final field, see pow_prefix
+        writer.varint(self.blockheight)
+        writer.hex(self.prevhash)
+        writer.hex(self.target)
+        writer.varint(self.timestamp)
+        writer.hex(self.merkleroot)
+        writer.u64(self.nonce)
+
+    @classmethod
+    def _read(cls, reader):
+        return cls(blockheight=reader.varint(), prevhash=reader.hex(), target=reader.hex(),
+                   timestamp=reader.varint(), merkleroot=reader.hex(), nonce=reader.u64())
+
+    def pow_prefix(self):
+        """
+        Returns the serialization of the header without the nonce.
+        The nonce is the final field of the serialization, encoded as
+        8 bytes, so a miner can hash this constant prefix once and
+        only add the nonce for each attempt.
+        """
+        return self._cached('pow_prefix', lambda: self.encode()[:-8])
+
+    def has_valid_pow(self):
+        """Checks if the hash of the header is below the target."""
+        return int(self.hash, 16) < int(self.target, 16)
 
+    @property
+    def work(self):
+        """The expected number of hashes needed to find a header with
+        the target. The chain with the most cumulative work is the main
+        chain."""
+        return 2**512 // (int(self.target, 16) + 1)
 
 
 class Block(KCBase):
-    """This class implements blocks.
+    """This class implements blocks. A block consists of a header and
+    the transactions, see BlockHeader. The hash of a block is the hash
+    of its header.
     """
+    _fields = ('blockheight', 'prevhash', 'nonce', 'target', 'transactions', 'timestamp')
+    __slots__ = _fields
 
     def __init__(self, *, blockheight, prevhash, target, transactions, nonce = 0, timestamp = None):
         if timestamp is None:
@@ -74,6 +243,55 @@ class Block(KCBase):
         self.transactions = transactions
         self.timestamp = timestamp
 
+    def _invalidate(self, name=None):
+        # the merkle root only depends on the transactions, so we keep it
+        # when the miner changes the nonce or the timestamp
+        merkleroot = None
+        if name not in (None, 'transactions'):
+            merkleroot = (getattr(self, '_cache', None) or {}).get('merkleroot')
+        super()._invalidate(name)
+        if merkleroot is not None:
+            object.__setattr__(self, '_cache', {'merkleroot': merkleroot})
+
+    _compact_keys = ('merkleroot', 'header')
+    # see PrunedBlock
+    is_pruned = False
+
+    @property
+    def merkleroot(self):
+        """The root of the Merkle tree over the transaction hashes."""
+        return self._cached('merkleroot', lambda: merkle_root(self.txhashes))
+
+    @property
+    def txhashes(self):
+        """The hashes of the transactions."""
+        return [tx.hash for tx in self.transactions]
+
+    def has_unique_transactions(self):
+        """Checks that no transaction hash occurs twice in the block.
+        Otherwise the block may have the hash of a valid block, see
+        merkle_root. Pruned blocks are not checked."""
+        txhashes = self.txhashes
+        return txhashes is None or len(txhashes) == len(set(txhashes))
+
+    @property
+    def header(self):
+        return self._cached('header', lambda: BlockHeader(blockheight=self.blockheight, prevhash=self.prevhash,
+                                                          target=self.target, timestamp=self.timestamp,
+                                                          nonce=self.nonce, merkleroot=self.merkleroot))
+
+    @property
+    def hash(self):
+        """Returns the hash of the block, i.e., the hash of its header."""
+        return self.header.hash
+
+    @property
+    def work(self):
+        return self.header.work
+
+    def iter_transactions(self):
+        return iter(self.transactions)
+
     def next_target(self):
         # TODO
         return '54778eff6ff5c0f03f521ece097d26d59d10c3eb2146bbc817df89f63c6bbe25d0826c36ddded059e859aa97732557a4717b504d691c6457290bcaa5a5db'
@@ -87,26 +305,69 @@ class Block(KCBase):
         return "%s(blockheight=%s, prevhash='%s', target='%s', nonce='%s', transactions=%s, timestamp='%s')" % \
                (self.__class__.__name__, self.blockheight, self.prevhash, self.target, self.nonce, self.transactions, self.timestamp)
 
-    def is_valid(self, *, validate_transactions = True, blockchain):
+    def is_valid(self, *, validate_transactions = True, blockchain, sigcache = signaturecache, executor = None):
         """Checks if a block is valid. If validate_transactions is
         set, the included transactions will also be checked.
+        Transactions which have been checked on their admission to
+        the mempool are found in the sigcache, so their signatures are
+        not verified again. If an executor
+        (koppercoin.tokens.validation.Validationexecutor) is given, the
+        signatures are verified in parallel.
         """
         # TODO: correct genesis block? need bockchain as an argument
         # TODO: does the block suffice the Pow-property?
         # TODO: is the timestamp neither "too high" nor "too low"
         # TODO: valid target, will need previous block or blockchain # to validate against
-        valid_reward = mining_reward_per_blockheight(self.blockheight)
-        coinbase_txs = [tx for tx in self.transactions if tx.is_coinbase]
-        if len(coinbase_txs) > 1 or not all([tx.amount == valid_reward for tx in coinbase_txs]):
+        if not self.has_unique_transactions() or not self.has_valid_coinbase():
             return False
-        # check if the amount of the coinbase (without fees) is set correctly
         if validate_transactions:
-            keyimages = [_.keyimage for _ in [_.inputs for _ in self.transactions]]
-            # the all part validates that all transactions are valid in context of the blockchain
-            # the first part validates them relative to each other
-            return (len(keyimages)==len(set(keyimages))) and all([_.is_valid(blockchain=blockchain) for _ in self.transactions])
+            # first validate the transactions relative to each other,
+            # i.e., no keyimage is used twice in the block
+            keyimages = [keyimage for tx in self.transactions for keyimage in tx.keyimages]
+            if len(keyimages) != len(set(keyimages)):
+                return False
+            # then validate them in context of the blockchain
+            if executor is None:
+                return all(tx.is_valid(blockchain=blockchain, sigcache=sigcache) for tx in self.transactions)
+            # the cheap checks are done here, the signatures are
+            # checked in parallel by the executor
+            if not all(tx.is_valid(blockchain=blockchain, verify_signatures=False) for tx in self.transactions):
+                return False
+            return executor.check_signatures(self.transactions, blockchain=blockchain, sigcache=sigcache)
         return True
 
+    def has_valid_coinbase(self):
+        """Checks that the block has at most one coinbase transaction and
+        that it pays at most the mining reward plus the fees of the
+        other transactions. The fees are computed from the declared
+        amounts of the inputs, which are checked against the
+        referenced outputs together with the signatures, see
+        Transaction.check_signatures."""
+        coinbase_txs = [tx for tx in self.transactions if tx.is_coinbase]
+        if len(coinbase_txs) > 1:
+            return False
+        try:
+            fees = sum(tx.fee for tx in self.transactions if not tx.is_coinbase)
+            valid_amount = mining_reward_per_blockheight(self.blockheight) + fees
+            return all(sum(txout.amount for txout in tx.outputs) <= valid_amount for tx in coinbase_txs)
+        except (TypeError, AttributeError):
+            return False
+
+    def _write(self, writer):
+        # the transactions are length-prefixed, so they can be skipped
+        # without decoding them
+        self.header._write(writer)
+        writer.list(self.transactions, lambda tx: writer.bytes(tx.encode()))
+
+    @classmethod
+    def _read(cls, reader):
+        header = BlockHeader._read(reader)
+        transactions = reader.list(lambda: Transaction.decode(reader.rawbytes()))
+        block = cls(blockheight=header.blockheight, prevhash=header.prevhash, target=header.target,
+                    transactions=transactions, nonce=header.nonce, timestamp=header.timestamp)
+        if block.merkleroot != header.merkleroot:
+            raise codec.DecodeError("Merkle root does not match the transactions")
+        return block
 
     @classmethod
     def from_dict(cls, dict):
@@ -118,6 +379,136 @@ class Block(KCBase):
                    timestamp=dict['timestamp'])
 
 
+class LazyBlock(Block):
+    """A block which is decoded lazily. The header is decoded
+    eagerly, the transactions are kept in their encoded form and
+    decoded on the first access of transactions. The hash of the block
+    and its merkle root are computed from the encoded transactions, so
+    checking if a block is new, relaying it and storing it does not
+    require to decode the transactions.
+
+    >>> block = Block(blockheight=1, prevhash='00', target='ff', transactions=[])
+    >>> lazy = LazyBlock.decode(block.encode())
+    >>> lazy.hash == block.hash
+    True
+    >>> list(lazy.iter_transactions())
+    []
+    """
+    __slots__ = ('_rawtransactions', '_decoded')
+
+    @property
+    def transactions(self):
+        if self._decoded is None:
+            object.__setattr__(self, '_decoded', [Transaction.decode(raw) for raw in self._rawtransactions])
+            object.__setattr__(self, '_rawtransactions', None)
+        return self._decoded
+
+    @transactions.setter
+    def transactions(self, transactions):
+        object.__setattr__(self, '_decoded', transactions)
+        object.__setattr__(self, '_rawtransactions', None)
+
+    @property
+    def is_decoded(self):
+        return self._decoded is not None
+
+    def iter_transactions(self):
+        """Streams the transactions, decoding one at a time without
+        building the whole list."""
+        if self.is_decoded:
+            return iter(self._decoded)
+        return (Transaction.decode(raw) for raw in self._rawtransactions)
+
+    @property
+    def txhashes(self):
+        if self.is_decoded:
+            return super().txhashes
+        return [hashlib.sha512(raw).hexdigest() for raw in self._rawtransactions]
+
+    def compact(self):
+        if self.is_decoded:
+            return super().compact()
+        cache = self._cache or {}
+        object.__setattr__(self, '_cache', {k: cache[k] for k in self._compact_keys if k in cache} or None)
+
+    def _write(self, writer):
+        if self.is_decoded:
+            return super()._write(writer)
+        self.header._write(writer)
+        writer.list(self._rawtransactions, writer.bytes)
+
+    @classmethod
+    def _read(cls, reader):
+        header = BlockHeader._read(reader)
+        block = cls.__new__(cls)
+        object.__setattr__(block, '_rawtransactions', reader.list(reader.bytes))
+        object.__setattr__(block, '_decoded', None)
+        for k in ('blockheight', 'prevhash', 'target', 'timestamp', 'nonce'):
+            setattr(block, k, getattr(header, k))
+        if block.merkleroot != header.merkleroot:
+            raise codec.DecodeError("Merkle root does not match the transactions")
+        return block
+
+
+class PrunedBlock(Block):
+    """A block of which only the header is kept, e.g., an old block of
+    a pruned node or a block below a snapshot. The transactions are not
+    available, their outputs and keyimages are only found in the
+    indexes of the blockchain. A block pruned by the node itself keeps
+    the hashes of its transactions, so they can be looked up in the
+    transaction index. The hash of a pruned block is the hash of the
+    full block, its encoding is the encoding of the header and the
+    hashes of the transactions.
+
+    >>> tx = Transaction(outputs=[], pubkey='00', is_coinbase=True)
+    >>> block = Block(blockheight=1, prevhash='00', target='ff', transactions=[tx])
+    >>> pruned = PrunedBlock.from_block(block)
+    >>> pruned.hash == block.hash
+    True
+    >>> PrunedBlock.decode(pruned.encode()).txhashes == [tx.hash]
+    True
+    >>> PrunedBlock.from_header(block.header).txhashes is None
+    True
+    """
+    __slots__ = ('_merkleroot', '_txhashes')
+    is_pruned = True
+
+    @classmethod
+    def from_header(cls, header, txhashes=None):
+        block = cls.__new__(cls)
+        object.__setattr__(block, '_merkleroot', header.merkleroot)
+        object.__setattr__(block, '_txhashes', txhashes)
+        object.__setattr__(block, 'transactions', [])
+        for k in ('blockheight', 'prevhash', 'target', 'timestamp', 'nonce'):
+            setattr(block, k, getattr(header, k))
+        return block
+
+    @classmethod
+    def from_block(cls, block):
+        return cls.from_header(block.header, block.txhashes)
+
+    @property
+    def merkleroot(self):
+        return self._merkleroot
+
+    @property
+    def txhashes(self):
+        """The hashes of the transactions or None if they are unknown."""
+        return self._txhashes
+
+    def _write(self, writer):
+        self.header._write(writer)
+        writer.optional(self._txhashes, lambda txhashes: writer.list(txhashes, writer.hex))
+
+    @classmethod
+    def _read(cls, reader):
+        header = BlockHeader._read(reader)
+        txhashes = reader.optional(lambda: reader.list(reader.hex))
+        if txhashes is not None and merkle_root(txhashes) != header.merkleroot:
+            raise codec.DecodeError("Merkle root does not match the transactions")
+        return cls.from_header(header, txhashes)
+
+
 class Transaction(KCBase):
     """This class implements transactions of tokens between different
     participants.
@@ -128,6 +519,8 @@ class Transaction(KCBase):
     a valid signature of the outputs with the corresponding publickey
     of the miner which has mined the block.
     """
+    _fields = ('inputs', 'outputs', 'por', 'pubkey', 'is_coinbase')
+    __slots__ = _fields
 
     def __init__(self, *, inputs=None, outputs, por=None, pubkey, is_coinbase):
         self.inputs = inputs
@@ -146,21 +539,30 @@ class Transaction(KCBase):
 
     @property
     def fee(self):
+        return self._cached('fee', self._fee)
+
+    def _fee(self):
         if self.is_coinbase:
             return 0
         inputamount = sum([txin.amount for txin in self.inputs])
         outputamount = sum([txout.amount for txout in self.outputs])
         return inputamount - outputamount
 
-    def is_coinbase(self):
-        return self.is_coinbase
+    @property
+    def feerate(self):
+        """The fee per byte of the encoded transaction."""
+        return self.fee / len(self.encode())
 
     def __repr__(self):
         return "%s(inputs=%s, outputs=%s,por='%s',pubkey'%s',is_coinbase=%s)" % \
                (self.__class__.__name__, str(self.inputs), str(self.outputs), self.por, self.pubkey, str(self.is_coinbase))
 
-    def is_valid(self, *, blockchain):
-        """Checks if a transaction is valid.
+    def is_valid(self, *, blockchain, sigcache=None, verify_signatures=True):
+        """Checks if a transaction is valid. If a sigcache is given,
+        it is used to skip signature checks which have already been
+        done and is updated with the new results. If verify_signatures
+        is not set, the signatures are left to the caller, but the
+        referenced outputs still need to exist.
         """
         # The types have to be correct
         try:
@@ -174,32 +576,39 @@ class Transaction(KCBase):
         if not self.is_coinbase:
             # check the spend authorization (correct sig, or correct
             # multisig or correct contract) for non-coinbase transactions
-            if not self.check_signatures(blockchain = blockchain):
+            if not verify_signatures:
+                # raises a KeyError like check_signatures if a
+                # referenced output does not exist
+                self.pending_inputs(blockchain=blockchain)
+            elif not self.check_signatures(blockchain = blockchain, sigcache = sigcache):
                 return False
             # check for Doublespend
             if self.is_doublespend(blockchain = blockchain):
                 return False
         return True
 
-    def is_doublespend(self, *, blockchain):
-        for txinput in self.inputs:
-            for keyimage in txinput.keyimages:
-                try:
-                    tx = blockchain.get_transaction_by_keyimage(keyimage)
-                    # retrieve a tx with the same keyimage
-                    # if it is the same as our transaction, it is no doublespend
-                    if tx == self:
-                        return False
-                    # otherwise it is
-                    else:
-                        return True
-                # if we do not find a tx with the same keyimage, it is
-                # no doublespend
-                except KeyError:
-                    return False
-        return True
+    @property
+    def keyimages(self):
+        """The keyimages of all inputs of the transaction."""
+        if self.is_coinbase:
+            return []
+        return [keyimage for txinput in self.inputs for keyimage in txinput.keyimages]
 
-    def check_signatures(self, *, blockchain):
+    def is_doublespend(self, *, blockchain):
+        """Checks if another transaction in the blockchain uses one of
+        the keyimages of this transaction."""
+        for keyimage in self.keyimages:
+            try:
+                tx = blockchain.get_transaction_by_keyimage(keyimage)
+            except KeyError:
+                # no tx with the same keyimage
+                continue
+            # if it is the same as our transaction, it is no doublespend
+            if not tx.is_same(self):
+                return True
+        return False
+
+    def check_signatures(self, *, blockchain, sigcache=None):
         """
         Checks if the permissions to spend the referenced previous
         TxOuts (prevouts) in the TxInputs exists. I.e, this will check
@@ -210,54 +619,128 @@ class Transaction(KCBase):
 
         In the case of singlesig and multisig transactions, this will
         check the signatures.
+
+        Each input is verified exactly once: the outputs referenced by
+        all inputs are resolved in one lookup and the signed message is
+        built only once per transaction.
+
+        Inputs which are found in the sigcache are not verified again,
+        we only check that the outputs they reference exist.
+        Successfully verified inputs are added to the sigcache.
+        """
+        message = None
+        for index, txinput, ring in self.pending_inputs(blockchain=blockchain, sigcache=sigcache):
+            if message is None:
+                message = self.signed_message()
+            if not self._check_input_signatures(txinput, ring, message):
+                return False
+            if sigcache is not None:
+                sigcache.add(self.hash, index)
+        return True
+
+    def pending_inputs(self, *, blockchain, sigcache=None):
+        """Returns a list of (index, txinput, ring) for the inputs whose
+        signatures still need to be verified, where ring are the
+        outputs referenced by the input. The outputs referenced by
+        all inputs are resolved in one lookup, which raises a KeyError
+        if one of them does not exist.
+        """
+        prevouts = blockchain.get_outputs_by_hashes(
+            [h for txinput in self.inputs for h in txinput.prevhashes])
+        pending = []
+        offset = 0
+        for index, txinput in enumerate(self.inputs):
+            ring = prevouts[offset:offset + len(txinput.prevhashes)]
+            offset += len(txinput.prevhashes)
+            if sigcache is None or (self.hash, index) not in sigcache:
+                pending.append((index, txinput, ring))
+        return pending
+
+    def signed_message(self):
+        """Returns the message which is signed by the inputs of the
+        transaction, i.e., the outputs of the transaction."""
+        return json.dumps([_.serialize() for _ in self.outputs], sort_keys=True)
+
+    @staticmethod
+    def _check_input_signatures(txinput, ring, message):
+        """Checks the signatures of a TxInput spending one of the
+        TxOutputs in ring. The amount of the input is declared by the
+        transaction and not covered by the signatures, so it needs to
+        be the amount of every output in the ring. Otherwise a
+        transaction could spend more than its ring holds, and the
+        fees which the coinbase may claim would be inflated."""
+        if not ring or any(output.condition != ring[0].condition for output in ring):
+            # a ring needs a single OutputCondition
+            return False
+        if any(output.amount != txinput.amount for output in ring):
+            return False
+        condition = ring[0].condition
+        if condition == OutputCondition.singlesig:
+            # We have a TxOutFlavor.transfer, so there is only one sig,
+            # which is a ringsignature over the recipient pubkeys of
+            # the ring
+            if len(txinput.signatures) != 1:
+                return False
+            pubkeys = [output.recipientpubkeys[0] for output in ring]
+            return lww_signature.verify(pubkeys, message, txinput.signatures[0])
+        elif condition == OutputCondition.contract:
+            # spending contracts is not supported yet, so their outputs
+            # cannot be spent
+            return False
+        elif condition == OutputCondition.multisig:
+            # note: this is not a ringsig and cannot be made one, since
+            # there is no real anonymity set, so we have only one
+            # previous txo and need a signature for each of its
+            # recipient pubkeys
+            if len(ring) != 1:
+                return False
+            return Transaction._match_multisig(list(ring[0].recipientpubkeys),
+                                               list(txinput.signatures), message)
+        return False
+
+    @staticmethod
+    def _match_multisig(pubkeys, signatures, message):
+        """Checks that each pubkey has signed the message with exactly
+        one of the signatures. The signatures carry no signer index, so
+        the position of a signature is used as the hint for its
+        signer: the i-th signature is tried with the i-th pubkey first
+        and only then with the pubkeys which are not yet matched.
+        Signatures in the order of the pubkeys need one verification
+        each.
         """
-        for txinput in self.inputs:
-            for ring_output in [blockchain.get_output_by_hash(h) for h in txinput.prevhashes]:
-                # multiple previous outputs outs due to ringsig
-                can_spend_this_output = False
-                if ring_output.condition == OutputCondition.singlesig:
-                    # Check if the signature is valid.
-                    # first collect all the recipient pubkeys in the ring
-                    previous_txos = [blockchain.get_output_by_hash(h) for h in txinput.prevhashes]
-                    pubkeys = [output.recipientpubkeys[0] for output in previous_txos]
-                    # get the message which should be signed
-                    message = json.dumps([_.serialize() for _ in self.outputs], sort_keys=True)
-                    # Get the signature
-                    # We have a TxOutFlavor.transfer, so there is only one sig
-                    signature = txinput.signatures[0]
-                    # and check the sig
-                    if lww_signature.verify(pubkeys, message, signature):
-                        can_spend_this_output = True
-                elif ring_output.condition == OutputCondition.contract:
-                    raise NotImplementedError
-                elif ring_output.condition == OutputCondition.multisig:
-                    # Check if the signatures are valid.
-                    # first collect the sigs
-                    previous_txo = blockchain.get_output_by_hash(txinput.prevhashes[0])
-                    # note: this is not a ringsig and cannot be made one, since there is no real anonymity set
-                    # this also means we have only one previous txo
-                    # (one prehash), so we take the first one
-                    # we copy the pubkeys and the signatures, since these can be in a
-                    # different order, so we need to iterate and
-                    # remove the pubkey
-                    pubkeys = list(previous_txo.recipientpubkeys)
-                    # get the message which should be signed
-                    message = json.dumps([_.serialize() for _ in self.outputs], sort_keys=True)
-                    # get the signatures
-                    signatures = list(txinput.signatures)
-                    for pk in list(pubkeys):
-                        for sig in list(signatures):
-                            if lww_signature.verify([pk], message, sig):
-                                # we have found the corresponding signature and can delete it
-                                pubkeys.remove(pk)
-                                signatures.remove(sig)
-                    if len(pubkeys) == 0 and len(signatures) == 0:
-                        can_spend_this_output = True
-                if can_spend_this_output == False:
-                    # At least on of the referenced txouts per txin need to be spendable
-                    return False
+        if len(pubkeys) != len(signatures):
+            return False
+        unmatched = list(range(len(pubkeys)))
+        for hint, sig in enumerate(signatures):
+            candidates = [hint] if hint in unmatched else []
+            candidates += [i for i in unmatched if i != hint]
+            for i in candidates:
+                if lww_signature.verify([pubkeys[i]], message, sig):
+                    unmatched.remove(i)
+                    break
+            else:
+                return False
         return True
 
+    def _write(self, writer):
+        writer.optional(self.inputs, lambda inputs: writer.list(inputs, lambda txin: txin._write(writer)))
+        writer.list(self.outputs, lambda txout: txout._write(writer))
+        writer.optional(self.por, lambda por: writer.string(json.dumps(por, sort_keys=True)))
+        writer.hex(self.pubkey)
+        writer.bool(self.is_coinbase)
+
+    @classmethod
+    def _read(cls, reader):
+        inputs = reader.optional(lambda: reader.list(lambda: TxInput._read(reader)))
+        outputs = reader.list(lambda: TxOutput._read(reader))
+        por = reader.optional(reader.string)
+        if por is not None:
+            por_json = por
+            por = json.loads(por_json)
+            if json.dumps(por, sort_keys=True) != por_json:
+                raise codec.DecodeError("Non-canonical por")
+        return cls(inputs=inputs, outputs=outputs, por=por, pubkey=reader.hex(), is_coinbase=reader.bool())
+
     @classmethod
     def from_dict(cls, dict):
         if dict['inputs'] is not None:
@@ -274,6 +757,8 @@ class Transaction(KCBase):
 class TxInput(KCBase):
     """This class implements inputs of transactions.
     """
+    _fields = ('prevhashes', 'signatures', 'amount')
+    __slots__ = _fields
 
     def __init__(self, *, prevhashes, signatures, amount):
         self.prevhashes = prevhashes
@@ -295,10 +780,29 @@ class TxInput(KCBase):
     def keyimages(self):
         return [sig[0] for sig in self.signatures]
 
+    def _write(self, writer):
+        def write_signature(signature):
+            (keyimage, c, s) = signature
+            writer.hex(keyimage)
+            writer.bigint(c)
+            writer.list(s, writer.bigint)
+        writer.list(self.prevhashes, writer.hex)
+        writer.list(self.signatures, write_signature)
+        writer.varint(self.amount)
+
+    @classmethod
+    def _read(cls, reader):
+        def read_signature():
+            return (reader.hex(), reader.bigint(), reader.list(reader.bigint))
+        return cls(prevhashes=reader.list(reader.hex), signatures=reader.list(read_signature),
+                   amount=reader.varint())
+
 
 class TxOutput(KCBase):
     """This class implements outputs of transactions.
     """
+    _fields = ('amount', 'condition', 'nonce', 'recipientpubkeys')
+    __slots__ = _fields
 
     def __init__(self, *, recipientpubkeys, amount, nonce=None, condition):
         self.amount = amount
@@ -312,6 +816,22 @@ class TxOutput(KCBase):
         return "%s(recipientpubkeys=%s, amount=%s, nonce=%s, condition=%s)" % \
                (self.__class__.__name__, self.recipientpubkeys, self.amount, self.nonce, self.condition)
 
+    def _write(self, writer):
+        writer.varint(self.amount)
+        writer.u8(self.condition)
+        writer.varint(self.nonce)
+        writer.list(self.recipientpubkeys, writer.hex)
+
+    @classmethod
+    def _read(cls, reader):
+        amount = reader.varint()
+        try:
+            condition = OutputCondition(reader.u8())
+        except ValueError:
+            raise codec.DecodeError("Unknown OutputCondition")
+        return cls(amount=amount, condition=condition, nonce=reader.varint(),
+                   recipientpubkeys=reader.list(reader.hex))
+
 
 
 class OutputCondition(IntEnum):
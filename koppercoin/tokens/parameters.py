@@ -14,3 +14,14 @@ def mining_reward_per_blockheight(blockheight):
         return 0
     else:
         return int((start) * (1/2)**num_halvings_to_blockheight)
+
+
+# The maximal size of an encoded transaction in bytes
+max_transaction_size = 2**17
+# The maximal size of an encoded block in bytes
+max_block_size = 2**21
+# The maximal size of the encoded transactions in the mempool in bytes
+max_mempool_size = 2**26
+# The number of seconds after which a transaction is dropped from the
+# mempool
+mempool_expiry = 14 * 24 * 3600
@@ -0,0 +1,159 @@
+"""
+This file implements the access to the sqlite databases of the
+blockchain and the mempool.
+
+All writes to a database go through a single Sqlitewriter, a thread
+which owns the write connection. Writes are handed to it through a
+queue, so the reactor and the mining threads never wait for the disk.
+The writer collects the writes and commits them in batches with
+executemany, either when enough rows are pending or when the oldest
+pending write is older than the flush interval. The database uses the
+WAL journal, so readers are not blocked by the writer. The readers
+borrow their connections from a Readerpool.
+
+The durability is configurable with the synchronous setting of sqlite:
+'full' survives power loss, 'normal' survives a crash of the process
+and 'off' leaves the syncing to the operating system.
+"""
+
+import queue
+import sqlite3
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+_synchronous = {'full': 'FULL', 'normal': 'NORMAL', 'off': 'OFF'}
+
+
+def connect(path, durability='normal'):
+    """Opens a connection in WAL mode."""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=" + _synchronous[durability])
+    return conn
+
+
+class Sqlitewriter(threading.Thread):
+    """The thread which writes to a database. The thread is started
+    with the first write.
+
+    :param flushsize: the number of pending rows which triggers a
+        commit
+    :param flushinterval: the maximal number of seconds a write is
+        pending
+    :param durability: 'full', 'normal' or 'off'
+    """
+
+    def __init__(self, path, *, flushsize=512, flushinterval=1.0, durability='normal'):
+        super().__init__(daemon=True)
+        self.path = path
+        self.flushsize = flushsize
+        self.flushinterval = flushinterval
+        self.durability = durability
+        self.queue = queue.Queue()
+        self.startlock = threading.Lock()
+
+    def submit(self, sql, rows, callback=None):
+        """Queues the statement sql for each of the rows. The callback
+        is called in the writer thread after the rows are committed.
+        If the commit fails, the callback is not called."""
+        self.submit_many([(sql, rows)], callback)
+
+    def submit_many(self, writes, callback=None):
+        """Queues several statements, writes is a list of pairs of a
+        statement and its rows. They are committed in the same
+        transaction, see submit for the callback."""
+        with self.startlock:
+            if not self.is_alive() and self.ident is None:
+                self.start()
+        self.queue.put(([(sql, list(rows)) for sql, rows in writes], callback))
+
+    def flush(self):
+        """Blocks until all writes submitted so far are committed or
+        have failed."""
+        done = threading.Event()
+        self.submit_many([], done.set)
+        done.wait()
+
+    def close(self):
+        """Commits all pending writes and stops the thread."""
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+    def run(self):
+        conn = connect(self.path, self.durability)
+        pending = []
+        numrows = 0
+        deadline = None
+        stop = False
+        while not stop:
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if item is None:
+                stop = True
+            elif item:
+                pending.append(item)
+                numrows += sum(len(rows) for sql, rows in item[0])
+                if deadline is None:
+                    deadline = time.time() + self.flushinterval
+            flushrequested = item and not item[0]
+            if pending and (stop or flushrequested or numrows >= self.flushsize or time.time() >= deadline):
+                self._commit(conn, pending)
+                pending = []
+                numrows = 0
+                deadline = None
+        conn.close()
+
+    @staticmethod
+    def _commit(conn, pending):
+        writes = [write for item, callback in pending for write in item]
+        try:
+            with conn:
+                # consecutive writes with the same statement are
+                # batched, the order of the writes is kept
+                batch = []
+                for sql, rows in writes + [(None, [])]:
+                    if batch and sql != batch[0][0]:
+                        conn.executemany(batch[0][0], [row for _, batchrows in batch for row in batchrows])
+                        batch = []
+                    if sql is not None:
+                        batch.append((sql, rows))
+        except sqlite3.Error as e:
+            logging.getLogger(__name__).error("Writing to the database failed: " + str(e))
+            # the writes are rolled back, so only the flushes are done
+            pending = [(item, callback) for item, callback in pending if not item]
+        for item, callback in pending:
+            if callback is not None:
+                callback()
+
+
+class Readerpool():
+    """A pool of read connections to a database."""
+
+    def __init__(self, path, size=4):
+        self.path = path
+        self.size = size
+        self.connections = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Borrows a connection from the pool."""
+        try:
+            conn = self.connections.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            conn = sqlite3.connect(self.path, check_same_thread=False) if create else self.connections.get()
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
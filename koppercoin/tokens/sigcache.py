@@ -0,0 +1,67 @@
+"""
+This file implements a cache for the results of the signature checks
+of transactions. A transaction is checked when it enters the mempool
+and again when it is included in a block. With the cache, the second
+check does not need to verify the ring signatures again.
+
+The node fills the cache when the validation pipeline checks a
+received transaction, see koppercoin.tokens.validation, before it is
+added to the mempool. Mempool.admit fills it for transactions which
+are added without the pipeline.
+
+The cache is keyed by (tx hash, input index). The hash commits to the
+signed outputs, the signatures and the hashes of the referenced
+outputs, whose recipient keys are in turn fixed by these hashes.
+Hence a positive result never becomes wrong and the cache does not
+need to be invalidated on a reorg. What can change on a reorg is
+whether the referenced outputs exist and whether a keyimage is
+already spent. These are checked separately on each validation.
+Since the network and the mining threads share the cache, it is
+threadsafe.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class Signaturecache():
+    """A bounded cache of verified TxInputs. If the cache is full, the
+    least recently used entries are evicted."""
+
+    def __init__(self, maxsize=2**16):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return True
+            return False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, txhash, index):
+        """Marks the signatures of the index-th input of the transaction
+        with the hash txhash as valid."""
+        with self.lock:
+            self.entries[(txhash, index)] = True
+            self.entries.move_to_end((txhash, index))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def remove_transaction(self, tx):
+        """Removes all entries of a transaction."""
+        with self.lock:
+            for index in range(len(tx.inputs or [])):
+                self.entries.pop((tx.hash, index), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# The cache shared by the mempool and the validation of blocks
+signaturecache = Signaturecache()
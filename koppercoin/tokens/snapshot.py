@@ -0,0 +1,215 @@
+"""
+This file implements snapshots of the state of the blockchain. A
+snapshot contains everything a node needs to validate the blocks after
+it: the headers of the main chain up to the height of the snapshot,
+the outputs, which are also the decoy index, and the keyimages with
+the hashes of the transactions which spent them. A new node can start
+from a snapshot instead of replaying all blocks.
+
+A snapshot file is
+
+    magic (4 bytes) | height | headers | outputs | keyimages | hash (64 bytes)
+
+where each section is a list of length-prefixed encodings (see
+koppercoin.tokens.codec) terminated by an empty one, and hash is the
+SHA-512 of everything before it. The sections are ordered
+canonically, so every node creates the same snapshot at the same
+height. The hash is the commitment a node compares with a trusted
+value before it starts from the snapshot.
+
+    python -m koppercoin.tokens.snapshot create blockchain.db snapshot.kcs [height]
+    python -m koppercoin.tokens.snapshot verify snapshot.kcs
+    python -m koppercoin.tokens.snapshot load snapshot.kcs blockchain.db hash
+"""
+
+import os
+import hashlib
+from koppercoin.tokens import codec
+from koppercoin.tokens.model import BlockHeader, PrunedBlock, TxOutput
+
+MAGIC = b'KCSN'
+# the number of outputs or keyimages which are added at once
+_batchsize = 4096
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class _Hashingfile():
+    """Writes to a file and hashes everything written."""
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha512()
+
+    def write(self, data):
+        self.f.write(data)
+        self.hash.update(data)
+
+    def item(self, data):
+        writer = codec.Writer()
+        writer.bytes(data)
+        self.write(writer.getvalue())
+
+    def section(self, items):
+        for data in items:
+            self.item(data)
+        self.item(b'')
+
+
+def _keyimage_item(keyimage, txhash):
+    writer = codec.Writer()
+    writer.hex(keyimage)
+    writer.hex(txhash)
+    return writer.getvalue()
+
+
+def create(blockchain, path, height=None):
+    """Writes a snapshot of the main chain of the blockchain at height
+    to path. If height is None, the snapshot is taken at the maxblock.
+    The state above height is left out, so it needs to be in full
+    blocks.
+    :returns: the hash of the snapshot
+    :raises SnapshotError: if the state at height cannot be restored
+    """
+    if height is None:
+        height = blockchain.maxblock.blockheight
+    if not 0 <= height <= blockchain.maxblock.blockheight:
+        raise SnapshotError("No block at height " + str(height))
+    above = blockchain.blocks_in_range(height + 1)
+    if any(block.is_pruned for block in above):
+        raise SnapshotError("The blocks above the snapshot are pruned")
+    txs = [tx for block in above for tx in block.transactions]
+    newoutputs = set(output.hash for tx in txs for output in tx.outputs)
+    newkeyimages = set(keyimage for tx in txs for keyimage in tx.keyimages)
+    # the indexes only return committed objects
+    if hasattr(blockchain.pm, 'commit'):
+        blockchain.pm.commit()
+    with open(path, 'wb') as f:
+        out = _Hashingfile(f)
+        out.write(MAGIC)
+        writer = codec.Writer()
+        writer.varint(height)
+        out.write(writer.getvalue())
+        out.section(block.header.encode() for block in blockchain.blocks_in_range(1, height + 1))
+        out.section(output.encode() for output in blockchain.indexes.iter_outputs()
+                    if output.hash not in newoutputs)
+        out.section(_keyimage_item(keyimage, txhash) for keyimage, txhash in blockchain.indexes.iter_keyimage_items()
+                    if keyimage not in newkeyimages)
+        digest = out.hash.digest()
+        f.write(digest)
+    return digest.hex()
+
+
+def verify(path):
+    """Checks the hash at the end of the snapshot.
+    :returns: the hash of the snapshot
+    :raises SnapshotError: if the snapshot is damaged"""
+    size = os.path.getsize(path)
+    h = hashlib.sha512()
+    with open(path, 'rb') as f:
+        if size < len(MAGIC) + 64 or f.read(len(MAGIC)) != MAGIC:
+            raise SnapshotError("Not a snapshot")
+        h.update(MAGIC)
+        remaining = size - len(MAGIC) - 64
+        while remaining > 0:
+            chunk = f.read(min(remaining, 2**20))
+            h.update(chunk)
+            remaining -= len(chunk)
+        if h.digest() != f.read(64):
+            raise SnapshotError("The hash of the snapshot does not match its content")
+    return h.hexdigest()
+
+
+def _varint(f):
+    result = 0
+    shift = 0
+    while True:
+        byte = f.read(1)
+        if not byte:
+            raise SnapshotError("Unexpected end of the snapshot")
+        result |= (byte[0] & 0x7f) << shift
+        if not byte[0] & 0x80:
+            return result
+        shift += 7
+
+
+def _section(f):
+    while True:
+        length = _varint(f)
+        if length == 0:
+            return
+        data = f.read(length)
+        if len(data) < length:
+            raise SnapshotError("Unexpected end of the snapshot")
+        yield data
+
+
+def _batches(items):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == _batchsize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _read_keyimage_item(data):
+    reader = codec.Reader(data)
+    return (reader.hex(), reader.hex())
+
+
+def load(blockchain, path, commitment):
+    """Starts the blockchain from the snapshot at path. The blockchain
+    must not contain any blocks except the genesis block. The blocks
+    up to the height of the snapshot are added as PrunedBlocks, the
+    following blocks can be added and validated as usual.
+    :param commitment: the trusted hash of the snapshot
+    :returns: the height of the snapshot
+    :raises SnapshotError: if the snapshot does not match the
+        commitment or is malformed
+    """
+    if len(blockchain.mainchain) != 1:
+        raise SnapshotError("The blockchain already contains blocks")
+    if verify(path) != commitment:
+        raise SnapshotError("The snapshot does not match the commitment")
+    with open(path, 'rb') as f:
+        f.seek(len(MAGIC))
+        height = _varint(f)
+        try:
+            for data in _section(f):
+                block = PrunedBlock.from_header(BlockHeader.decode(data))
+                if block.prevhash != blockchain.maxblock.hash or block.blockheight != blockchain.maxblock.blockheight + 1:
+                    raise SnapshotError("The headers of the snapshot are no chain")
+                blockchain.add_block(block)
+            if blockchain.maxblock.blockheight != height:
+                raise SnapshotError("The headers of the snapshot end at the wrong height")
+            for batch in _batches(_section(f)):
+                blockchain.add_outputs([TxOutput.decode(data) for data in batch])
+            for batch in _batches(_section(f)):
+                blockchain.add_keyimages([_read_keyimage_item(data) for data in batch])
+        except codec.DecodeError as e:
+            raise SnapshotError("Malformed snapshot: " + str(e))
+        if f.tell() != os.path.getsize(path) - 64:
+            raise SnapshotError("Trailing data")
+    return height
+
+
+if __name__ == '__main__':
+    import sys
+    from koppercoin.tokens import Blockchain, Persistencemanager
+    command = sys.argv[1]
+    if command == 'create':
+        pm = Persistencemanager(sys.argv[2])
+        height = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        print(create(Blockchain(persistence=pm), sys.argv[3], height))
+        pm.close()
+    elif command == 'verify':
+        print(verify(sys.argv[2]))
+    elif command == 'load':
+        pm = Persistencemanager(sys.argv[3])
+        print("Loaded snapshot at height " + str(load(Blockchain(persistence=pm), sys.argv[2], sys.argv[4])))
+        pm.close()
@@ -0,0 +1,146 @@
+"""
+This file implements the block templates for mining. A template is
+the set of transactions a miner tries to find a block for, on top of
+the current block of the blockchain.
+
+The template is packed greedily: the transactions of the mempool are
+taken by decreasing fee rate as long as they fit into the maximal block
+size and do not use a keyimage of a transaction which is already in
+the template. The mempool is only walked until not even its smallest
+transaction would fit any more. The coinbase pays the mining reward plus the fees of the
+transactions.
+
+When a transaction arrives, it is added to the existing template if it
+fits, or replaces the transactions with the lowest fee rates if this
+increases the fees of the template. So a template only needs to be
+built again when the blockchain has a new current block. Each change
+increases the generation of the template, so the miners know when to
+switch to new work.
+"""
+
+import threading
+from koppercoin.tokens import parameters
+from koppercoin.tokens.model import Block
+
+# bytes reserved for the parts of a block which change with the
+# content, e.g., the amount of the coinbase and the number of
+# transactions
+_slack = 32
+
+
+def _varintsize(value):
+    return max(1, (value.bit_length() + 6) // 7)
+
+
+def _txsize(tx):
+    """The number of bytes the transaction takes in an encoded block."""
+    return _encodedsize(len(tx.encode()))
+
+
+def _encodedsize(size):
+    """The number of bytes a transaction of size bytes takes in an
+    encoded block."""
+    return _varintsize(size) + size
+
+
+class Templatebuilder():
+    """Builds and updates the template of the next block.
+
+    :param mempool: the mempool whose transactions are included
+    :param wallet: the wallet which receives the coinbase
+    :param maxsize: the maximal size of an encoded block in bytes
+    """
+
+    def __init__(self, mempool, wallet, *, maxsize=parameters.max_block_size):
+        self.mempool = mempool
+        self.wallet = wallet
+        self.maxsize = maxsize
+        self.lock = threading.RLock()
+        self.prevblock = None
+        self.generation = 0
+        self._clear()
+
+    def _clear(self):
+        self.transactions = []
+        self.hashes = set()
+        self.keyimages = set()
+        self.fees = 0
+        self.size = 0
+        self.budget = 0
+        self.coinbase = None
+
+    def build(self, prevblock):
+        """Builds a new template on top of prevblock from the mempool.
+        :returns: the block of the template
+        """
+        with self.lock, self.mempool.lock:
+            self._clear()
+            self.prevblock = prevblock
+            coinbase = self.wallet.gen_coinbase_tx(prevblock.blockheight + 1)
+            empty = Block.from_prevblock(prevblock, transactions=[coinbase])
+            self.budget = self.maxsize - len(empty.encode()) - _slack
+            minsize = self.mempool.min_txsize()
+            for tx in self.mempool.iter_by_feerate():
+                if self.budget - self.size < _encodedsize(minsize):
+                    break
+                self._add(tx)
+            self.generation += 1
+            return self.block()
+
+    def _add(self, tx):
+        if (tx.is_coinbase or tx.hash in self.hashes or any(keyimage in self.keyimages for keyimage in tx.keyimages)
+                or self.size + _txsize(tx) > self.budget):
+            return False
+        self.transactions.append(tx)
+        self.hashes.add(tx.hash)
+        self.keyimages.update(tx.keyimages)
+        self.fees += tx.fee
+        self.size += _txsize(tx)
+        return True
+
+    def _remove(self, tx):
+        self.transactions.remove(tx)
+        self.hashes.remove(tx.hash)
+        self.keyimages.difference_update(tx.keyimages)
+        self.fees -= tx.fee
+        self.size -= _txsize(tx)
+
+    def add_transaction(self, tx):
+        """Adds a transaction of the mempool to the template. If it does
+        not fit, it replaces the transactions with lower fee rates,
+        but only if this increases the fees of the template.
+        Transactions which conflict with the template are not added.
+        :returns: True if the template was changed
+        """
+        with self.lock:
+            if self.prevblock is None:
+                return False
+            if not self._add(tx):
+                if tx.is_coinbase or tx.hash in self.hashes or any(keyimage in self.keyimages
+                                                                   for keyimage in tx.keyimages):
+                    return False
+                # the transactions which are replaced, lowest fee rate first
+                replaced = []
+                free = self.budget - self.size
+                for other in sorted(self.transactions, key=lambda other: other.feerate):
+                    if free >= _txsize(tx) or other.feerate >= tx.feerate:
+                        break
+                    replaced.append(other)
+                    free += _txsize(other)
+                if free < _txsize(tx) or sum(other.fee for other in replaced) >= tx.fee:
+                    return False
+                for other in replaced:
+                    self._remove(other)
+                self._add(tx)
+            self.coinbase = None
+            self.generation += 1
+            return True
+
+    def block(self):
+        """Returns the block of the current template, with the
+        transactions followed by the coinbase. The nonce and the
+        timestamp are left to the miner."""
+        with self.lock:
+            if self.coinbase is None:
+                self.coinbase = self.wallet.gen_coinbase_tx(self.prevblock.blockheight + 1, fees=self.fees)
+            return Block.from_prevblock(self.prevblock, transactions=self.transactions + [self.coinbase])
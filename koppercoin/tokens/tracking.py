@@ -0,0 +1,95 @@
+"""
+This file implements the scanning of the blockchain on behalf of light
+clients. A light client hands its tracking key (a, B) to a node. The
+tracking key allows to detect the TxOutputs which belong to the client
+but not to spend them, compare with koppercoin.crypto.onetime_keys.
+The node then scans new blocks and only forwards the matching
+TxOutputs together with their transaction public keys.
+"""
+
+from koppercoin.crypto import onetime_keys
+from koppercoin.tokens.model import OutputCondition
+
+
+class Trackingsubscription():
+    """A subscription of a light client. It holds the tracking key of
+    the client and knows how to scan transactions and blocks for
+    TxOutputs which are recoverable with this tracking key.
+    """
+
+    def __init__(self, trackingkey, *, fromheight=0):
+        (a, B) = trackingkey
+        self.trackingkey = (a, B)
+        self.fromheight = fromheight
+
+    def scan_transaction(self, tx):
+        """Returns the TxOutputs of the transaction which can be
+        recovered with the tracking key, i.e., singlesig outputs
+        belonging to the client and multisig outputs where the client
+        is one of the recipients.
+        """
+        matches = []
+        for txout in tx.outputs:
+            if txout.condition == OutputCondition.singlesig:
+                ot_pub_keys = txout.recipientpubkeys[:1]
+            elif txout.condition == OutputCondition.multisig:
+                ot_pub_keys = txout.recipientpubkeys
+            else:
+                continue
+            if any(onetime_keys.recoverable((ot_pub_key, tx.pubkey), self.trackingkey)
+                   for ot_pub_key in ot_pub_keys):
+                matches.append(txout)
+        return matches
+
+    def scan_block(self, block, transactions=None):
+        """Scans a block and returns a list of entries
+        (txhash, tx_pubkey, [txout1, ..., txoutn]), one for each
+        transaction which contains matching TxOutputs. The transactions
+        of a pruned block are passed in transactions, see
+        Blockchain.get_transactions.
+        """
+        if transactions is None:
+            transactions = block.transactions
+        entries = []
+        for tx in transactions:
+            matches = self.scan_transaction(tx)
+            if matches:
+                entries.append((tx.hash, tx.pubkey, matches))
+        return entries
+
+    def scan_blocks(self, blocks):
+        """Scans the blocks and returns the results of scan_block as a
+        list of (block, entries). Blocks without matches are left out.
+        """
+        results = []
+        for block in blocks:
+            entries = self.scan_block(block)
+            if entries:
+                results.append((block, entries))
+        return results
+
+    def catch_up(self, blockchain, fromheight=None):
+        """Scans all blocks of the main chain starting at fromheight
+        and returns the results of scan_block as a list of
+        (block, entries), ordered by increasing blockheight.
+        Blocks without matches are left out.
+        """
+        if fromheight is None:
+            fromheight = self.fromheight
+        results = []
+        for block in blockchain.stream_blocks(fromheight):
+            entries = self.scan_block(block, blockchain.get_transactions(block))
+            if entries:
+                results.append((block, entries))
+        return results
+
+    @staticmethod
+    def serialize_matches(block, entries):
+        """Returns a serializable version of the matches of a block
+        which can be sent to the light client."""
+        return {'blockheight': block.blockheight,
+                'blockhash': block.hash,
+                'transactions': [{'txhash': txhash,
+                                  'pubkey': tx_pubkey,
+                                  'outputs': [_.serialize() for _ in txouts]}
+                                 for (txhash, tx_pubkey, txouts) in entries]}
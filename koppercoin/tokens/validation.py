@@ -0,0 +1,285 @@
+"""
+This file implements the parallel verification of the signatures of
+the transactions in a block. Verifying the ring signatures is by far
+the most expensive part of validating a block and the inputs can be
+verified independently of each other, so they are distributed to a
+pool of processes.
+
+The pool is created once and reused for all blocks. The processes
+only get the encoded inputs, the outputs they reference and the
+signed messages, never the blockchain. As soon as one signature is
+invalid the block is rejected and the remaining jobs of this block
+are skipped by the processes.
+
+Transactions and blocks received from the network are checked by a
+Validationpipeline, which runs the checks ordered by their cost, so
+that invalid objects are rejected before their signatures are
+verified.
+"""
+
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict
+from koppercoin.tokens.model import Transaction, TxInput, TxOutput
+from koppercoin.tokens.sigcache import signaturecache
+from koppercoin.tokens.keyimages import Keyimageregistry
+from koppercoin.tokens import parameters
+
+# The generation of the current block, shared with the processes in
+# the pool. Jobs of older generations are skipped.
+_generation = None
+
+
+def _setup(generation):
+    global _generation
+    _generation = generation
+
+
+def _verify(job):
+    """Verifies the signatures of one input in a process of the pool.
+    Returns the position of the job and the result, which is None if
+    the job has been skipped."""
+    (position, generation, txinput, ring, message) = job
+    if _generation.value != generation:
+        return (position, None)
+    return (position, Transaction._check_input_signatures(TxInput.decode(txinput),
+                                                          [TxOutput.decode(output) for output in ring],
+                                                          message))
+
+
+class Validationexecutor():
+    """Verifies the signatures of transactions using a reusable pool
+    of processes.
+
+    :param processes: the number of processes, defaults to the number
+        of cpus. With one process everything is verified in the calling
+        thread.
+    :param threshold: blocks with fewer unverified inputs are verified
+        in the calling thread, since this is faster than sending them
+        to the pool.
+    """
+
+    def __init__(self, processes=None, *, threshold=2):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.threshold = threshold
+        self.pool = None
+        self.generation = multiprocessing.Value('i', 0)
+        # the generation counter is shared by all blocks, so blocks are
+        # verified one after the other
+        self.lock = threading.Lock()
+
+    def _get_pool(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(processes=self.processes, initializer=_setup,
+                                             initargs=(self.generation,))
+        return self.pool
+
+    def close(self):
+        """Stops the processes of the pool."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def check_signatures(self, transactions, *, blockchain, sigcache=None):
+        """Checks the signatures of all inputs of the transactions.
+        Inputs which are in the sigcache are skipped and verified
+        inputs are added to it.
+
+        :returns: True if all signatures are valid
+        """
+        jobs = []
+        for tx in transactions:
+            if tx.is_coinbase:
+                continue
+            pending = tx.pending_inputs(blockchain=blockchain, sigcache=sigcache)
+            if pending:
+                message = tx.signed_message()
+                jobs += [(tx, index, txinput, ring, message) for (index, txinput, ring) in pending]
+        if self.processes <= 1 or len(jobs) < self.threshold:
+            for (tx, index, txinput, ring, message) in jobs:
+                if not Transaction._check_input_signatures(txinput, ring, message):
+                    return False
+                if sigcache is not None:
+                    sigcache.add(tx.hash, index)
+            return True
+        with self.lock:
+            generation = self.generation.value
+            encoded = [(position, generation, txinput.encode(), [output.encode() for output in ring], message)
+                       for position, (tx, index, txinput, ring, message) in enumerate(jobs)]
+            # the results arrive in the order the jobs finish, so we
+            # stop at the first invalid signature
+            for position, valid in self._get_pool().imap_unordered(_verify, encoded):
+                if not valid:
+                    # skip the remaining jobs of this block
+                    self.generation.value += 1
+                    return False
+                (tx, index) = jobs[position][:2]
+                if sigcache is not None:
+                    sigcache.add(tx.hash, index)
+            return True
+
+
+def _is_well_formed(tx):
+    """The structural checks of a regular transaction, which do not
+    need the blockchain."""
+    try:
+        if not tx.inputs or not tx.outputs:
+            return False
+        if not all(isinstance(txin, TxInput) and txin.prevhashes and txin.signatures for txin in tx.inputs):
+            return False
+        if not all(isinstance(txout, TxOutput) and txout.amount >= 0 for txout in tx.outputs):
+            return False
+        return tx.fee >= 0
+    except (TypeError, AttributeError):
+        return False
+
+
+class Validationpipeline():
+    """Validates transactions and blocks received from the network.
+    The checks are run in stages, the cheapest first, and each stage
+    rejects early:
+
+    1. structure: the size and the structure of the object
+    2. pow: the proof of work of the block header and, once the
+       previous block is known, its target
+    3. duplicate: objects we already know and blocks whose parent we
+       do not know
+    4. keyimages: keyimages used twice or already spent, for
+       transactions also in the mempool
+    5. coinbase: the amount of the coinbase of a block
+    6. signatures: the referenced outputs and the signatures
+
+    The stages which need the indexes, i.e., transactions already in
+    the chain, spent keyimages and the referenced outputs, are only
+    run for blocks which extend the main chain, see Blockchain.
+
+    The rejections per stage are counted in rejected, the accepted
+    objects in accepted. The hashes of transactions with invalid
+    signatures are kept in invalidtransactions, so their signatures
+    are not verified again when other peers relay them. The hash
+    commits to the signatures, so such a transaction stays invalid.
+
+    :param seentransactions: a set of hashes of transactions which
+        have already been received, e.g., the ones we have relayed
+    :param seenblocks: the same for blocks
+    :param executor: a Validationexecutor for verifying the
+        signatures of blocks in parallel
+    :param maxinvalid: the number of invalid transactions which are
+        remembered, the oldest ones are forgotten first
+    """
+    stages = ('structure', 'pow', 'duplicate', 'keyimages', 'coinbase', 'signatures')
+
+    def __init__(self, blockchain, mempool, *, seentransactions=None, seenblocks=None, executor=None,
+                 sigcache=signaturecache, maxinvalid=2**12):
+        self.blockchain = blockchain
+        self.registry = Keyimageregistry(blockchain, mempool)
+        self.seentransactions = seentransactions if seentransactions is not None else set()
+        self.seenblocks = seenblocks if seenblocks is not None else set()
+        self.executor = executor
+        self.sigcache = sigcache
+        self.rejected = {'transaction': Counter(), 'block': Counter()}
+        self.accepted = Counter()
+        self.invalidtransactions = OrderedDict()
+        self.maxinvalid = maxinvalid
+        self.lock = threading.Lock()
+
+    def _reject(self, kind, stage):
+        with self.lock:
+            self.rejected[kind][stage] += 1
+        return False
+
+    def _accept(self, kind):
+        with self.lock:
+            self.accepted[kind] += 1
+        return True
+
+    def _reject_invalid(self, tx):
+        with self.lock:
+            self.invalidtransactions[tx.hash] = True
+            while len(self.invalidtransactions) > self.maxinvalid:
+                self.invalidtransactions.popitem(last=False)
+        return self._reject('transaction', 'signatures')
+
+    def reject_malformed(self, kind):
+        """Counts an object which could not even be decoded."""
+        return self._reject(kind, 'structure')
+
+    def check_transaction(self, tx):
+        """Validates a transaction which is to be added to the mempool.
+        A coinbase transaction is only valid inside a block.
+        :returns: True if the transaction is valid
+        """
+        if (len(tx.encode()) > parameters.max_transaction_size or tx.is_coinbase
+                or not _is_well_formed(tx)):
+            return self._reject('transaction', 'structure')
+        if (tx.hash in self.seentransactions or tx.hash in self.invalidtransactions
+                or tx.hash in self.blockchain.transactions):
+            return self._reject('transaction', 'duplicate')
+        keyimages = tx.keyimages
+        if len(keyimages) != len(set(keyimages)) or self.registry.conflicts(tx):
+            return self._reject('transaction', 'keyimages')
+        try:
+            if not tx.check_signatures(blockchain=self.blockchain, sigcache=self.sigcache):
+                return self._reject_invalid(tx)
+        except KeyError:
+            # a referenced output does not exist, it may still arrive
+            # with a block
+            return self._reject('transaction', 'signatures')
+        return self._accept('transaction')
+
+    def check_block(self, block):
+        """Validates a block which is to be added to the blockchain.
+        :returns: True if the block is valid
+        """
+        if len(block.encode()) > parameters.max_block_size:
+            return self._reject('block', 'structure')
+        if not block.header.has_valid_pow():
+            return self._reject('block', 'pow')
+        if block.hash in self.seenblocks or block.hash in self.blockchain.blocks:
+            return self._reject('block', 'duplicate')
+        try:
+            prevblock = self.blockchain.get_block_by_hash(block.prevhash)
+        except KeyError:
+            return self._reject('block', 'duplicate')
+        if block.blockheight != prevblock.blockheight + 1:
+            return self._reject('block', 'structure')
+        # the proof of work only counts for the target of the chain,
+        # not for a target the block declares itself
+        if block.target != prevblock.next_target():
+            return self._reject('block', 'pow')
+        # a block which repeats a transaction may have the hash of a
+        # valid block, see merkle_root
+        if not block.has_unique_transactions():
+            return self._reject('block', 'structure')
+        # only now the transactions are decoded
+        transactions = [tx for tx in block.transactions if not tx.is_coinbase]
+        if not all(_is_well_formed(tx) for tx in transactions):
+            return self._reject('block', 'structure')
+        keyimages = [keyimage for tx in transactions for keyimage in tx.keyimages]
+        if len(keyimages) != len(set(keyimages)):
+            return self._reject('block', 'keyimages')
+        if not block.has_valid_coinbase():
+            return self._reject('block', 'coinbase')
+        # the indexes contain the main chain, so the remaining stages
+        # can only be checked for blocks which extend it. The blocks of
+        # other chains are validated by the blockchain when they join
+        # the main chain.
+        if block.prevhash != self.blockchain.maxblock.hash:
+            return self._accept('block')
+        if any(tx.hash in self.blockchain.transactions for tx in transactions):
+            return self._reject('block', 'duplicate')
+        if any(tx.is_doublespend(blockchain=self.blockchain) for tx in transactions):
+            return self._reject('block', 'keyimages')
+        try:
+            if self.executor is not None:
+                valid = self.executor.check_signatures(transactions, blockchain=self.blockchain,
+                                                       sigcache=self.sigcache)
+            else:
+                valid = all(tx.check_signatures(blockchain=self.blockchain, sigcache=self.sigcache)
+                            for tx in transactions)
+        except KeyError:
+            # a referenced output does not exist
+            valid = False
+        if not valid:
+            return self._reject('block', 'signatures')
+        return self._accept('block')
@@ -113,7 +113,7 @@ class Wallet():
         self.txos.clear()
         self.unspent_txos.clear()
         for block in self.blockchain:
-            for tx in block.transactions:
+            for tx in self.blockchain.get_transactions(block):
                 # check for own transactions
                 (txouts, pk) = self.get_own_txouts_and_tx_pubkey_from_tx(tx)
                 if txouts != []:
@@ -191,7 +191,7 @@ class Wallet():
         own_txos = []
         # TODO: if we can mark tx as belonging to us in the db this will be faster
         for block in self.blockchain:
-            for tx in block.transactions:
+            for tx in self.blockchain.get_transactions(block):
                 (txouts, pk) = self.get_own_txouts_and_tx_pubkey_from_tx(tx)
                 if txouts != []:
                     own_txos += [(txout, pk) for txout in txouts]
@@ -207,7 +207,7 @@ class Wallet():
         shared_txos = []
         # TODO: if we can mark tx as belonging to us in the db this will be faster
         for block in self.blockchain:
-            for tx in block.transactions:
+            for tx in self.blockchain.get_transactions(block):
                 (txouts, pk) = self.get_shared_txouts_and_tx_pubkey_from_tx(tx)
                 if txouts != []:
                     shared_txos += [(txout, pk) for txout in txouts]
@@ -327,7 +327,8 @@ class Wallet():
         # build the anonymity set referenced in txinput.prevouts
         for (txo, tx_pubkey) in txos_and_pks_to_be_used:
             try:
-                anon_txouts = self.blockchain.get_random_output_by_flavor_and_amnt(OutputCondition.singlesig, txo.amount, anon_size-1)
+                anon_txouts = self.blockchain.get_random_output_by_flavor_and_amnt(OutputCondition.singlesig, txo.amount, anon_size-1,
+                                                                                   exclude=[txo.hash])
             except ValueError:
                 raise Wallet.NotEnoughTxOutsError("""There are not enough TxOutputs
                     found which can be used in the anonymity set.
@@ -351,17 +352,18 @@ class Wallet():
         tx = Transaction.gen_regular(inputs=txinputs, outputs=txoutputs, pubkey=tx_pk)
         return tx
 
-    def gen_coinbase_tx(self, blockheight):
+    def gen_coinbase_tx(self, blockheight, fees=0):
         """generates a coinbase transaction, i.e., a transaction for
-        earning the mining reward.
+        earning the mining reward and the fees of the other
+        transactions of the block.
 
         >>> wal = Wallet(force_new=True, persist=False, blockchain=Blockchain())
         >>> tx = wal.gen_coinbase_tx(2)
         >>> tx.is_coinbase
         True
         """
-        # set the amount (without the fees)
-        amount = parameters.mining_reward_per_blockheight(blockheight)
+        # set the amount
+        amount = parameters.mining_reward_per_blockheight(blockheight) + fees
         # set the recipient
         (onetime_key, tx_pubkey) = onetime_keys.generate_ot_key(self.public_key)
         coinbase_output = TxOutput(amount=amount, condition=OutputCondition.singlesig, recipientpubkeys=[onetime_key])
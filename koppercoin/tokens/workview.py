@@ -0,0 +1,81 @@
+"""
+This file implements the view of the mining processes on the work of
+the node. The node publishes the template of the next block, i.e., the
+header on top of the current block together with the transactions of
+the template, to shared memory. The mining processes read it from
+there instead of keeping their own copies of the blockchain and the
+mempool, which would diverge from the ones of the node.
+
+Each publication increases a generation counter. The counter is odd
+while a template is written, so a reader which sees the same even
+generation before and after copying the template has read a complete
+one. The miners compare the generation with the one of their work
+after each batch of nonces, which is a single read of shared memory,
+and switch to the new template as soon as it changes.
+"""
+
+import time
+import ctypes
+import threading
+import multiprocessing
+from koppercoin.tokens import parameters
+from koppercoin.tokens.model import Block
+
+
+class Workview():
+    """A template of the next block in shared memory. It is written by
+    a single process and can be read by any process which inherits it.
+
+    :param size: the maximal size of an encoded template in bytes
+    """
+
+    def __init__(self, size=parameters.max_block_size + 2**10):
+        self.size = size
+        self._generation = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self._length = multiprocessing.RawValue(ctypes.c_uint32, 0)
+        self._buffer = multiprocessing.RawArray(ctypes.c_char, size)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @property
+    def generation(self):
+        """The generation of the current template, 0 if no template was
+        published yet."""
+        return self._generation.value
+
+    def publish(self, block):
+        """Publishes the block as the new template.
+        :returns: the generation of the template
+        :raises ValueError: if the block exceeds the size of the view
+        """
+        data = block.encode()
+        if len(data) > self.size:
+            raise ValueError("The template exceeds the size of the view")
+        with self.lock:
+            generation = self._generation.value
+            self._generation.value = generation + 1
+            self._length.value = len(data)
+            ctypes.memmove(self._buffer, data, len(data))
+            self._generation.value = generation + 2
+        return generation + 2
+
+    def read(self):
+        """Reads the current template.
+        :returns: a tuple (generation, block), where block is None if no
+            template was published yet
+        """
+        while True:
+            generation = self._generation.value
+            if generation % 2 == 0:
+                data = ctypes.string_at(self._buffer, self._length.value)
+                if self._generation.value == generation:
+                    return (generation, Block.decode(data) if generation else None)
+            time.sleep(0)
@@ -0,0 +1,268 @@
+import unittest
+# Set test environment flag
+import koppercoin.config
+koppercoin.config.test = True
+
+import os
+import tempfile
+from koppercoin.tokens import *
+from koppercoin.tokens import Persistencemanager
+from koppercoin.tokens.wallet import *
+from koppercoin.tokens.sigcache import Signaturecache
+from koppercoin.tokens.validation import Validationpipeline
+from test_transactions import Mockpersistence, find_next_block_noabrt
+from test_validation import mine
+
+
+class TestBlocktree(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.bc = Blockchain(persistence=Mockpersistence())
+        self.wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        self.coinbase_tx = self.wal.gen_coinbase_tx(1)
+        self.fstblock = find_next_block_noabrt(genesisblock, [self.coinbase_tx])
+        self.bc.add_block(self.fstblock)
+        self.tx = self.wal.gen_transfer_tx(1, [self.wal.public_key], [self.coinbase_tx.outputs[0].amount//2], 2)
+        self.sndblock = find_next_block_noabrt(self.fstblock, [self.tx])
+        # a competing chain which does not contain the transaction
+        self.fork = [find_next_block_noabrt(self.fstblock, [])]
+        self.fork.append(find_next_block_noabrt(self.fork[0], []))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def assertIndexed(self, bc, indexed):
+        self.assertEqual(self.tx.hash in bc.transactions, indexed)
+        self.assertEqual(self.tx.outputs[0].hash in bc.outputs, indexed)
+        self.assertEqual(self.tx.keyimages[0] in bc.keyimages, indexed)
+        self.assertEqual(self.coinbase_tx.outputs[0].hash in bc.outputs, True)
+
+    def test_reorg(self):
+        """
+        test if the chain with the most work becomes the main chain and
+        the indexes follow it
+        """
+        self.bc.add_block(self.sndblock)
+        # a chain with the same work does not replace the main chain
+        update = self.bc.add_block(self.fork[0])
+        self.assertEqual(update, Blockchain.Chainupdate(disconnected=[], connected=[]))
+        self.assertEqual(self.bc.maxblock.hash, self.sndblock.hash)
+        self.assertIndexed(self.bc, True)
+        update = self.bc.add_block(self.fork[1])
+        self.assertEqual([block.hash for block in update.disconnected], [self.sndblock.hash])
+        self.assertEqual([block.hash for block in update.connected], [block.hash for block in self.fork])
+        self.assertEqual(self.bc.maxblock.hash, self.fork[1].hash)
+        self.assertEqual(self.bc.get_work(self.fork[1].hash), genesisblock.work + 3 * self.fork[1].work)
+        self.assertIndexed(self.bc, False)
+        # and back to the chain with the transaction
+        trdblock = find_next_block_noabrt(self.sndblock, [])
+        self.bc.add_block(trdblock)
+        update = self.bc.add_block(find_next_block_noabrt(trdblock, []))
+        self.assertEqual(len(update.disconnected), 2)
+        self.assertEqual(len(update.connected), 3)
+        self.assertIndexed(self.bc, True)
+        self.assertEqual(len(list(self.bc)), 5)
+
+    def test_heights(self):
+        """
+        test if the height index follows the main chain
+        """
+        self.bc.add_block(self.sndblock)
+        self.assertEqual(self.bc.get_block_by_height(2).hash, self.sndblock.hash)
+        for block in self.fork:
+            self.bc.add_block(block)
+        self.assertEqual(self.bc.mainchain, [genesisblock.hash, self.fstblock.hash] + [block.hash for block in self.fork])
+        self.assertEqual([block.hash for block in self.bc.blocks_in_range(1, 3)],
+                         [self.fstblock.hash, self.fork[0].hash])
+        self.assertEqual([block.hash for block in self.bc.iter_forward(2)], [block.hash for block in self.fork])
+        self.assertEqual(list(self.bc)[0].hash, self.fork[1].hash)
+        self.assertRaises(KeyError, self.bc.get_hash_by_height, 4)
+        self.assertEqual(self.bc.blocks_in_range(4, 10), [])
+
+    def test_stream_blocks(self):
+        """
+        test if the main chain is streamed from the block store in
+        batches
+        """
+        pm = Persistencemanager(os.path.join(self.dir.name, "blockchain.db"))
+        bc = Blockchain(persistence=pm)
+        for block in [self.fstblock, self.sndblock] + self.fork:
+            bc.add_block(block)
+        streamed = list(bc.stream_blocks(1, batchsize=2))
+        self.assertEqual([block.hash for block in streamed], [self.fstblock.hash] + [block.hash for block in self.fork])
+        self.assertEqual([block.is_decoded for block in streamed], [False] * 3)
+        self.assertEqual(pm.raw_blocks([self.sndblock.hash, genesisblock.hash])[1], None)
+        pm.close()
+
+    def test_decoys(self):
+        """
+        test if decoys are sampled from the outputs with the same
+        condition and amount of the main chain
+        """
+        amount = self.coinbase_tx.outputs[0].amount
+        self.assertRaises(ValueError, self.bc.get_random_output_by_flavor_and_amnt, OutputCondition.singlesig,
+                          amount, 1, exclude=[self.coinbase_tx.outputs[0].hash])
+        other = self.wal.gen_coinbase_tx(1)
+        self.bc.add_block(self.fork[0])
+        self.bc.add_block(find_next_block_noabrt(self.fork[0], [other]))
+        decoys = self.bc.get_random_output_by_flavor_and_amnt(OutputCondition.singlesig, amount, 1,
+                                                             exclude=[self.coinbase_tx.outputs[0].hash])
+        self.assertEqual([decoy.hash for decoy in decoys], [other.outputs[0].hash])
+        self.assertEqual(self.bc.get_random_output_by_flavor_and_amnt(OutputCondition.multisig, amount, 0), [])
+        # the wallet uses them as the ring of its inputs
+        tx = self.wal.gen_transfer_tx(2, [self.wal.public_key], [amount//2], 2)
+        self.assertEqual(len(tx.inputs[0].prevhashes), 2)
+        self.assertEqual(tx.is_valid(blockchain=self.bc), True)
+
+    def test_orphans(self):
+        """
+        test if blocks are connected once their previous block arrives
+        """
+        self.bc.add_block(self.fork[1])
+        self.assertNotIn(self.fork[1].hash, self.bc.blocks)
+        self.assertEqual(self.bc.maxblock.hash, self.fstblock.hash)
+        update = self.bc.add_block(self.fork[0])
+        self.assertEqual(self.bc.maxblock.hash, self.fork[1].hash)
+        self.assertEqual(len(update.connected), 2)
+        self.assertEqual(self.bc.orphans, {})
+
+    def test_fork_shares_transaction(self):
+        """
+        test if a fork which contains a transaction of the main chain is
+        accepted by the validation pipeline and becomes the main chain
+        """
+        pipeline = Validationpipeline(self.bc, Mempool(persistencemanager=Mockpersistence(), allowload=False),
+                                      sigcache=Signaturecache())
+        self.bc.add_block(mine(self.fstblock, [self.tx, self.wal.gen_coinbase_tx(2)]))
+        fork = [mine(self.fstblock, [self.tx])]
+        fork.append(mine(fork[0], []))
+        for block in fork:
+            self.assertEqual(pipeline.check_block(block), True)
+            update = self.bc.add_block(block)
+        self.assertEqual(len(update.disconnected), 1)
+        self.assertEqual(self.bc.maxblock.hash, fork[1].hash)
+        self.assertIndexed(self.bc, True)
+
+    def test_invalid_fork(self):
+        """
+        test if a fork with an invalid transaction does not become the
+        main chain and is dropped
+        """
+        self.bc.add_block(self.sndblock)
+        tampered = Transaction.decode(self.tx.encode())
+        tampered.outputs = [TxOutput(amount=1, recipientpubkeys=self.tx.outputs[0].recipientpubkeys,
+                                     condition=OutputCondition.singlesig)]
+        invalid = find_next_block_noabrt(self.fork[0], [tampered])
+        self.bc.add_block(self.fork[0])
+        update = self.bc.add_block(invalid)
+        self.assertEqual(update, Blockchain.Chainupdate(disconnected=[], connected=[]))
+        self.assertEqual(self.bc.maxblock.hash, self.sndblock.hash)
+        self.assertEqual(self.bc.mainchain, [genesisblock.hash, self.fstblock.hash, self.sndblock.hash])
+        self.assertNotIn(invalid.hash, self.bc.blocks)
+        self.assertIndexed(self.bc, True)
+        # blocks on top of the invalid block are dropped as well
+        self.bc.add_block(find_next_block_noabrt(invalid, []))
+        self.assertEqual(self.bc.maxblock.hash, self.sndblock.hash)
+        # the valid part of the fork can still become the main chain
+        self.bc.add_block(self.fork[1])
+        self.bc.add_block(find_next_block_noabrt(self.fork[1], []))
+        self.assertEqual(self.bc.mainchain[2], self.fork[0].hash)
+        self.assertIndexed(self.bc, False)
+
+    def test_persistent_reorg(self):
+        """
+        test if a reorganization is applied to the stored indexes and
+        the main chain is selected again when loading
+        """
+        path = os.path.join(self.dir.name, "blockchain.db")
+        pm = Persistencemanager(path)
+        bc = Blockchain(persistence=pm)
+        for block in [self.fstblock, self.sndblock] + self.fork:
+            bc.add_block(block)
+        pm.commit()
+        self.assertIndexed(bc, False)
+        pm.close()
+        pm = Persistencemanager(path)
+        bc = Blockchain(persistence=pm)
+        self.assertEqual(bc.maxblock.hash, self.fork[1].hash)
+        self.assertIn(self.sndblock.hash, bc.blocks)
+        self.assertIndexed(bc, False)
+        pm.close()
+
+
+class TestPruning(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "blockchain.db")
+        self.pm = Persistencemanager(self.path, segmentsize=1)
+        self.bc = Blockchain(persistence=self.pm, retain_blocks=2)
+        self.wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        self.coinbase_tx = self.wal.gen_coinbase_tx(1)
+        self.chain = [find_next_block_noabrt(genesisblock, [self.coinbase_tx])]
+        self.bc.add_block(self.chain[0])
+        self.tx = self.wal.gen_transfer_tx(1, [self.wal.public_key], [self.coinbase_tx.outputs[0].amount//2], 2)
+        self.chain.append(find_next_block_noabrt(self.chain[0], [self.tx]))
+        self.bc.add_block(self.chain[1])
+        for height in range(3, 6):
+            self.chain.append(find_next_block_noabrt(self.chain[-1], []))
+            self.bc.add_block(self.chain[-1])
+
+    def tearDown(self):
+        self.pm.close()
+        self.dir.cleanup()
+
+    def test_prune(self):
+        """
+        test if only the last blocks are kept in full and the pruned
+        blocks are still found in the indexes
+        """
+        self.assertEqual([block.is_pruned for block in self.bc.iter_forward(1)], [True] * 3 + [False] * 2)
+        self.assertEqual([tx.hash for tx in self.bc.get_transactions(self.bc.get_block_by_height(2))], [self.tx.hash])
+        self.assertEqual(self.wal.get_balance(), self.coinbase_tx.outputs[0].amount - 2)
+        self.assertEqual(self.tx.is_doublespend(blockchain=self.bc), False)
+        decoys = self.bc.get_random_output_by_flavor_and_amnt(OutputCondition.singlesig, self.coinbase_tx.outputs[0].amount, 1)
+        self.assertEqual([decoy.hash for decoy in decoys], [self.coinbase_tx.outputs[0].hash])
+        self.assertRaises(KeyError, self.bc.get_raw_block, self.chain[1].hash)
+        self.assertEqual(bytes(self.bc.get_raw_block(self.chain[4].hash)), self.chain[4].encode())
+        # the segments of the pruned blocks are deleted
+        self.pm.commit()
+        self.assertLess(self.pm.store.size(), sum(len(block.encode()) for block in self.chain))
+
+    def test_restart(self):
+        """
+        test if a pruned node restarts from its pruned blocks
+        """
+        self.pm.close()
+        self.pm = Persistencemanager(self.path, segmentsize=1)
+        bc = Blockchain(persistence=self.pm, retain_blocks=2)
+        self.assertEqual(bc.maxblock.hash, self.chain[-1].hash)
+        self.assertEqual([block.is_pruned for block in bc.iter_forward(1)], [True] * 3 + [False] * 2)
+        self.assertEqual(bc.get_block_by_height(2).txhashes, [self.tx.hash])
+        self.wal.blockchain = bc
+        self.wal.rescan_blockchain()
+        self.assertEqual(self.wal.get_balance(), self.coinbase_tx.outputs[0].amount - 2)
+
+    def test_pruned_reorg(self):
+        """
+        test if a chain which forks below the pruned blocks is not
+        adopted
+        """
+        block = self.chain[0]
+        for height in range(2, 8):
+            block = find_next_block_noabrt(block, [])
+            update = self.bc.add_block(block)
+            self.assertEqual(update.connected, [])
+        self.assertEqual(self.bc.maxblock.hash, self.chain[-1].hash)
+
+    def test_retain_bytes(self):
+        """
+        test if the blocks within the retained bytes are kept
+        """
+        bc = Blockchain(persistence=Mockpersistence(), retain_bytes=len(self.chain[3].encode()) * 2)
+        for block in self.chain:
+            bc.add_block(block)
+        self.assertEqual([block.is_pruned for block in bc.iter_forward(1)], [True] * 3 + [False] * 2)
+
+
+if __name__ == 'main':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+# Set test environment flag
+import koppercoin.config
+koppercoin.config.test = True
+
+import time
+import threading
+import importlib.util
+import multiprocessing
+from koppercoin.tokens import *
+from koppercoin.tokens.wallet import *
+from koppercoin.tokens.workview import Workview
+from koppercoin.network.remoteworker import Remoteworker
+from test_transactions import Mockpersistence
+
+has_twisted = importlib.util.find_spec("twisted") is not None
+
+
+def start_reactor():
+    """Runs the reactor in a background thread, once for all tests."""
+    from twisted.internet import reactor
+    if not reactor.running:
+        threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False}, daemon=True).start()
+        while not reactor.running:
+            time.sleep(0.01)
+    return reactor
+
+
+def wait_for(condition, timeout=60):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+@unittest.skipUnless(has_twisted, "twisted is not installed")
+class TestCoordinator(unittest.TestCase):
+    def setUp(self):
+        from twisted.internet.threads import blockingCallFromThread
+        from koppercoin.network.coordinator import Coordinatorfactory
+        self.call = blockingCallFromThread
+        self.reactor = start_reactor()
+        self.bc = Blockchain(persistence=Mockpersistence())
+        self.wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        self.view = Workview()
+        self.view.publish(Block.from_prevblock(genesisblock, transactions=[self.wal.gen_coinbase_tx(1)]))
+        self.found = []
+        self.factory = Coordinatorfactory(self.view, multiprocessing.Value('Q', 0), self.found.append)
+        self.port = self.call(self.reactor, self.reactor.listenTCP, 0, self.factory, interface='127.0.0.1')
+
+    def tearDown(self):
+        self.call(self.reactor, self.port.stopListening)
+
+    def test_mine(self):
+        """
+        test if remote workers mine the templates of the node and switch
+        to a new tip
+        """
+        workers = [Remoteworker('127.0.0.1', self.port.getHost().port, name) for name in ['a', 'b']]
+        stop = threading.Event()
+        threads = [threading.Thread(target=worker.run, args=(stop,)) for worker in workers]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(wait_for(lambda: len(self.found) > 0))
+        block = self.found[0]
+        self.assertEqual(block.header.has_valid_pow(), True)
+        self.assertEqual(block.prevhash, genesisblock.hash)
+        # the node has a new tip
+        self.view.publish(Block.from_prevblock(block, transactions=[self.wal.gen_coinbase_tx(2)]))
+        self.assertTrue(wait_for(lambda: any(other.prevhash == block.hash for other in self.found)))
+        stop.set()
+        for thread in threads:
+            thread.join(10)
+        self.assertGreaterEqual(sum(self.factory.dispatcher.shares.values()), 2)
+        self.assertEqual(sum(worker.rejected for worker in workers), 0)
+        # each worker searched its own nonce range
+        self.assertGreaterEqual(self.factory.dispatcher.extranonces.value, len(workers))
+
+
+if __name__ == 'main':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+# Set test environment flag
+import koppercoin.config
+koppercoin.config.test = True
+
+import multiprocessing
+from koppercoin.tokens import *
+from koppercoin.tokens.wallet import *
+from koppercoin.tokens import jobs
+from koppercoin.tokens.jobs import Jobdispatcher, Workerstate
+from koppercoin.tokens.workview import Workview
+from test_transactions import Mockpersistence
+
+
+class TestJobdispatcher(unittest.TestCase):
+    def setUp(self):
+        self.bc = Blockchain(persistence=Mockpersistence())
+        self.wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        self.view = Workview()
+        self.view.publish(Block.from_prevblock(genesisblock, transactions=[self.wal.gen_coinbase_tx(1)]))
+        self.found = []
+        self.dispatcher = Jobdispatcher(self.view, multiprocessing.Value('Q', 0), self.found.append)
+
+    def test_reject(self):
+        """
+        test if stale, foreign and duplicate shares are rejected
+        """
+        self.assertEqual(self.dispatcher.update(), True)
+        self.assertEqual(self.dispatcher.update(), False)
+        worker = Workerstate('a')
+        job = self.dispatcher.job(worker)
+        generation = job['generation']
+        nonce = job['extranonce'] << job['rangebits']
+        self.assertEqual(self.dispatcher.check(worker, generation + 2, nonce), (False, 'stale'))
+        self.assertEqual(self.dispatcher.check(worker, generation, nonce + 2**job['rangebits']), (False, 'range'))
+        # the range of a job is not shared with another worker
+        self.assertEqual(self.dispatcher.check(Workerstate('b'), generation, nonce), (False, 'range'))
+        # about one in 2**16 digests is a share
+        (accepted, reason) = self.dispatcher.check(worker, generation, nonce)
+        while not accepted:
+            nonce += 1
+            (accepted, reason) = self.dispatcher.check(worker, generation, nonce)
+        self.assertEqual(len(self.found), 1 if reason == 'block' else 0)
+        self.assertEqual(self.dispatcher.check(worker, generation, nonce), (False, 'duplicate'))
+        self.assertEqual(self.dispatcher.shares['a'], 1)
+
+    def test_bounds(self):
+        """
+        test if a worker gets a bounded number of ranges and its jobs of
+        old templates are forgotten
+        """
+        self.assertEqual(self.dispatcher.job(Workerstate()), None)
+        self.dispatcher.update()
+        worker = Workerstate()
+        for _ in range(jobs._maxranges):
+            self.assertNotEqual(self.dispatcher.job(worker), None)
+        self.assertEqual(self.dispatcher.job(worker), None)
+        self.assertEqual(self.dispatcher.extranonces.value, jobs._maxranges)
+        for _ in range(jobs._keep):
+            self.view.publish(Block.from_prevblock(genesisblock, transactions=[self.wal.gen_coinbase_tx(1)]))
+            self.dispatcher.update()
+            self.assertNotEqual(self.dispatcher.job(worker), None)
+        self.assertEqual(len(self.dispatcher.templates), jobs._keep)
+        self.assertEqual(set(worker.extranonces), set(self.dispatcher.templates))
+
+
+if __name__ == 'main':
+    unittest.main()
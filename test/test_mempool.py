@@ -0,0 +1,165 @@
+import unittest
+# Set test environment flag
+import koppercoin.config
+koppercoin.config.test = True
+
+import os
+import random
+import tempfile
+from koppercoin.tokens import *
+from koppercoin.tokens.wallet import *
+from koppercoin.tokens import mempool as mempoolmodule
+from koppercoin.tokens.mempool import Feeheap
+from koppercoin.tokens.persistence import connect
+from test_transactions import Mockpersistence, find_next_block_noabrt
+
+
+class TestFeeheap(unittest.TestCase):
+    def test_order(self):
+        """
+        test if the heap returns its items ordered by their keys after
+        random pushes and removals
+        """
+        heap = Feeheap()
+        keys = {}
+        for item in range(200):
+            keys[item] = random.random()
+            heap.push(keys[item], item)
+        for item in random.sample(range(200), 100):
+            heap.remove(item)
+            del keys[item]
+        self.assertEqual(heap.smallest(10), sorted(keys, key=keys.get)[:10])
+        self.assertEqual(heap.smallest(1000), sorted(keys, key=keys.get))
+        self.assertEqual(heap.peek(), min(keys, key=keys.get))
+        self.assertRaises(KeyError, heap.remove, 500)
+
+
+class TestMempool(unittest.TestCase):
+    def setUp(self):
+        self.bc = Blockchain(persistence=Mockpersistence())
+        # the transactions of different wallets do not conflict
+        self.wals = [Wallet(persist=False, force_new=True, blockchain=self.bc) for _ in range(3)]
+        self.wal = self.wals[0]
+        block = genesisblock
+        for height, wal in enumerate(self.wals, 1):
+            block = find_next_block_noabrt(block, [wal.gen_coinbase_tx(height)])
+            self.bc.add_block(block)
+        self.amount = block.transactions[0].outputs[0].amount // 2
+        self.txs = [wal.gen_transfer_tx(1, [wal.public_key], [self.amount], fee)
+                    for wal, fee in zip(self.wals, [300, 100, 200])]
+
+    def test_fee_order(self):
+        """
+        test if the transactions with the highest fee rates are returned
+        first
+        """
+        mempool = Mempool(persistencemanager=Mockpersistence(), allowload=False)
+        mempool.add_many(self.txs)
+        self.assertEqual(mempool.get_txs_with_max_fee(2), [self.txs[0], self.txs[2]])
+        self.assertEqual(mempool.get_tx_with_max_fee(), self.txs[0])
+        mempool.remove(self.txs[0])
+        self.assertEqual(mempool.get_txs_with_max_fee(5), [self.txs[2], self.txs[1]])
+        self.assertEqual(mempool.size, sum(len(tx.encode()) for tx in self.txs[1:]))
+        self.assertEqual(self.txs[0].fee, 300)
+
+    def test_eviction(self):
+        """
+        test if the transactions with the lowest fee rates are evicted
+        when the pool is full
+        """
+        maxsize = sum(len(tx.encode()) for tx in self.txs[:2])
+        mempool = Mempool(persistencemanager=Mockpersistence(), allowload=False, maxsize=maxsize)
+        self.assertEqual(mempool.add(self.txs[0]), True)
+        self.assertEqual(mempool.add(self.txs[1]), True)
+        self.assertEqual(mempool.add(self.txs[2]), True)
+        self.assertEqual(mempool.pool, {self.txs[0], self.txs[2]})
+        self.assertEqual(mempool.add(self.txs[1]), False)
+        self.assertEqual(len(mempool), 2)
+
+    def test_expiry(self):
+        """
+        test if transactions are dropped after the expiry time
+        """
+        mempool = Mempool(persistencemanager=Mockpersistence(), allowload=False, expiry=60)
+        mempool._add(self.txs[0], now=1000)
+        mempool._add(self.txs[1], now=1030)
+        self.assertEqual(mempool.expire(now=1059), 0)
+        self.assertEqual(mempool.expire(now=1060), 1)
+        self.assertEqual(mempool.pool, {self.txs[1]})
+        mempool._add(self.txs[2], now=1100)
+        self.assertEqual(mempool.pool, {self.txs[2]})
+
+    def test_conflicts(self):
+        """
+        test if a transaction which uses a keyimage of the pool is not
+        added
+        """
+        mempool = Mempool(persistencemanager=Mockpersistence(), allowload=False)
+        conflicting = self.wal.gen_transfer_tx(1, [self.wal.public_key], [self.amount], 400)
+        self.assertEqual(mempool.add(self.txs[0]), True)
+        self.assertEqual(mempool.add(conflicting), False)
+        self.assertEqual(mempool.pool, {self.txs[0]})
+        self.assertIs(mempool.get_transaction_by_keyimage(self.txs[0].keyimages[0]), self.txs[0])
+
+    def test_update_chain(self):
+        """
+        test if the transactions of disconnected blocks are pending
+        again and the ones spent by connected blocks are removed
+        """
+        mempool = Mempool(persistencemanager=Mockpersistence(), allowload=False)
+        oldblock = Block.from_prevblock(genesisblock, transactions=[self.txs[0], self.wal.gen_coinbase_tx(1)])
+        mempool.update_chain(Blockchain.Chainupdate(disconnected=[oldblock], connected=[]), blockchain=self.bc)
+        self.assertEqual(mempool.pool, {self.txs[0]})
+        # the new chain spends the same keyimage
+        conflicting = self.wal.gen_transfer_tx(1, [self.wal.public_key], [self.amount], 400)
+        newblock = Block.from_prevblock(genesisblock, transactions=[conflicting])
+        mempool.update_chain(Blockchain.Chainupdate(disconnected=[], connected=[newblock]), blockchain=self.bc)
+        self.assertEqual(len(mempool), 0)
+
+    def test_reorganization(self):
+        """
+        test if the transactions which spend outputs of the old chain
+        are evicted after a reorganization and a block mined on them
+        is dropped
+        """
+        mempool = Mempool(persistencemanager=Mockpersistence(), allowload=False)
+        mempool.add_many(self.txs)
+        # a longer chain without the coinbase of the last wallet
+        block = self.bc.get_block_by_height(2)
+        for height in (3, 4):
+            block = find_next_block_noabrt(block, [self.wal.gen_coinbase_tx(height)])
+            update = self.bc.add_block(block)
+        self.assertEqual(len(update.disconnected), 1)
+        mempool.update_chain(update, blockchain=self.bc)
+        self.assertEqual(mempool.pool, {self.txs[0], self.txs[1]})
+        miningmanager = Miningmanager(mempool, self.bc, self.wal)
+        invalid = find_next_block_noabrt(block, [self.txs[2], self.wal.gen_coinbase_tx(5, fees=self.txs[2].fee)])
+        self.assertEqual(miningmanager.submit_block(invalid), False)
+        self.assertNotIn(invalid.hash, self.bc.blocks)
+        self.assertEqual(self.bc.maxblock.hash, block.hash)
+
+    def test_load_json(self):
+        """
+        test if the json transactions of an older version are dropped
+        when the mempool is loaded
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mempool.db")
+            conn = connect(path)
+            with conn:
+                conn.execute("CREATE TABLE transactions (hash text, content text)")
+                conn.execute("INSERT INTO transactions VALUES (?, ?)", (self.txs[1].hash, self.txs[1].json()))
+            conn.close()
+            pm = mempoolmodule.Persistencemanager(path)
+            pm.save(self.txs[0])
+            pm.commit()
+            mempool = Mempool(persistencemanager=pm)
+            self.assertEqual([tx.hash for tx in mempool.pool], [self.txs[0].hash])
+            pm.commit()
+            with pm.readers.connection() as conn:
+                self.assertEqual(conn.execute("SELECT hash FROM transactions").fetchall(), [(self.txs[0].hash,)])
+            pm.close()
+
+
+if __name__ == 'main':
+    unittest.main()
@@ -0,0 +1,282 @@
+import unittest
+# Set test environment flag
+import koppercoin.config
+koppercoin.config.test = True
+
+import os
+import json
+import zlib
+import tempfile
+from koppercoin.tokens import *
+from koppercoin.tokens import Persistencemanager
+from koppercoin.tokens.wallet import *
+from koppercoin.tokens import model
+from koppercoin.tokens import blockstore
+from koppercoin.tokens.blockstore import Blockstore
+from test_transactions import Mockpersistence, find_next_block_noabrt
+
+
+class TestPersistence(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "blockchain.db")
+        self.bc = Blockchain(persistence=Persistencemanager(self.path))
+        wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        self.chain = []
+        block = genesisblock
+        for height in range(1, 4):
+            block = find_next_block_noabrt(block, [wal.gen_coinbase_tx(height)])
+            self.bc.add_block(block)
+            self.chain.append(block)
+        # a block of a shorter fork
+        self.fork = find_next_block_noabrt(self.chain[0], [wal.gen_coinbase_tx(2)])
+        self.bc.add_block(self.fork)
+        self.bc.pm.commit()
+
+    def tearDown(self):
+        self.bc.pm.close()
+        self.dir.cleanup()
+
+    def test_load(self):
+        """
+        test if the chain with the most work is loaded
+        """
+        pm = Persistencemanager(self.path)
+        bc = Blockchain(persistence=pm)
+        self.assertEqual(bc.maxblock, self.bc.maxblock)
+        self.assertEqual([block.hash for block in bc], [block.hash for block in reversed(self.chain)] + [genesisblock.hash])
+        self.assertIn(self.fork.hash, bc.blocks)
+        coinbase = self.chain[1].transactions[0]
+        self.assertEqual(bc.get_transaction_by_hash(coinbase.hash).hash, coinbase.hash)
+        # the loaded blocks are not saved again
+        pm.commit()
+        self.assertEqual(len(pm.store), 4)
+        pm.close()
+
+    def test_indexes(self):
+        """
+        test if the indexes are stored and the transactions of indexed
+        blocks are not decoded when loading
+        """
+        bc = Blockchain(persistence=Persistencemanager(self.path))
+        self.assertEqual([bc.blocks[block.hash].is_decoded for block in self.chain], [False] * 3)
+        coinbase = self.chain[2].transactions[0]
+        self.assertEqual(bc.get_transaction_by_hash(coinbase.hash).hash, coinbase.hash)
+        self.assertEqual(bc.get_output_by_hash(coinbase.outputs[0].hash).hash, coinbase.outputs[0].hash)
+        self.assertRaises(KeyError, bc.get_output_by_hash, coinbase.hash)
+        # the coinbase of the fork is not in the main chain
+        self.assertEqual(len(bc.transactions), 3)
+
+
+    def test_write_behind(self):
+        """
+        test if writes are committed in the background and can be read
+        before
+        """
+        pm = Persistencemanager(os.path.join(self.dir.name, "other.db"), blockdir=os.path.join(self.dir.name, "other"),
+                                flushsize=10**6, flushinterval=60)
+        bc = Blockchain(persistence=pm)
+        block = self.chain[0]
+        bc.add_block(block)
+        coinbase = block.transactions[0]
+        self.assertEqual(bc.get_output_by_hash(coinbase.outputs[0].hash).hash, coinbase.outputs[0].hash)
+        with pm.readers.connection() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM idx_outputs").fetchone()[0], 0)
+        pm.commit()
+        with pm.readers.connection() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM idx_outputs").fetchone()[0], 1)
+        self.assertEqual(len(pm.store), 1)
+        self.assertEqual(bc.outputs.pending, {})
+        self.assertEqual(bc.get_transaction_by_hash(coinbase.hash).hash, coinbase.hash)
+        pm.close()
+
+    def test_failed_write(self):
+        """
+        test if writes are counted once and stay pending if their
+        commit fails
+        """
+        path = os.path.join(self.dir.name, "other.db")
+        pm = Persistencemanager(path, blockdir=os.path.join(self.dir.name, "other"),
+                                flushsize=10**6, flushinterval=60)
+        bc = Blockchain(persistence=pm)
+        bc.add_block(self.chain[0])
+        pm.commit()
+        # a pending write of a committed output
+        bc.indexes.add_outputs(self.chain[0].transactions[0].outputs)
+        self.assertEqual(len(bc.outputs), 1)
+        pm.commit()
+        conn = connect(path)
+        with conn:
+            conn.execute("DROP TABLE idx_decoys")
+        conn.close()
+        bc.add_block(self.chain[1])
+        pm.commit()
+        output = self.chain[1].transactions[0].outputs[0]
+        self.assertIn(output.hash, bc.outputs.pending)
+        self.assertNotIn(output.hash, bc.outputs.cache)
+        self.assertEqual(bc.get_output_by_hash(output.hash).hash, output.hash)
+        self.assertEqual(len(bc.outputs), 2)
+        pm.close()
+
+    def test_headers_in_memory(self):
+        """
+        test if only the headers of the stored blocks are kept in
+        memory and the blocks are read from the store
+        """
+        for block in self.chain + [self.fork]:
+            self.assertIsInstance(self.bc.blocks.entries[block.hash], BlockHeader)
+        self.assertIs(self.bc.blocks.entries[genesisblock.hash], genesisblock)
+        self.assertEqual(self.bc.current_block.hash, self.chain[-1].hash)
+        block = self.bc.get_block_by_height(2)
+        self.assertEqual(block.is_decoded, False)
+        self.assertEqual(block.transactions[0].hash, self.chain[1].transactions[0].hash)
+
+    def test_get_many(self):
+        """
+        test if the outputs are read in their order with pending,
+        cached and committed ones
+        """
+        outputs = [block.transactions[0].outputs[0] for block in self.chain]
+        hashes = [output.hash for output in outputs]
+        self.bc.outputs.cache.clear()
+        self.bc.get_output_by_hash(hashes[1])
+        self.bc.indexes.add_outputs([self.fork.transactions[0].outputs[0]])
+        hashes = [hashes[2], self.fork.transactions[0].outputs[0].hash, hashes[1], hashes[0]]
+        self.assertEqual([output.hash for output in self.bc.get_outputs_by_hashes(hashes)], hashes)
+        self.assertRaises(KeyError, self.bc.get_outputs_by_hashes, hashes + [self.fork.hash])
+
+    def test_raw_block(self):
+        """
+        test if the raw encoding of a block is read from the segments
+        """
+        block = self.chain[1]
+        self.assertEqual(bytes(self.bc.get_raw_block(block.hash)), block.encode())
+        self.assertEqual(bytes(self.bc.get_raw_block(genesisblock.hash)), genesisblock.encode())
+        self.assertEqual(LazyBlock.decode(self.bc.pm.raw_block(block.hash)).hash, block.hash)
+        self.assertRaises(KeyError, self.bc.pm.raw_block, genesisblock.hash)
+
+
+class TestBlockstore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.blockdir = os.path.join(self.dir.name, "blocks")
+        wal = Wallet(persist=False, force_new=True, blockchain=Blockchain(persistence=Mockpersistence()))
+        self.chain = []
+        block = genesisblock
+        for height in range(1, 4):
+            block = find_next_block_noabrt(block, [wal.gen_coinbase_tx(height)])
+            self.chain.append(block)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_segments(self):
+        """
+        test if blocks are appended to new segments and read again
+        """
+        store = Blockstore(self.blockdir, segmentsize=1)
+        for block in self.chain + self.chain:
+            store.append(block)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(sorted(os.listdir(self.blockdir))[:3], ["blk00000.dat", "blk00001.dat", "blk00002.dat"])
+        self.assertEqual([block.hash for block in store.iter_blocks()], [block.hash for block in self.chain])
+        self.assertEqual(store.get_block(self.chain[1].hash).hash, self.chain[1].hash)
+        self.assertRaises(KeyError, store.get_raw, genesisblock.hash)
+        store.close()
+
+    def test_recovery(self):
+        """
+        test if records missing in the index are indexed again and an
+        incomplete record is truncated
+        """
+        store = Blockstore(self.blockdir)
+        store.append(self.chain[0])
+        store.close()
+        segment = os.path.join(self.blockdir, "blk00000.dat")
+        size = os.path.getsize(segment)
+        # a record which was written but not indexed and a torn record
+        with open(segment, 'ab') as f:
+            raw = self.chain[1].encode()
+            f.write(blockstore._recordheader.pack(blockstore.MAGIC, len(raw), zlib.crc32(raw)) + raw)
+            f.write(blockstore.MAGIC + b'\x00\x01')
+        store = Blockstore(self.blockdir)
+        self.assertIn(self.chain[1].hash, store)
+        self.assertEqual(os.path.getsize(segment), size + blockstore._recordheader.size + len(raw))
+        store.append(self.chain[2])
+        self.assertEqual([block.hash for block in store.iter_blocks()], [block.hash for block in self.chain])
+        store.close()
+
+    def test_prune(self):
+        """
+        test if a segment is only pruned when all its blocks are below
+        the height, also after the store is opened again
+        """
+        store = Blockstore(self.blockdir, segmentsize=1)
+        for block in self.chain:
+            store.append(block)
+        self.assertEqual(store.prune(1), 0)
+        store.close()
+        store = Blockstore(self.blockdir, segmentsize=1)
+        self.assertEqual(store.heights, {0: 1, 1: 2, 2: 3})
+        self.assertEqual(store.prune(3), 2)
+        self.assertEqual(store.is_pruned(self.chain[1].hash), True)
+        self.assertEqual(store.is_pruned(self.chain[2].hash), False)
+        self.assertEqual(store.prune(3), 0)
+        store.close()
+        # the segments of the PrunedBlocks are not pruned again
+        store = Blockstore(self.blockdir, segmentsize=1)
+        self.assertEqual(store.prune(3), 0)
+        self.assertEqual(store.prune(3), 0)
+        self.assertEqual(store.get_block(self.chain[0].hash).hash, self.chain[0].hash)
+        store.close()
+
+    def test_migrate(self):
+        """
+        test if the blocks table of an old database is migrated
+        """
+        path = os.path.join(self.dir.name, "blockchain.db")
+        conn = connect(path)
+        with conn:
+            conn.execute("CREATE TABLE blocks (height integer, hash text, content blob)")
+            conn.executemany("INSERT INTO blocks VALUES (?, ?, ?)",
+                             [(block.blockheight, block.hash, block.encode()) for block in self.chain])
+        conn.close()
+        pm = Persistencemanager(path, blockdir=self.blockdir)
+        bc = Blockchain(persistence=pm)
+        self.assertEqual(bc.maxblock.hash, self.chain[-1].hash)
+        self.assertEqual(len(pm.store), 3)
+        pm.close()
+
+    def test_migrate_json(self):
+        """
+        test if the json blocks of the first versions are moved aside,
+        so the node starts with an empty blockchain
+        """
+        path = os.path.join(self.dir.name, "blockchain.db")
+        # the rows of the first versions, chained by the hashes of the json
+        rows = []
+        prevhash = model.hash(genesisblock.json())
+        for block in self.chain:
+            legacy = dict(block.serialize(), prevhash=prevhash)
+            content = json.dumps(legacy, sort_keys=True)
+            prevhash = model.hash(content)
+            rows.append((block.blockheight, prevhash, content))
+        conn = connect(path)
+        with conn:
+            conn.execute("CREATE TABLE blocks (height integer, hash text, content text)")
+            conn.executemany("INSERT INTO blocks VALUES (?, ?, ?)", rows)
+        conn.close()
+        pm = Persistencemanager(path, blockdir=self.blockdir)
+        bc = Blockchain(persistence=pm)
+        self.assertEqual(bc.maxblock.hash, genesisblock.hash)
+        self.assertEqual(len(pm.store), 0)
+        with pm.readers.connection() as conn:
+            self.assertEqual(conn.execute("SELECT * FROM blocks_json").fetchall(), rows)
+        pm.close()
+        # the next start finds no blocks table
+        store = Blockstore(self.blockdir)
+        self.assertEqual(migrate(path, store), 0)
+        store.close()
+
+if __name__ == 'main':
+    unittest.main()
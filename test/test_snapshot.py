@@ -0,0 +1,104 @@
+import unittest
+# Set test environment flag
+import koppercoin.config
+koppercoin.config.test = True
+
+import os
+import tempfile
+from koppercoin.tokens import *
+from koppercoin.tokens import Persistencemanager
+from koppercoin.tokens.wallet import *
+from koppercoin.tokens import snapshot
+from koppercoin.tokens.snapshot import SnapshotError
+from test_transactions import Mockpersistence, find_next_block_noabrt
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.pm = Persistencemanager(os.path.join(self.dir.name, "blockchain.db"))
+        self.bc = Blockchain(persistence=self.pm)
+        self.wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        self.coinbase_tx = self.wal.gen_coinbase_tx(1)
+        self.fstblock = find_next_block_noabrt(genesisblock, [self.coinbase_tx])
+        self.bc.add_block(self.fstblock)
+        self.tx = self.wal.gen_transfer_tx(1, [self.wal.public_key], [self.coinbase_tx.outputs[0].amount//2], 2)
+        self.sndblock = find_next_block_noabrt(self.fstblock, [self.tx])
+        self.bc.add_block(self.sndblock)
+        self.trdblock = find_next_block_noabrt(self.sndblock, [self.wal.gen_coinbase_tx(3)])
+        self.bc.add_block(self.trdblock)
+        self.path = os.path.join(self.dir.name, "snapshot.kcs")
+        self.hash = snapshot.create(self.bc, self.path, 2)
+
+    def tearDown(self):
+        self.pm.close()
+        self.dir.cleanup()
+
+    def test_canonical(self):
+        """
+        test if the snapshot does not depend on the indexes and on the
+        blocks above its height
+        """
+        bc = Blockchain(persistence=Mockpersistence())
+        bc.add_block(self.fstblock)
+        bc.add_block(self.sndblock)
+        self.assertEqual(snapshot.create(bc, os.path.join(self.dir.name, "other.kcs")), self.hash)
+        self.assertEqual(snapshot.verify(self.path), self.hash)
+
+    def test_load(self):
+        """
+        test if a node started from a snapshot knows the outputs and
+        keyimages and validates the following blocks
+        """
+        bc = Blockchain(persistence=Mockpersistence())
+        self.assertEqual(snapshot.load(bc, self.path, self.hash), 2)
+        self.assertEqual(bc.maxblock.hash, self.sndblock.hash)
+        self.assertEqual(bc.get_block_by_height(1).is_pruned, True)
+        self.assertRaises(KeyError, bc.get_raw_block, self.fstblock.hash)
+        self.assertEqual(bc.get_output_by_hash(self.tx.outputs[0].hash).hash, self.tx.outputs[0].hash)
+        self.assertEqual(self.trdblock.transactions[0].outputs[0].hash in bc.outputs, False)
+        # the keyimage is spent before the snapshot
+        self.assertEqual(self.tx.is_doublespend(blockchain=bc), False)
+        conflict = Transaction.gen_regular(inputs=self.tx.inputs, outputs=self.tx.outputs[:1], pubkey=self.tx.pubkey)
+        self.assertEqual(conflict.is_doublespend(blockchain=bc), True)
+        self.assertEqual(self.trdblock.is_valid(blockchain=bc), True)
+        bc.add_block(self.trdblock)
+        self.assertEqual(bc.maxblock.hash, self.trdblock.hash)
+        self.assertRaises(SnapshotError, snapshot.load, bc, self.path, self.hash)
+
+    def test_restart(self):
+        """
+        test if a node started from a snapshot keeps its state
+        """
+        path = os.path.join(self.dir.name, "other.db")
+        pm = Persistencemanager(path, blockdir=os.path.join(self.dir.name, "other"))
+        snapshot.load(Blockchain(persistence=pm), self.path, self.hash)
+        pm.close()
+        pm = Persistencemanager(path, blockdir=os.path.join(self.dir.name, "other"))
+        bc = Blockchain(persistence=pm)
+        self.assertEqual(bc.maxblock.hash, self.sndblock.hash)
+        self.assertEqual(bc.blocks[self.fstblock.hash].is_pruned, True)
+        self.assertEqual(bc.get_transaction_by_keyimage(self.tx.keyimages[0]).hash, self.tx.hash)
+        decoys = bc.get_random_output_by_flavor_and_amnt(OutputCondition.singlesig, self.coinbase_tx.outputs[0].amount, 1)
+        self.assertEqual([decoy.hash for decoy in decoys], [self.coinbase_tx.outputs[0].hash])
+        pm.close()
+
+    def test_commitment(self):
+        """
+        test if damaged snapshots and snapshots which do not match the
+        commitment are rejected
+        """
+        bc = Blockchain(persistence=Mockpersistence())
+        self.assertRaises(SnapshotError, snapshot.load, bc, self.path, "00" * 64)
+        with open(self.path, 'r+b') as f:
+            f.seek(20)
+            byte = f.read(1)
+            f.seek(20)
+            f.write(bytes([byte[0] ^ 1]))
+        self.assertRaises(SnapshotError, snapshot.verify, self.path)
+        self.assertRaises(SnapshotError, snapshot.load, bc, self.path, self.hash)
+        self.assertEqual(len(bc.mainchain), 1)
+
+
+if __name__ == 'main':
+    unittest.main()
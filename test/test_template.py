@@ -0,0 +1,92 @@
+import unittest
+# Set test environment flag
+import koppercoin.config
+koppercoin.config.test = True
+
+from koppercoin.tokens import *
+from koppercoin.tokens.wallet import *
+from koppercoin.tokens import parameters
+from koppercoin.tokens.template import Templatebuilder
+from test_transactions import Mockpersistence, find_next_block_noabrt
+
+
+class TestTemplatebuilder(unittest.TestCase):
+    def setUp(self):
+        self.bc = Blockchain(persistence=Mockpersistence())
+        self.wallets = [Wallet(persist=False, force_new=True, blockchain=self.bc) for i in range(3)]
+        block = genesisblock
+        for (height, wal) in enumerate(self.wallets, 1):
+            block = find_next_block_noabrt(block, [wal.gen_coinbase_tx(height)])
+            self.bc.add_block(block)
+        self.amount = parameters.mining_reward_per_blockheight(1) // 2
+        # a and conflicting spend the same output
+        (self.a, self.b, self.c) = [wal.gen_transfer_tx(1, [wal.public_key], [self.amount], fee)
+                                    for (wal, fee) in zip(self.wallets, [500, 300, 200])]
+        self.conflicting = self.wallets[0].gen_transfer_tx(1, [self.wallets[0].public_key], [self.amount], 100)
+        self.mempool = Mempool(persistencemanager=Mockpersistence(), allowload=False)
+
+    def test_build(self):
+        """
+        test if the transactions with the highest fee rates are packed
+        without conflicts and the coinbase receives their fees
+        """
+        self.mempool.add_many([self.conflicting, self.c, self.a, self.b])
+        builder = Templatebuilder(self.mempool, self.wallets[0])
+        block = builder.build(self.bc.current_block)
+        self.assertEqual(block.transactions[:-1], [self.a, self.b, self.c])
+        coinbase = block.transactions[-1]
+        self.assertEqual(coinbase.outputs[0].amount, parameters.mining_reward_per_blockheight(4) + 1000)
+        self.assertEqual(block.is_valid(blockchain=self.bc), True)
+
+    def test_size_limit(self):
+        """
+        test if the template does not exceed the maximal block size
+        """
+        self.mempool.add_many([self.a, self.b, self.c])
+        full = Templatebuilder(self.mempool, self.wallets[0]).build(self.bc.current_block)
+        maxsize = len(full.encode()) - 1
+        block = Templatebuilder(self.mempool, self.wallets[0], maxsize=maxsize).build(self.bc.current_block)
+        self.assertEqual(block.transactions[:-1], [self.a, self.b])
+        self.assertLessEqual(len(block.encode()), maxsize)
+
+    def test_stop(self):
+        """
+        test if the mempool is only walked until not even its smallest
+        transaction fits
+        """
+        self.mempool.add_many([self.a, self.b, self.c])
+        self.assertEqual(self.mempool.min_txsize(), min(len(tx.encode()) for tx in [self.a, self.b, self.c]))
+        empty = Templatebuilder(self.mempool, self.wallets[0], maxsize=0).build(self.bc.current_block)
+        maxsize = len(empty.encode()) + len(self.a.encode()) + 64
+        walked = []
+        iter_by_feerate = self.mempool.iter_by_feerate
+        self.mempool.iter_by_feerate = lambda: (walked.append(tx) or tx for tx in iter_by_feerate())
+        block = Templatebuilder(self.mempool, self.wallets[0], maxsize=maxsize).build(self.bc.current_block)
+        self.assertEqual(block.transactions[:-1], [self.a])
+        self.assertEqual(walked, [self.a, self.b])
+
+    def test_incremental(self):
+        """
+        test if arriving transactions are added to the template or
+        replace the ones with lower fee rates
+        """
+        builder = Templatebuilder(self.mempool, self.wallets[0])
+        builder.build(self.bc.current_block)
+        generation = builder.generation
+        self.assertEqual(builder.add_transaction(self.conflicting), True)
+        self.assertEqual(builder.add_transaction(self.a), False)
+        self.assertEqual(builder.generation, generation + 1)
+        # only one transaction fits
+        maxsize = len(builder.block().encode()) + 64
+        builder = Templatebuilder(self.mempool, self.wallets[0], maxsize=maxsize)
+        builder.build(self.bc.current_block)
+        self.assertEqual(builder.add_transaction(self.c), True)
+        self.assertEqual(builder.add_transaction(self.b), True)
+        self.assertEqual(builder.block().transactions[:-1], [self.b])
+        self.assertEqual(builder.add_transaction(self.c), False)
+        self.assertEqual(builder.block().transactions[-1].outputs[0].amount,
+                         parameters.mining_reward_per_blockheight(4) + 300)
+
+
+if __name__ == 'main':
+    unittest.main()
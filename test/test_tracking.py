@@ -0,0 +1,156 @@
+import unittest
+# Set test environment flag
+import koppercoin.config
+koppercoin.config.test = True
+
+import importlib.util
+from unittest import mock
+from koppercoin.tokens import *
+from koppercoin.tokens.wallet import *
+from koppercoin.tokens.tracking import Trackingsubscription
+from test_transactions import Mockpersistence, find_next_block_noabrt
+
+has_twisted = importlib.util.find_spec("twisted") is not None
+
+
+class TestTracking(unittest.TestCase):
+    def setUp(self):
+        self.bc = Blockchain(persistence=Mockpersistence())
+        self.wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        self.other = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        self.coinbase_tx = self.wal.gen_coinbase_tx(1)
+        self.other_coinbase_tx = self.other.gen_coinbase_tx(2)
+        self.fstblock = find_next_block_noabrt(genesisblock, [self.coinbase_tx])
+        self.sndblock = find_next_block_noabrt(self.fstblock, [self.other_coinbase_tx])
+        self.bc.add_block(self.fstblock)
+        self.bc.add_block(self.sndblock)
+        self.subscription = Trackingsubscription(self.wal.trackingkey)
+
+    def test_scan_block(self):
+        """
+        test if only the outputs of the tracked wallet are found
+        """
+        entries = self.subscription.scan_block(self.fstblock)
+        self.assertEqual(entries, [(self.coinbase_tx.hash, self.coinbase_tx.pubkey, self.coinbase_tx.outputs)])
+        self.assertEqual(self.subscription.scan_block(self.sndblock), [])
+
+    def test_catch_up(self):
+        """
+        test if catching up respects the starting height
+        """
+        results = self.subscription.catch_up(self.bc, 1)
+        self.assertEqual([block for block, _ in results], [self.fstblock])
+        self.assertEqual(self.subscription.catch_up(self.bc, 2), [])
+
+    def test_scan_blocks(self):
+        """
+        test if blocks without matches are left out
+        """
+        results = self.subscription.scan_blocks([self.fstblock, self.sndblock])
+        self.assertEqual([block for block, _ in results], [self.fstblock])
+
+
+class Fakefactory():
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.trackers = set()
+        self.trackedoutputs = []
+
+
+class Fakeprotocol():
+    def __init__(self, factory):
+        self.factory = factory
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+@unittest.skipUnless(has_twisted, "twisted is not installed")
+class TestTrackingmixin(unittest.TestCase):
+    def setUp(self):
+        from twisted.internet.defer import Deferred
+        from koppercoin.network.p2p import Tracking
+        self.bc = Blockchain(persistence=Mockpersistence())
+        self.wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        self.fstblock = find_next_block_noabrt(genesisblock, [self.wal.gen_coinbase_tx(1)])
+        self.sndblock = find_next_block_noabrt(self.fstblock, [self.wal.gen_coinbase_tx(2)])
+        self.bc.add_block(self.fstblock)
+        self.server = Tracking(Fakeprotocol(Fakefactory(self.bc)))
+        self.client = Tracking(Fakeprotocol(Fakefactory(self.bc)))
+        # the scans are run when the test fires their deferreds
+        self.scans = []
+
+        def defer_to_thread(function, *args):
+            d = Deferred()
+            self.scans.append((d, function, args))
+            return d
+        patcher = mock.patch('koppercoin.network.p2p.deferToThread', defer_to_thread)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_scan(self, index):
+        (d, function, args) = self.scans[index]
+        d.callback(function(*args))
+
+    def test_order(self):
+        """
+        test if the matches of new blocks are pushed after the ones of
+        the catch-up, and only once
+        """
+        self.server.handle_subscribe({'trackingkey': list(self.wal.trackingkey), 'fromheight': 1})
+        self.server.push_block(self.sndblock)
+        self.server.push_block(self.fstblock)
+        # the pushes wait for the catch-up
+        self.assertEqual(len(self.scans), 1)
+        self.run_scan(0)
+        self.run_scan(1)
+        self.run_scan(2)
+        heights = [msg['matches']['blockheight'] for msg in self.server.protocol.sent]
+        self.assertEqual(heights, [1, 2])
+
+    def test_unsubscribed(self):
+        """
+        test if a light client ignores outputs of peers it did not
+        subscribe at
+        """
+        self.server.handle_subscribe({'trackingkey': list(self.wal.trackingkey), 'fromheight': 1})
+        self.run_scan(0)
+        msg = self.server.protocol.sent[0]
+        self.client.handle_trackedoutputs(msg)
+        self.assertEqual(self.client.factory.trackedoutputs, [])
+        self.client.send_subscribe(self.wal.trackingkey)
+        self.client.handle_trackedoutputs(msg)
+        self.assertEqual(len(self.client.factory.trackedoutputs), 1)
+        # no pushes after unsubscribing
+        self.server.handle_unsubscribe({})
+        self.server.push_block(self.sndblock)
+        self.assertEqual(len(self.scans), 1)
+
+    def test_retraction(self):
+        """
+        test if the outputs of a block which left the main chain are
+        retracted after its matches are pushed
+        """
+        self.client.send_subscribe(self.wal.trackingkey)
+        self.server.handle_subscribe({'trackingkey': list(self.wal.trackingkey), 'fromheight': 1})
+        self.server.push_block(self.sndblock)
+        self.server.retract_block(self.sndblock)
+        self.run_scan(0)
+        self.run_scan(1)
+        # a block whose matches were not pushed is not retracted
+        self.server.retract_block(self.sndblock)
+        msgtypes = [msg['msgtype'] for msg in self.server.protocol.sent]
+        self.assertEqual(msgtypes, ['trackedoutputs', 'trackedoutputs', 'retractedoutputs'])
+        for msg in self.server.protocol.sent:
+            self.client.msgtypes[msg['msgtype']](msg)
+        self.assertEqual([(height, output.hash) for (height, _, output) in self.client.factory.trackedoutputs],
+                         [(1, self.fstblock.transactions[0].outputs[0].hash)])
+        # the block is pushed again if it joins the main chain again
+        self.server.push_block(self.sndblock)
+        self.run_scan(2)
+        self.assertEqual(len(self.server.protocol.sent), 4)
+
+
+if __name__ == 'main':
+    unittest.main()
@@ -5,8 +5,10 @@ koppercoin.config.test = True
 
 from koppercoin.tokens import *
 from koppercoin.tokens.wallet import *
+from koppercoin.tokens.sigcache import Signaturecache
 from koppercoin.crypto import onetime_keys, lww_signature
 import json
+from unittest import mock
 
 class Mockpersistence():
     def __init__(self):
@@ -18,6 +20,9 @@ class Mockpersistence():
     def save(self, object):
         pass
 
+    def remove(self, object):
+        pass
+
     def commit(self):
         pass
 
@@ -46,6 +51,22 @@ def find_next_block_noabrt(block, transactions):
     return possible_block
 
 
+def mine(block, transactions):
+    """Mines a next block which satisfies the proof of work."""
+    import hashlib
+    from koppercoin.tokens import mining
+    possible_block = Block.from_prevblock(prevblock=block, transactions=transactions)
+    prefix_hash = hashlib.sha512(possible_block.header.pow_prefix())
+    target = mining.pow_target(possible_block.target)
+    start = 0
+    while True:
+        nonce = mining.search_nonces(prefix_hash, target, start, start + mining._batchsize)
+        if nonce is not None:
+            possible_block.nonce = nonce
+            return possible_block
+        start += mining._batchsize
+
+
 class TestCoinbaseTransactions(unittest.TestCase):
     def setUp(self):
         # get a wallet
@@ -95,6 +116,85 @@ class TestBlocks(unittest.TestCase):
         self.assertEquals(self.sndblock.is_valid(validate_transactions=False, blockchain = self.bc), True)
         self.assertEquals(self.sndblock.is_valid(validate_transactions=True, blockchain = self.bc), True)
 
+    def test_header_hash(self):
+        """
+        test that the hash of a block is the hash of its header, which
+        commits to the transactions via the merkle root
+        """
+        wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        block = Block.from_prevblock(self.sndblock, transactions=[wal.gen_coinbase_tx(2)])
+        self.assertEqual(block.hash, block.header.hash)
+        self.assertEqual(block.merkleroot, block.transactions[0].hash)
+        oldhash = block.hash
+        block.nonce = 1
+        self.assertNotEqual(block.hash, oldhash)
+        oldhash = block.hash
+        block.transactions = [wal.gen_coinbase_tx(2)]
+        self.assertNotEqual(block.hash, oldhash)
+        self.assertEqual(Block.from_json(block.json()).hash, block.hash)
+        self.assertEqual(Block.decode(block.encode()).hash, block.hash)
+
+    def test_lazy_block(self):
+        """
+        test if a lazy block only decodes its transactions on demand
+        """
+        wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        block = Block.from_prevblock(self.sndblock, transactions=[wal.gen_coinbase_tx(2), wal.gen_coinbase_tx(3)])
+        lazy = LazyBlock.decode(block.encode())
+        self.assertEqual(lazy.hash, block.hash)
+        self.assertEqual(lazy.encode(), block.encode())
+        self.assertEqual([tx.hash for tx in lazy.iter_transactions()], [tx.hash for tx in block.transactions])
+        self.assertEqual(lazy.is_decoded, False)
+        self.assertEqual([tx.hash for tx in lazy.transactions], [tx.hash for tx in block.transactions])
+        self.assertEqual(lazy.is_decoded, True)
+        self.assertEqual(lazy.hash, block.hash)
+
+    def test_decode_errors(self):
+        """
+        test if malformed encodings are rejected
+        """
+        from koppercoin.tokens.codec import DecodeError
+        data = self.sndblock.encode()
+        self.assertRaises(DecodeError, Block.decode, data[:-1])
+        self.assertRaises(DecodeError, Block.decode, data + b'\x00')
+        self.assertRaises(DecodeError, Block.decode, b'\xff' + data[1:])
+
+
+class TestMining(unittest.TestCase):
+    def test_search_nonces(self):
+        """
+        test if the mining kernel finds a block satisfying the target
+        """
+        block = mine(genesisblock, [])
+        self.assertEqual(block.prevhash, genesisblock.hash)
+        self.assertTrue(int(block.hash, 16) < int(block.target, 16))
+        self.assertTrue(block.header.has_valid_pow())
+
+    def test_worker(self):
+        """
+        test if a worker finds a block for the published template
+        """
+        import queue
+        import threading
+        import multiprocessing
+        from koppercoin.tokens import mining
+        from koppercoin.tokens.workview import Workview
+        view = Workview()
+        view.publish(Block.from_prevblock(genesisblock, transactions=[]))
+        (results, stop) = (queue.Queue(), threading.Event())
+        worker = threading.Thread(target=mining._worker,
+                                  args=(0, view, multiprocessing.Value('Q', 0), results, stop))
+        worker.start()
+        while True:
+            message = results.get(timeout=60)
+            if message[0] == 'block':
+                break
+        stop.set()
+        worker.join(5)
+        block = message[2]
+        self.assertEqual(block.prevhash, genesisblock.hash)
+        self.assertTrue(block.header.has_valid_pow())
+
 
 class TestTransferTransactions(unittest.TestCase):
     def setUp(self):
@@ -220,6 +320,44 @@ class TestTransferTransactions(unittest.TestCase):
         """
         self.assertEquals(Transaction.from_json(self.tx.json()).hash, self.tx.hash)
 
+    def test_encode_decode_identical(self):
+        """
+        test if t and decode(encode(t)) are identical
+        """
+        decoded = Transaction.decode(self.tx.encode())
+        self.assertEqual(decoded.hash, self.tx.hash)
+        self.assertEqual(decoded.encode(), self.tx.encode())
+        self.assertEqual(decoded.is_valid(blockchain=self.bc), True)
+
+    def test_signature_cache(self):
+        """
+        test if verified inputs are cached and not verified again
+        """
+        cache = Signaturecache()
+        self.assertEqual(self.tx.is_valid(blockchain=self.bc, sigcache=cache), True)
+        self.assertIn((self.tx.hash, 0), cache)
+        # a cached input is accepted without checking the signature
+        with mock.patch.object(Transaction, '_check_input_signatures', return_value=False):
+            self.assertEqual(self.tx.check_signatures(blockchain=self.bc, sigcache=cache), True)
+            self.assertEqual(self.tx.check_signatures(blockchain=self.bc), False)
+
+    def test_parallel_validation(self):
+        """
+        test if the signatures of a block are verified by the process pool
+        """
+        from koppercoin.tokens.validation import Validationexecutor
+        executor = Validationexecutor(2, threshold=1)
+        try:
+            block = Block.from_prevblock(self.bc.current_block, transactions=[self.tx])
+            self.assertEqual(block.is_valid(blockchain=self.bc, sigcache=None, executor=executor), True)
+            # a transaction whose outputs have been changed after signing
+            tampered = Transaction.decode(self.tx.encode())
+            tampered.outputs = list(reversed(tampered.outputs))
+            self.assertEqual(executor.check_signatures([tampered, self.tx], blockchain=self.bc), False)
+            self.assertEqual(executor.check_signatures([self.tx], blockchain=self.bc), True)
+        finally:
+            executor.close()
+
 
 class TestMultisigTransactions(unittest.TestCase):
     def setUp(self):
@@ -344,6 +482,26 @@ class TestMultisigTransactions(unittest.TestCase):
         """
         self.assertEquals(Transaction.from_json(self.multisig_tx.json()).hash, self.multisig_tx.hash)
 
+    def test_encode_decode_identical(self):
+        """
+        test if t and decode(encode(t)) are identical
+        where t contains a multisig output
+        """
+        self.assertEqual(Transaction.decode(self.multisig_tx.encode()).hash, self.multisig_tx.hash)
+        self.assertEqual(Transaction.decode(self.multisigspend_tx.encode()).is_valid(blockchain=self.bc), True)
+
+    def test_multisig_needs_all_signers(self):
+        """
+        test if a multisig input is invalid if one signature is used
+        for two pubkeys
+        """
+        tx = Transaction.decode(self.multisigspend_tx.encode())
+        txin = tx.inputs[0]
+        tx.inputs = [TxInput(prevhashes=txin.prevhashes, signatures=[txin.signatures[0]] * 2, amount=txin.amount)]
+        self.assertEqual(tx.check_signatures(blockchain=self.bc), False)
+        tx.inputs = [TxInput(prevhashes=txin.prevhashes, signatures=txin.signatures[:1], amount=txin.amount)]
+        self.assertEqual(tx.check_signatures(blockchain=self.bc), False)
+
 
 class TestWallet(unittest.TestCase):
     """
@@ -0,0 +1,181 @@
+import unittest
+# Set test environment flag
+import koppercoin.config
+koppercoin.config.test = True
+
+from koppercoin.tokens import *
+from koppercoin.tokens.wallet import *
+from unittest import mock
+from koppercoin.tokens.sigcache import Signaturecache
+from koppercoin.tokens.validation import Validationpipeline
+from koppercoin.tokens.keyimages import Bloomfilter
+from test_transactions import Mockpersistence, mine
+
+
+class TestValidationpipeline(unittest.TestCase):
+    def setUp(self):
+        self.bc = Blockchain(persistence=Mockpersistence())
+        self.wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        self.coinbase_tx = self.wal.gen_coinbase_tx(1)
+        self.fstblock = mine(genesisblock, [self.coinbase_tx])
+        self.bc.add_block(self.fstblock)
+        self.tx = self.wal.gen_transfer_tx(1, [self.wal.public_key], [self.coinbase_tx.outputs[0].amount//2], 2)
+        self.mempool = Mempool(persistencemanager=Mockpersistence(), allowload=False)
+        self.pipeline = Validationpipeline(self.bc, self.mempool, sigcache=Signaturecache())
+
+    def test_transaction_stages(self):
+        """
+        test if transactions are rejected by the cheapest failing stage
+        """
+        self.assertEqual(self.pipeline.check_transaction(self.wal.gen_coinbase_tx(2)), False)
+        self.assertEqual(self.pipeline.rejected['transaction']['structure'], 1)
+        tampered = Transaction.decode(self.tx.encode())
+        tampered.outputs = [TxOutput(amount=1, recipientpubkeys=self.tx.outputs[0].recipientpubkeys,
+                                     condition=OutputCondition.singlesig)]
+        self.assertEqual(self.pipeline.check_transaction(tampered), False)
+        self.assertEqual(self.pipeline.rejected['transaction']['signatures'], 1)
+        self.assertEqual(self.pipeline.check_transaction(self.tx), True)
+        self.assertEqual(self.pipeline.accepted['transaction'], 1)
+        self.pipeline.seentransactions.add(self.tx.hash)
+        self.assertEqual(self.pipeline.check_transaction(self.tx), False)
+        self.assertEqual(self.pipeline.rejected['transaction']['duplicate'], 1)
+
+    def test_block_stages(self):
+        """
+        test if blocks are rejected by the cheapest failing stage
+        """
+        coinbase_tx = self.wal.gen_coinbase_tx(2)
+        block = mine(self.fstblock, [self.tx, coinbase_tx])
+        # an invalid nonce
+        invalid = LazyBlock.decode(block.encode())
+        while invalid.header.has_valid_pow():
+            invalid.nonce += 1
+        self.assertEqual(self.pipeline.check_block(invalid), False)
+        self.assertEqual(self.pipeline.rejected['block']['pow'], 1)
+        # a coinbase which pays more than the reward and the fees
+        output = coinbase_tx.outputs[0]
+        greedy_tx = Transaction.gen_coinbase(output=TxOutput(amount=output.amount + 3, condition=output.condition,
+                                                             recipientpubkeys=output.recipientpubkeys),
+                                             pubkey=coinbase_tx.pubkey)
+        greedy = mine(self.fstblock, [self.tx, greedy_tx])
+        self.assertEqual(self.pipeline.check_block(greedy), False)
+        self.assertEqual(self.pipeline.rejected['block']['coinbase'], 1)
+        self.assertEqual(self.pipeline.check_block(LazyBlock.decode(block.encode())), True)
+        self.assertEqual(self.pipeline.accepted['block'], 1)
+        self.bc.add_block(block)
+        self.assertEqual(self.pipeline.check_block(block), False)
+        self.assertEqual(self.pipeline.rejected['block']['duplicate'], 1)
+
+    def test_easy_target(self):
+        """
+        test if a block whose target is easier than the one of the chain
+        is rejected, although its hash is below its own target
+        """
+        easy = Block.from_prevblock(self.fstblock, transactions=[self.wal.gen_coinbase_tx(2)])
+        easy.target = 'f' * 128
+        while not easy.header.has_valid_pow():
+            easy.nonce += 1
+        self.assertEqual(self.pipeline.check_block(easy), False)
+        self.assertEqual(self.pipeline.rejected['block']['pow'], 1)
+
+    def test_inflated_fees(self):
+        """
+        test if inputs which declare more than their ring holds are
+        rejected, with the coinbase claiming the inflated fees
+        """
+        inflated = Transaction.decode(self.tx.encode())
+        inflated.inputs = [TxInput(prevhashes=txin.prevhashes, signatures=txin.signatures, amount=txin.amount + 1000)
+                           for txin in inflated.inputs]
+        self.assertEqual(inflated.fee, self.tx.fee + 1000 * len(self.tx.inputs))
+        self.assertEqual(inflated.is_valid(blockchain=self.bc), False)
+        self.assertEqual(self.pipeline.check_transaction(inflated), False)
+        self.assertEqual(self.pipeline.rejected['transaction']['signatures'], 1)
+        block = mine(self.fstblock, [inflated, self.wal.gen_coinbase_tx(2, fees=inflated.fee)])
+        self.assertEqual(block.has_valid_coinbase(), True)
+        self.assertEqual(self.pipeline.check_block(block), False)
+        self.assertEqual(self.pipeline.rejected['block']['signatures'], 1)
+
+    def test_mutated_block(self):
+        """
+        test if a block which repeats its last transaction is rejected
+        without affecting the block with the same hash
+        """
+        coinbases = [self.wal.gen_coinbase_tx(2) for _ in range(3)]
+        block = mine(self.fstblock, coinbases)
+        mutated = Block.from_prevblock(self.fstblock, transactions=coinbases + coinbases[-1:])
+        (mutated.timestamp, mutated.nonce) = (block.timestamp, block.nonce)
+        self.assertEqual(mutated.hash, block.hash)
+        self.assertEqual(self.pipeline.check_block(mutated), False)
+        self.assertEqual(self.pipeline.rejected['block']['structure'], 1)
+        self.assertEqual(mutated.is_valid(blockchain=self.bc), False)
+        self.assertEqual(self.bc.add_block(mutated), Blockchain.Chainupdate(disconnected=[], connected=[]))
+        self.assertNotIn(block.hash, self.bc.blocks)
+        self.assertNotIn(block.hash, self.bc.invalid)
+
+    def test_contract_input(self):
+        """
+        test if spending a contract output is rejected instead of
+        failing
+        """
+        txin = self.tx.inputs[0]
+        contract = TxOutput(amount=txin.amount, recipientpubkeys=self.coinbase_tx.outputs[0].recipientpubkeys,
+                            condition=OutputCondition.contract)
+        self.assertEqual(Transaction._check_input_signatures(txin, [contract], self.tx.signed_message()), False)
+
+    def test_invalid_transactions(self):
+        """
+        test if the signatures of a rejected transaction are not
+        verified again and only the newest ones are remembered
+        """
+        pipeline = Validationpipeline(self.bc, self.mempool, sigcache=Signaturecache(), maxinvalid=1)
+        tampered = []
+        for amount in (1, 2):
+            tx = Transaction.decode(self.tx.encode())
+            tx.outputs = [TxOutput(amount=amount, recipientpubkeys=self.tx.outputs[0].recipientpubkeys,
+                                   condition=OutputCondition.singlesig)]
+            tampered.append(tx)
+        self.assertEqual(pipeline.check_transaction(tampered[0]), False)
+        check_signatures = Transaction.check_signatures
+        with mock.patch.object(Transaction, 'check_signatures', autospec=True,
+                               side_effect=check_signatures) as checked:
+            self.assertEqual(pipeline.check_transaction(tampered[0]), False)
+            self.assertEqual(checked.call_count, 0)
+            self.assertEqual(pipeline.rejected['transaction']['duplicate'], 1)
+            self.assertEqual(pipeline.check_transaction(tampered[1]), False)
+            self.assertEqual(list(pipeline.invalidtransactions), [tampered[1].hash])
+            self.assertEqual(pipeline.check_transaction(tampered[0]), False)
+            self.assertEqual(checked.call_count, 2)
+
+    def test_keyimage_conflicts(self):
+        """
+        test if transactions spending a keyimage of the mempool are rejected
+        """
+        self.assertEqual(self.pipeline.check_transaction(self.tx), True)
+        self.mempool.add(self.tx)
+        # the coinbase is not spent in the blockchain, so the wallet
+        # spends it again
+        conflicting = self.wal.gen_transfer_tx(1, [self.wal.public_key], [1], 2)
+        self.assertEqual(self.pipeline.registry.conflicts(conflicting), [self.tx])
+        self.assertEqual(self.pipeline.check_transaction(conflicting), False)
+        self.assertEqual(self.pipeline.rejected['transaction']['keyimages'], 1)
+        self.assertEqual(self.mempool.admit(conflicting, blockchain=self.bc), False)
+        # the transaction is included in a block
+        self.mempool.remove_spent([conflicting])
+        self.assertEqual(self.mempool.pool, set())
+        self.assertEqual(self.pipeline.registry.is_spent(self.tx.keyimages[0]), False)
+
+    def test_keyimage_filter(self):
+        """
+        test if the Bloomfilter in front of the keyimages of the blockchain
+        answers lookups correctly
+        """
+        bc = Blockchain(persistence=Mockpersistence(), keyimagefilter=Bloomfilter(2**12, 3))
+        bc.add_block(self.fstblock)
+        self.assertRaises(KeyError, bc.get_transaction_by_keyimage, self.tx.keyimages[0])
+        bc.add_block(Block.from_prevblock(self.fstblock, transactions=[self.tx]))
+        self.assertEqual(bc.get_transaction_by_keyimage(self.tx.keyimages[0]), self.tx)
+        self.assertEqual(self.tx.is_doublespend(blockchain=bc), False)
+
+
+if __name__ == 'main':
+    unittest.main()
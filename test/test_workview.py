@@ -0,0 +1,103 @@
+import unittest
+# Set test environment flag
+import koppercoin.config
+koppercoin.config.test = True
+
+import time
+import queue
+import threading
+import multiprocessing
+from koppercoin.tokens import *
+from koppercoin.tokens.wallet import *
+from koppercoin.tokens import mining
+from koppercoin.tokens.workview import Workview
+from test_transactions import Mockpersistence
+
+
+def read_hash(view, results):
+    (generation, block) = view.read()
+    results.put((generation, block.hash))
+
+
+class TestWorkview(unittest.TestCase):
+    def setUp(self):
+        self.bc = Blockchain(persistence=Mockpersistence())
+        self.wal = Wallet(persist=False, force_new=True, blockchain=self.bc)
+        self.template = Block.from_prevblock(genesisblock, transactions=[self.wal.gen_coinbase_tx(1)])
+
+    def test_publish(self):
+        """
+        test if a published template is read by another process
+        """
+        view = Workview()
+        self.assertEqual(view.read(), (0, None))
+        self.assertEqual(view.publish(self.template), 2)
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=read_hash, args=(view, results))
+        process.start()
+        self.assertEqual(results.get(timeout=30), (2, self.template.hash))
+        process.join()
+        self.assertRaises(ValueError, Workview(size=10).publish, self.template)
+
+
+class TestMiningmanager(unittest.TestCase):
+    def next_message(self, results, kind):
+        while True:
+            message = results.get(timeout=5)
+            if message[0] == kind:
+                return message
+
+    def test_switch(self):
+        """
+        test if a worker switches to a new template without being
+        restarted and searches its own nonce ranges
+        """
+        bc = Blockchain(persistence=Mockpersistence())
+        wal = Wallet(persist=False, force_new=True, blockchain=bc)
+        template = Block.from_prevblock(genesisblock, transactions=[wal.gen_coinbase_tx(1)])
+        view = Workview()
+        # no nonce satisfies this target
+        template.target = "0" * 128
+        view.publish(template)
+        (results, stop) = (queue.Queue(), threading.Event())
+        extranonces = multiprocessing.Value('Q', 5)
+        worker = threading.Thread(target=mining._worker, args=(0, view, extranonces, results, stop))
+        worker.start()
+        self.assertEqual(self.next_message(results, 'work'), ('work', 0, 2))
+        self.assertEqual(extranonces.value, 6)
+        start = time.time()
+        view.publish(template)
+        self.assertEqual(self.next_message(results, 'work'), ('work', 0, 4))
+        self.assertLess(time.time() - start, 1)
+        # the worker reports its hashrate
+        (kind, id, hashes, shares, seconds) = self.next_message(results, 'stats')
+        self.assertGreater(hashes, 0)
+        stop.set()
+        worker.join(5)
+        self.assertEqual(worker.is_alive(), False)
+
+    def test_mine(self):
+        """
+        test if the mining process mines on the templates of the node
+        """
+        bc = Blockchain(persistence=Mockpersistence())
+        wal = Wallet(persist=False, force_new=True, blockchain=bc)
+        mempool = Mempool(persistencemanager=Mockpersistence(), allowload=False)
+        found = []
+        mm = Miningmanager(mempool, bc, wal, callback=found.append, num_threads=1)
+        mm.start_mining()
+        deadline = time.time() + 120
+        while len(found) < 2 and time.time() < deadline:
+            time.sleep(0.1)
+        mm.stop_mining()
+        self.assertGreaterEqual(len(found), 2)
+        self.assertEqual([block.blockheight for block in found[:2]], [1, 2])
+        self.assertEqual(bc.get_block_by_height(2).hash, found[1].hash)
+        self.assertEqual(mm.view.read()[1].prevhash, bc.maxblock.hash)
+        # each block is a share
+        self.assertGreaterEqual(mm.shares, len(found))
+        self.assertGreater(mm.hashrate, 0)
+
+
+if __name__ == 'main':
+    unittest.main()